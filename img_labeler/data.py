@@ -3,6 +3,8 @@
 
 import pickle
 import os
+import json
+import struct
 import numpy as np
 import random
 from datetime import datetime
@@ -61,6 +63,10 @@ class PeakNetData(DataManager):
       (2, H, W).
     - Offers an interface that allows users to modify the label tensor with the
       shape (1, H, W).  The label tensor only supports integer type.
+
+    `snapshot_labels` shares labels with a background save, and
+    `detach_label` copies a shared label before it's edited again, as well
+    as a label of typed data before its first edit.
     """
 
     def __init__(self, config_data):
@@ -87,6 +93,7 @@ class PeakNetData(DataManager):
 
         # Internal variables...
         self.data_list = []
+        self.shared_label_idx_set = set()
 
         set_seed(self.seed)
 
@@ -96,6 +103,12 @@ class PeakNetData(DataManager):
 
 
     def load_dataset(self):
+        # Memory map a typed data file saved by the labeler...
+        if is_typed_data(self.path_pnd):
+            self.data_list = load_data(self.path_pnd)
+
+            return None
+
         with open(self.path_pnd, 'rb') as fh:
             data_list = pickle.load(fh)
 
@@ -117,3 +130,225 @@ class PeakNetData(DataManager):
             self.set_random_state()
 
         return img, label
+
+
+    def detach_label(self, idx, label):
+        ''' Return the label of frame `idx` that is safe to edit in place.
+
+            The label is copied first if it's shared with a pending snapshot
+            (copy-on-write), or still mapped from a typed data file.
+        '''
+        is_mapped = isinstance(self.data_list, MmapDataList) and not self.data_list.is_edited(idx)
+        if idx in self.shared_label_idx_set or is_mapped:
+            img, label = self.data_list[idx]
+            label = np.array(label)
+            self.data_list[idx] = (img, label)
+            self.shared_label_idx_set.discard(idx)
+
+        return label
+
+
+    def snapshot_labels(self):
+        ''' Return a list of (image, label) that stays unchanged until
+            `release_snapshot`, without copying any frame.
+        '''
+        if isinstance(self.data_list, MmapDataList):
+            snapshot = self.data_list.snapshot()
+        else:
+            snapshot = [ self.data_list[idx] for idx in range(len(self.data_list)) ]
+        self.shared_label_idx_set = set(range(len(snapshot)))
+
+        return snapshot
+
+
+    def release_snapshot(self):
+        self.shared_label_idx_set = set()
+
+        return None
+
+
+
+
+
+def save_state(path_state, obj_to_save, progress_callback = None):
+    ''' Pickle a session state to a temporary path and rename it on
+        completion, so an interrupted save never clobbers the last state.
+    '''
+    if progress_callback is not None: progress_callback(0, 1)
+
+    path_tmp = f"{path_state}.tmp"
+    with open(path_tmp, 'wb') as fh:
+        pickle.dump(obj_to_save, fh, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(path_tmp, path_state)
+
+    if progress_callback is not None: progress_callback(1, 1)
+
+    return None
+
+
+
+# Typed data format...
+# - MAGIC
+# - Header size (uint64, little endian)
+# - Header in JSON, describing dtype, shape and byte offset of each array
+# - Image array, shape (N, ...) (aligned)
+# - Label array, shape (N, ...) (aligned)
+DATA_MAGIC     = b"IMGLBL01"
+DATA_ALIGNMENT = 4096
+
+def is_typed_data(path_data):
+    with open(path_data, 'rb') as fh:
+        magic = fh.read(len(DATA_MAGIC))
+
+    return magic == DATA_MAGIC
+
+
+
+
+def save_data(path_data, data_list, progress_callback = None):
+    ''' Save a list of (image, label) into the typed data format frame by
+        frame, so the whole dataset is never copied in memory.
+
+        The file is written to a temporary path and renamed on completion.
+        `progress_callback(num_done, num_data)` is called along the way.
+    '''
+    num_data = len(data_list)
+    if num_data == 0: raise ValueError("There is no data to save.")
+
+    img, label = data_list[0]
+    img, label = np.asarray(img), np.asarray(label)
+
+    # Describe the layout...
+    def align(offset): return -(-offset // DATA_ALIGNMENT) * DATA_ALIGNMENT
+
+    header = { "num_data" : num_data, "timestamp" : datetime.now().strftime("%Y_%m%d_%H%M_%S") }
+    offset = DATA_ALIGNMENT
+    for k, arr in (("image", img), ("label", label)):
+        shape  = (num_data, ) + arr.shape
+        nbytes = int(np.prod(shape)) * arr.dtype.itemsize
+        header[k] = { "dtype" : arr.dtype.str, "shape" : list(shape), "offset" : offset }
+        offset = align(offset + nbytes)
+
+    header_bytes = json.dumps(header).encode()
+    assert len(DATA_MAGIC) + 8 + len(header_bytes) <= DATA_ALIGNMENT, "Header is too large!!!"
+
+    # Write the header and allocate the file...
+    path_tmp = f"{path_data}.tmp"
+    with open(path_tmp, 'wb') as fh:
+        fh.write(DATA_MAGIC)
+        fh.write(struct.pack('<Q', len(header_bytes)))
+        fh.write(header_bytes)
+        fh.truncate(offset)
+
+    # Fill in frames...
+    mmap_dict = { k : np.memmap(path_tmp, dtype = header[k]["dtype"], mode = 'r+',
+                                offset = header[k]["offset"], shape = tuple(header[k]["shape"]))
+                  for k in ("image", "label") }
+    num_step = max(num_data // 100, 1)
+    for idx in range(num_data):
+        img, label = data_list[idx]
+        mmap_dict["image"][idx] = img
+        mmap_dict["label"][idx] = label
+
+        if progress_callback is not None and (idx + 1) % num_step == 0: progress_callback(idx + 1, num_data)
+
+    # Release the maps before the rename...
+    for k in ("image", "label"): mmap_dict[k].flush()
+    del mmap_dict
+
+    os.replace(path_tmp, path_data)
+
+    return None
+
+
+
+
+def load_data(path_data):
+    ''' Return a lazy `MmapDataList` for a typed data file.
+    '''
+    with open(path_data, 'rb') as fh:
+        magic = fh.read(len(DATA_MAGIC))
+        assert magic == DATA_MAGIC, f"{path_data} is not a typed data file!!!"
+
+        header_size, = struct.unpack('<Q', fh.read(8))
+        header = json.loads(fh.read(header_size))
+
+    return MmapDataList(path_data, header)
+
+
+
+
+def load_data_edits(path_data, timestamp, label_dict):
+    ''' Return a `MmapDataList` of a typed data file with edited labels
+        {idx : label} on top, as pickled in a saved state.
+    '''
+    data_list = load_data(path_data)
+    assert data_list.header["timestamp"] == timestamp, f"{path_data} has changed since the state was saved!!!"
+
+    for idx, label in label_dict.items(): data_list[idx] = (data_list.img_array[idx], label)
+
+    return data_list
+
+
+
+
+class MmapDataList:
+    """
+    A list of (image, label) backed by memory maps of a typed data file.
+
+    Opening is O(1), and frames page in on demand.  Images are mapped
+    copy-on-write and labels read-only, so the file is never touched.
+    Frames that are replaced (e.g. by `detach_label` before an edit) are
+    kept in `frame_dict`.
+
+    A pickled `MmapDataList` (e.g. in a saved state) refers to its file and
+    only carries edited labels, so the file must stay in place and
+    unchanged.
+    """
+
+    def __init__(self, path_data, header):
+        self.path_data = path_data
+        self.header    = header
+
+        self.img_array, self.label_array = [ np.memmap(path_data, dtype = header[k]["dtype"], mode = mode,
+                                                       offset = header[k]["offset"], shape = tuple(header[k]["shape"]))
+                                             for k, mode in (("image", 'c'), ("label", 'r')) ]
+
+        self.frame_dict = {}
+
+        return None
+
+
+    def __len__(self):
+        return self.header["num_data"]
+
+
+    def __getitem__(self, idx):
+        if idx in self.frame_dict: return self.frame_dict[idx]
+
+        return self.img_array[idx], self.label_array[idx]
+
+
+    def __setitem__(self, idx, frame):
+        self.frame_dict[idx] = frame
+
+
+    def is_edited(self, idx):
+        return idx in self.frame_dict
+
+
+    def snapshot(self):
+        ''' Return a list of the same frames sharing the maps, which replaced
+            frames don't affect.
+        '''
+        data_list = MmapDataList.__new__(MmapDataList)
+        data_list.__dict__.update(self.__dict__, frame_dict = dict(self.frame_dict))
+
+        return data_list
+
+
+    def __reduce__(self):
+        # Pickle a reference to the file with edited labels only...
+        label_dict = { idx : np.asarray(label) for idx, (_, label) in self.frame_dict.items() }
+
+        return (load_data_edits, (self.path_data, self.header["timestamp"], label_dict))
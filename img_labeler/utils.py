@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import random
+import threading
 import numpy as np
-import skimage.measure as sm
 import psana
 
+from collections        import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
 def set_seed(seed):
     random.seed(seed)
     np.random.seed(seed)
@@ -117,22 +121,90 @@ class PerfMetric:
 
 
 
+def block_sum(data, bin_row, bin_col):
+    """ Sum (B, H, W) over blocks of (bin_row, bin_col) with reshapes.
+
+        Edges that don't divide evenly are summed as partial blocks, without
+        padding the whole stack.
+    """
+    B, H, W = data.shape
+    H_main  = H - H % bin_row
+    W_main  = W - W % bin_col
+    H_block = H_main // bin_row
+    W_block = W_main // bin_col
+
+    out = np.zeros((B, -(-H // bin_row), -(-W // bin_col)), dtype = np.result_type(data.dtype, np.float32))
+
+    # Full blocks...
+    out[:, :H_block, :W_block] = data[:, :H_main, :W_main].reshape(B, H_block, bin_row, W_block, bin_col).sum(axis = (2, 4))
+
+    # Partial blocks at the bottom and right edges...
+    if H_main < H:
+        out[:, -1, :W_block] = data[:, H_main:, :W_main].reshape(B, H - H_main, W_block, bin_col).sum(axis = (1, 3))
+    if W_main < W:
+        out[:, :H_block, -1] = data[:, :H_main, W_main:].reshape(B, H_block, bin_row, W - W_main).sum(axis = (2, 3))
+    if H_main < H and W_main < W:
+        out[:, -1, -1] = data[:, H_main:, W_main:].sum(axis = (1, 2))
+
+    return out
+
+
+
+
 def downsample(assem, bin_row=2, bin_col=2, mask=None):
-    """ Downsample an SPI image.  
+    """ Downsample an SPI image (H, W) or a stack of images (B, H, W) by
+        mask-weighted binning.  A (H, W) mask is shared by all images.
+
+        Each block is the sum of all its pixels divided by the weight of its
+        good pixels in `mask`, so bad pixels must be zeroed beforehand for
+        a mean of good pixels.
         Adopted from https://github.com/chuckie82/DeepProjection/blob/master/DeepProjection/utils.py
     """
+    assem = np.asarray(assem)
+    is_2d = assem.ndim == 2
+    if is_2d: assem = assem[None]
+
+    B, H, W = assem.shape
+
     if mask is None:
-        combinedMask = np.ones_like(assem)
+        # Count pixels per block directly instead of binning an all-ones mask...
+        count_row = np.full(-(-H // bin_row), bin_row)
+        count_col = np.full(-(-W // bin_col), bin_col)
+        count_row[-1] = H - (len(count_row) - 1) * bin_row
+        count_col[-1] = W - (len(count_col) - 1) * bin_col
+        downWeight = np.outer(count_row, count_col)[None]
+        downCalib  = block_sum(assem, bin_row, bin_col)
     else:
-        combinedMask = mask
-    downCalib  = sm.block_reduce(assem       , block_size=(bin_row, bin_col), func=np.sum)
-    downWeight = sm.block_reduce(combinedMask, block_size=(bin_row, bin_col), func=np.sum)
-    warr       = np.zeros_like(downCalib, dtype='float32')
-    ind        = np.where(downWeight > 0)
-    warr[ind]  = downCalib[ind] / downWeight[ind]
+        mask = np.asarray(mask)
+        if mask.ndim == 2: mask = mask[None]
+        downWeight = block_sum(mask, bin_row, bin_col)
+        downCalib  = block_sum(assem, bin_row, bin_col)
+
+    warr = np.zeros(downCalib.shape, dtype='float32')
+    np.divide(downCalib, downWeight, out = warr, where = downWeight > 0, casting = 'unsafe')
+
+    return warr[0] if is_2d else warr
+
+
+
+
+def downsample_dataset(dataset, bin_row=2, bin_col=2, mask=None, chunk_size=64, out=None):
+    """ Downsample a whole (N, H, W) dataset, e.g. an h5py dataset or a
+        memmap, chunk by chunk so that only `chunk_size` frames are in memory.
+
+        `mask` is either (H, W) or (N, H, W).  `out` can be any preallocated
+        array-like (e.g. an h5py dataset) of the binned shape.
+    """
+    N, H, W = dataset.shape
+    if out is None: out = np.zeros((N, -(-H // bin_row), -(-W // bin_col)), dtype = 'float32')
+
+    for idx_start in range(0, N, chunk_size):
+        idx_end    = min(idx_start + chunk_size, N)
+        mask_chunk = mask if mask is None or mask.ndim == 2 else mask[idx_start:idx_end]
 
-    return warr
+        out[idx_start:idx_end] = downsample(dataset[idx_start:idx_end], bin_row, bin_col, mask_chunk)
 
+    return out
 
 
 
@@ -140,34 +212,231 @@ class PsanaImg:
     """
     It serves as an image accessing layer based on the data management system
     psana in LCLS.  
+
+    Images are assembled from calibrated panels with a pixel index map that
+    is computed once per run and detector and shared by all instances.
+
+    Pass `path_timestamps` to persist the event-to-timestamp index, so that
+    later sessions skip `run.times()`.
     """
 
-    def __init__(self, exp, run, mode, detector_name):
+    # Pixel index maps keyed by (exp, run, detector_name)...
+    pixel_index_map_cache = {}
+
+    def __init__(self, exp, run, mode, detector_name, path_timestamps = None):
+        self.exp             = exp
+        self.run             = run
+        self.detector_name   = detector_name
+        self.path_timestamps = path_timestamps
 
         # Biolerplate code to access an image
         # Set up data source
         self.datasource_id = f"exp={exp}:run={run}:{mode}"
         self.datasource    = psana.DataSource( self.datasource_id )
         self.run_current   = next(self.datasource.runs())
-        self.timestamps    = self.run_current.times()
+        self.timestamps    = self.load_timestamps()
 
         # Set up detector
         self.detector = psana.Detector(detector_name)
 
+        # Serialize access to psana, which isn't thread-safe...
+        self.lock = threading.Lock()
 
-    def get(self, event_num, multipanel = None, mode = "image"):
-        # Fetch the timestamp according to event number...
-        timestamp = self.timestamps[int(event_num)]
 
-        # Access each event based on timestamp...
-        event = self.run_current.event(timestamp)
+    def load_timestamps(self):
+        ''' Return timestamps of all events, from `path_timestamps` if it's
+            been saved before.
+        '''
+        if self.path_timestamps is not None and os.path.exists(self.path_timestamps):
+            # Each row is (seconds, nanoseconds, fiducial)...
+            timestamp_array = np.load(self.path_timestamps)
+            timestamps = [ psana.EventTime(int((sec << 32) | nsec), int(fid)) for sec, nsec, fid in timestamp_array.tolist() ]
+
+            return timestamps
+
+        timestamps = self.run_current.times()
+
+        if self.path_timestamps is not None:
+            timestamp_array = np.array([ (t.seconds(), t.nanoseconds(), t.fiducial()) for t in timestamps ], dtype = 'uint64')
+
+            # Write through a file handle so that `np.save` doesn't append .npy...
+            with open(self.path_timestamps, 'wb') as fh:
+                np.save(fh, timestamp_array)
+
+        return timestamps
+
+
+    def get_pixel_index_map(self):
+        ''' Return the flat index of each panel pixel in the assembled image,
+            and the shape of the assembled image.
+        '''
+        key = (self.exp, self.run, self.detector_name)
+        if key not in PsanaImg.pixel_index_map_cache:
+            # Same geometry used by `detector.image`, i.e. img[iX, iY] = calib...
+            iX, iY = self.detector.indexes_xy(int(self.run))
+            iX, iY = np.asarray(iX).ravel(), np.asarray(iY).ravel()
+
+            shape    = (int(iX.max()) + 1, int(iY.max()) + 1)
+            flat_idx = np.ravel_multi_index((iX, iY), shape)
+
+            PsanaImg.pixel_index_map_cache[key] = (flat_idx, shape)
+
+        return PsanaImg.pixel_index_map_cache[key]
+
+
+    def assemble(self, multipanel, out = None, is_batch = None):
+        ''' Assemble one event (panel, H, W) or a batch of events
+            (B, panel, H, W) into images with a single scatter.  A batch is
+            told by its 4 dimensions unless `is_batch` says otherwise, e.g.
+            for single-panel detectors.
+
+            Pass a preallocated `out` of shape (H_img, W_img) or
+            (B, H_img, W_img) to reuse the output buffer.  Pixels outside of
+            panels are left untouched in a reused buffer.
+        '''
+        flat_idx, shape = self.get_pixel_index_map()
+
+        multipanel = np.asarray(multipanel)
+        is_batch   = multipanel.ndim == 4 if is_batch is None else is_batch
+        num_batch  = len(multipanel) if is_batch else 1
+
+        if out is None: out = np.zeros((num_batch, ) + shape, dtype = multipanel.dtype)
 
+        out_flat = out.reshape(num_batch, -1)
+        out_flat[:, flat_idx] = multipanel.reshape(num_batch, -1)
+
+        return out if is_batch else out.reshape(shape)
+
+
+    def get(self, event_num, multipanel = None, mode = "image"):
         # Only three modes are supported...
-        assert mode in ("raw", "image", "calib"), f"Mode {mode} is not allowed!!!  Only 'raw' or 'image' are supported."
+        assert mode in ("raw", "image", "calib"), f"Mode {mode} is not allowed!!!  Only 'raw', 'image' or 'calib' are supported."
+
+        with self.lock:
+            # Fetch the timestamp according to event number...
+            timestamp = self.timestamps[int(event_num)]
+
+            # Access each event based on timestamp...
+            event = self.run_current.event(timestamp)
+
+            # Fetch image data based on timestamp from detector...
+            if mode != "image":
+                read = { "raw"   : self.detector.raw,
+                         "calib" : self.detector.calib }
+                img = read[mode](event) if multipanel is None else read[mode](event, multipanel)
+
+                return img
+
+            if multipanel is None: multipanel = self.detector.calib(event)
+
+        # Assemble calibrated panels using the cached pixel index map...
+        return None if multipanel is None else self.assemble(multipanel)
+
+
+    def get_batch(self, event_num_list, mode = "image", out = None):
+        ''' Return images of many events stacked along the first axis.  Events
+            without data are filled with zeros.
+        '''
+        read = { "raw"   : self.detector.raw,
+                 "calib" : self.detector.calib,
+                 "image" : self.detector.calib }
+
+        multipanel_list = []
+        with self.lock:
+            for event_num in event_num_list:
+                event      = self.run_current.event(self.timestamps[int(event_num)])
+                multipanel = read[mode](event)
+                multipanel_list.append(multipanel)
+
+        # Fill missing events with zeros...
+        shape_panel = next((i.shape for i in multipanel_list if i is not None), None)
+        if shape_panel is None: return None
+        multipanel_list = [ np.zeros(shape_panel, dtype = 'float32') if i is None else i for i in multipanel_list ]
+        multipanel_list = np.stack(multipanel_list)
+
+        if mode != "image": return multipanel_list
+
+        return self.assemble(multipanel_list, out = out, is_batch = True)
+
+
+
+
+class PsanaPrefetcher:
+    """
+    Fetch and calibrate psana events on background threads ahead of the
+    consumer.
+
+    At most `depth` events are in flight or held, so memory stays bounded.
+    psana access itself is serialized by `PsanaImg.lock`; image assembly and
+    the consumer run concurrently with it.
+
+    - `get(event_num)` serves browsing and schedules the following events.
+    - `iter(event_num_list)` streams (event_num, img) in order for exports.
+    """
+
+    def __init__(self, psana_img, mode = "image", num_workers = 1, depth = 16):
+        self.psana_img   = psana_img
+        self.mode        = mode
+        self.num_workers = num_workers
+        self.depth       = depth
+
+        # Internal variables...
+        self.executor    = ThreadPoolExecutor(max_workers = num_workers)
+        self.future_dict = OrderedDict()
+
+        return None
+
+
+    def submit(self, event_num):
+        ''' Schedule an event unless it's scheduled already, and make it the
+            most recently used one.
+        '''
+        if event_num in self.future_dict:
+            self.future_dict.move_to_end(event_num)
+
+            return self.future_dict[event_num]
+
+        self.future_dict[event_num] = self.executor.submit(self.psana_img.get, event_num, mode = self.mode)
+
+        # Forget the least recently used events beyond the depth...
+        while len(self.future_dict) > self.depth:
+            _, future = self.future_dict.popitem(last = False)
+            future.cancel()
+
+        return self.future_dict[event_num]
+
+
+    def get(self, event_num, num_ahead = None):
+        num_event = len(self.psana_img.timestamps)
+        num_ahead = self.depth - 1 if num_ahead is None else min(num_ahead, self.depth - 1)
+
+        future = self.submit(event_num)
+
+        # Schedule upcoming events, those already in flight are refreshed so
+        # that only events behind are evicted...
+        for event_num_next in range(event_num + 1, min(event_num + 1 + num_ahead, num_event)):
+            self.submit(event_num_next)
+
+        return future.result()
+
+
+    def iter(self, event_num_list):
+        future_queue = deque()
+        for event_num in event_num_list:
+            future_queue.append((event_num, self.executor.submit(self.psana_img.get, event_num, mode = self.mode)))
+
+            if len(future_queue) >= self.depth:
+                event_num_done, future = future_queue.popleft()
+                yield event_num_done, future.result()
+
+        while future_queue:
+            event_num_done, future = future_queue.popleft()
+            yield event_num_done, future.result()
+
 
-        # Fetch image data based on timestamp from detector...
-        read = { "image" : self.detector.image,
-                 "calib" : self.detector.calib }
-        img = read[mode](event) if multipanel is None else read[mode](event, multipanel)
+    def close(self):
+        for future in self.future_dict.values(): future.cancel()
+        self.future_dict.clear()
+        self.executor.shutdown(wait = True)
 
-        return img
+        return None
@@ -3,16 +3,46 @@
 
 import os
 import sys
+import copy
 import pickle
 import numpy as np
 
 from .utils import hex_to_rgb
+from .data  import save_data, load_data, is_typed_data, save_state
 
 import pyqtgraph as pg
 
 from pyqtgraph    import LabelItem, ImageItem, SignalProxy, PolyLineROI, GraphicsLayoutWidget
 from pyqtgraph.Qt import QtWidgets, QtCore, QtGui
 
+class SaveWorker(QtCore.QThread):
+    ''' Run `func(path, progress_callback)` on a worker thread so that the
+        UI stays responsive during a save.
+    '''
+    sigProgress = QtCore.Signal(int, int)
+    sigDone     = QtCore.Signal(str, str)    # (path, error message)
+
+    def __init__(self, func, path):
+        super().__init__()
+
+        self.func = func
+        self.path = path
+
+        return None
+
+
+    def run(self):
+        msg_error = ""
+        try:
+            self.func(self.path, self.sigProgress.emit)
+        except Exception as e:
+            msg_error = repr(e)
+
+        self.sigDone.emit(self.path, msg_error)
+
+
+
+
 class Window(QtWidgets.QMainWindow):
     def __init__(self, layout, data_manager):
         super().__init__()
@@ -53,6 +83,8 @@ class Window(QtWidgets.QMainWindow):
         self.proxy_click = None
         self.proxy_moved = None
 
+        self.save_worker = None
+
         self.fetchMousePosition()
 
         self.dispImg()
@@ -61,6 +93,9 @@ class Window(QtWidgets.QMainWindow):
 
 
     def closeEvent(self, event):
+        # Let a running save finish...
+        if self.save_worker is not None: self.save_worker.wait()
+
         QtWidgets.QApplication.closeAllWindows()
         event.accept()
 
@@ -181,7 +216,7 @@ class Window(QtWidgets.QMainWindow):
         x = int(mouse_pos.x())
         y = int(mouse_pos.y())
 
-        label = self.label    # (1, H, W)
+        label = self.get_label_to_edit()    # (1, H, W)
         layer_active = self.data_manager.layer_manager['layer_active']
         size_x, size_y = label.shape[-2:]
         if x < size_x and y < size_y:
@@ -201,7 +236,7 @@ class Window(QtWidgets.QMainWindow):
         if len(self.two_click_pos_list) == 2:
             (x_0, y_0), (x_1, y_1) = self.two_click_pos_list
 
-            label = self.label    # (1, H, W)
+            label = self.get_label_to_edit()    # (1, H, W)
             layer_active = self.data_manager.layer_manager['layer_active']
             size_x, size_y = label.shape[-2:]
 
@@ -257,7 +292,7 @@ class Window(QtWidgets.QMainWindow):
         self.layout.viewer_img.getView().addItem(self.roi_item)
 
         # Fetch image, label and mask...
-        label = self.label
+        label = self.get_label_to_edit()
         layer_active = self.data_manager.layer_manager['layer_active']
 
         # Fetch the right ROI...
@@ -327,6 +362,14 @@ class Window(QtWidgets.QMainWindow):
         return None
 
 
+    def get_label_to_edit(self):
+        ''' Return the current label, detached from any pending save.
+        '''
+        self.label = self.data_manager.detach_label(self.idx_img, self.label)
+
+        return self.label
+
+
     ###############
     ### DIPSLAY ###
     ###############
@@ -407,20 +450,53 @@ class Window(QtWidgets.QMainWindow):
     ################
     ### MENU BAR ###
     ################
+    def isSaving(self):
+        is_saving = self.save_worker is not None and self.save_worker.isRunning()
+        if is_saving: print("A save is still in progress, please try again later.")
+
+        return is_saving
+
+
+    def startSave(self, func, path):
+        self.save_worker = SaveWorker(func, path)
+        self.save_worker.sigProgress.connect(self.reportSaveProgress)
+        self.save_worker.sigDone.connect(self.finishSave)
+        self.save_worker.start()
+
+        self.statusBar().showMessage(f"Saving {path}...")
+
+        return None
+
+
+    def reportSaveProgress(self, num_done, num_total):
+        self.statusBar().showMessage(f"Saving {self.save_worker.path}: {num_done}/{num_total}")
+
+
+    def finishSave(self, path, msg_error):
+        # Labels can be edited in place again...
+        self.data_manager.release_snapshot()
+
+        if msg_error:
+            print(f"Failed to save {path}: {msg_error}")
+            self.statusBar().showMessage(f"Failed to save {path}")
+        else:
+            print(f"{path} saved")
+            self.statusBar().showMessage(f"{path} saved", 5000)
+
+        return None
+
+
     def saveStateDialog(self):
         path_pickle, is_ok = QtWidgets.QFileDialog.getSaveFileName(self, 'Save File', f'{self.timestamp}.pickle')
 
-        if is_ok:
-            obj_to_save = ( self.data_manager.data_list,
-                            self.data_manager.layer_manager,
+        if is_ok and not self.isSaving():
+            obj_to_save = ( self.data_manager.snapshot_labels(),
+                            copy.deepcopy(self.data_manager.layer_manager),
                             self.data_manager.state_random,
                             self.idx_img,
                             self.timestamp )
 
-            with open(path_pickle, 'wb') as fh:
-                pickle.dump(obj_to_save, fh, protocol = pickle.HIGHEST_PROTOCOL)
-
-            print(f"{path_pickle} saved")
+            self.startSave(lambda path, progress_callback: save_state(path, obj_to_save, progress_callback), path_pickle)
 
         return None
 
@@ -428,7 +504,8 @@ class Window(QtWidgets.QMainWindow):
     def loadStateDialog(self):
         path_pickle = QtWidgets.QFileDialog.getOpenFileName(self, 'Open File')[0]
 
-        if os.path.exists(path_pickle):
+        # Frames of a running save must stay in `data_list`...
+        if os.path.exists(path_pickle) and not self.isSaving():
             with open(path_pickle, 'rb') as fh:
                 obj_saved = pickle.load(fh)
                 self.data_manager.data_list     = obj_saved[0]
@@ -437,32 +514,37 @@ class Window(QtWidgets.QMainWindow):
                 self.idx_img                    = obj_saved[3]
                 self.timestamp                  = obj_saved[4]
 
-            self.dispImg()
             self.num_img = len(self.data_manager.data_list)
+            self.dispImg()
 
         return None
 
 
     def saveDataDialog(self):
-        path_npy, is_ok = QtWidgets.QFileDialog.getSaveFileName(self, 'Save File', f'{self.timestamp}.data.npy')
+        path_data, is_ok = QtWidgets.QFileDialog.getSaveFileName(self, 'Save File', f'{self.timestamp}.data')
 
-        if is_ok:
-            obj_to_save = np.save(path_npy, self.data_manager.data_list)
+        if is_ok and not self.isSaving():
+            snapshot = self.data_manager.snapshot_labels()
 
-            print(f"{path_npy} is saved")
+            self.startSave(lambda path, progress_callback: save_data(path, snapshot, progress_callback), path_data)
 
         return None
 
 
     def loadDataDialog(self):
-        path_npy = QtWidgets.QFileDialog.getOpenFileName(self, 'Load Data')[0]
+        path_data = QtWidgets.QFileDialog.getOpenFileName(self, 'Load Data')[0]
 
-        if os.path.exists(path_npy):
-            self.data_manager.data_list = np.load(path_npy)
+        # Frames of a running save must stay in `data_list`...
+        if os.path.exists(path_data) and not self.isSaving():
+            # Memory map typed data, or fall back to a legacy npy...
+            if is_typed_data(path_data):
+                self.data_manager.data_list = load_data(path_data)
+            else:
+                self.data_manager.data_list = list(np.load(path_data, allow_pickle = True))
 
-            print(f"{path_npy} is loaded.")
-            self.dispImg()
+            print(f"{path_data} is loaded.")
             self.num_img = len(self.data_manager.data_list)
+            self.dispImg()
 
         return None
 
@@ -1,9 +1,22 @@
-from . import data, layout, window, utils
+from . import data, layout, window, utils, sampler, diskcache, export, autosave, pixelstats, objects, peaks, predict, scheduler, session, agreement, filmstrip, tiles
 
 __all__ = [
             "data", 
             "layout", 
             "window", 
             "utils",
+            "sampler",
+            "diskcache",
+            "export",
+            "autosave",
+            "pixelstats",
+            "objects",
+            "peaks",
+            "predict",
+            "scheduler",
+            "session",
+            "agreement",
+            "filmstrip",
+            "tiles",
 ]
 
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Inter-annotator agreement of two or more label sources.
+
+A source is one of
+
+- a saved labeler state (`*.pickle`),
+- an edit log of a session or a merged one (e.g. `session/alice.edits`),
+- a labeler YAML (`*.yaml`), whose CXI segmasks are the labels.
+
+Frames labeled in all sources are compared pairwise.  Labels are turned
+into index-coded labels (bit-packed ones by `layer_order`, later layers on
+top) and each frame is reduced to a confusion matrix by one `np.bincount`,
+which gives per-class IoU and Cohen's kappa.  Peaks (connected components
+of `encode_peak`) are matched one-to-one as mutual nearest centroids within
+`max_distance` pixels.
+
+Frames are compared by worker processes, one CXI file per task, and read
+`chunk_size` frames at a time so that memory doesn't grow with the number
+of frames per file.  Labels of saved states are spooled to a temporary log
+of autosave records, so workers read them by offset like edit logs.
+
+    python -m manual_peak_labeler.agreement --source session/alice.edits session/bob.edits --path_output qc
+
+writes per-frame rows to `qc.frames.csv`, aggregates over all frames to
+`qc.json` and frames below `kappa_threshold` to `qc.adjudicate.yaml`, which
+the labeler opens as `path_yaml`.
+"""
+
+import os
+import csv
+import json
+import yaml
+import zlib
+import pickle
+import tempfile
+import argparse
+import itertools
+import numpy as np
+
+from scipy.spatial      import cKDTree
+from concurrent.futures import ProcessPoolExecutor
+
+from .data       import CXI_KEY, open_read_only
+from .utils      import bitplane_to_index
+from .peaks      import find_peaks
+from .session    import index_edit_log, read_record
+from .autosave   import decode_record
+from .pixelstats import list_event
+
+
+def get_confusion(label_a, label_b, num_class):
+    ''' Return the (num_class, num_class) confusion matrix of two index-coded
+        labels, rows by `label_a`.  Encodes beyond `num_class` are ignored.
+    '''
+    label_a  = np.asarray(label_a, dtype = np.int64).ravel()
+    label_b  = np.asarray(label_b, dtype = np.int64).ravel()
+    is_valid = (label_a < num_class) & (label_b < num_class)
+
+    return np.bincount(label_a[is_valid] * num_class + label_b[is_valid], minlength = num_class**2).reshape(num_class, num_class)
+
+
+
+
+def get_iou(confusion):
+    ''' Return per-class IoU (nan for classes absent from both labels).
+    '''
+    intersection = np.diag(confusion).astype(np.float64)
+    union        = confusion.sum(axis = 0) + confusion.sum(axis = 1) - intersection
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return np.where(union > 0, intersection / union, np.nan)
+
+
+
+
+def get_kappa(confusion):
+    num_total = confusion.sum()
+    if num_total == 0: return np.nan
+
+    p_observed = np.trace(confusion) / num_total
+    p_expected = (confusion.sum(axis = 0) * confusion.sum(axis = 1)).sum() / num_total**2
+    if p_expected == 1: return 1.0
+
+    return (p_observed - p_expected) / (1 - p_expected)
+
+
+
+
+def match_peaks(label_a, label_b, encode_peak = 1, max_distance = 3.0):
+    ''' Return (number of peaks in a, in b, matched) where a match is a pair
+        of mutual nearest centroids within `max_distance`.
+    '''
+    weight = np.ones(label_a.shape)
+    y_a, x_a, _ = find_peaks(weight, label_a, encode_peak)
+    y_b, x_b, _ = find_peaks(weight, label_b, encode_peak)
+    if len(y_a) == 0 or len(y_b) == 0: return len(y_a), len(y_b), 0
+
+    pos_a = np.stack([y_a, x_a], axis = 1)
+    pos_b = np.stack([y_b, x_b], axis = 1)
+    _, nn_a = cKDTree(pos_b).query(pos_a, distance_upper_bound = max_distance)
+    _, nn_b = cKDTree(pos_a).query(pos_b, distance_upper_bound = max_distance)
+
+    # Misses point past the end of the other list...
+    is_hit    = nn_a < len(pos_b)
+    is_mutual = np.zeros(len(pos_a), dtype = bool)
+    is_mutual[is_hit] = nn_b[nn_a[is_hit]] == np.arange(len(pos_a))[is_hit]
+
+    return len(y_a), len(y_b), int(is_mutual.sum())
+
+
+
+
+def get_f1(num_a, num_b, num_matched):
+    return 2 * num_matched / (num_a + num_b) if num_a + num_b > 0 else np.nan
+
+
+
+
+def to_index(label, label_mode, layer_order):
+    label = np.asarray(label)
+    if label.ndim == 3: label = label[0]
+
+    return bitplane_to_index(label, layer_order) if label_mode == 'bitplane' else label
+
+
+
+
+class LabelSource:
+    ''' Labels of one source keyed by (path_cxi, event_idx).  Labels of
+        saved states and edit logs are indexed in the main process and read
+        in workers, segmasks are read in workers.
+    '''
+
+    def __init__(self, path_source, label_mode = 'index'):
+        self.path_source = path_source
+        self.label_mode  = label_mode
+        self.path_spool  = None
+
+        if path_source.endswith((".pickle", ".pkl")):
+            self.kind = "log"
+            with open(path_source, 'rb') as fh:
+                obj_saved = pickle.load(fh)
+            label_state = obj_saved[4] if len(obj_saved) > 4 else {}
+            self.entry_dict = self.spool({ k : v for k, v in label_state.items() if k[1] is not None })
+        elif path_source.endswith((".yaml", ".yml")):
+            self.kind = "cxi"
+            self.entry_dict = { (path_cxi, event_idx) : None for path_cxi, event_idx_list in list_event(path_source).items()
+                                                             for event_idx in event_idx_list }
+        else:
+            self.kind = "log"
+            self.entry_dict = { k : v[1:] for k, v in index_edit_log(path_source).items() if k[1] is not None }
+
+        return None
+
+
+    def spool(self, label_state):
+        ''' Write labels to a temporary log of autosave records.
+
+            Return {key : (path_spool, offset)}.
+        '''
+        fd, self.path_spool = tempfile.mkstemp(suffix = ".labels")
+
+        entry_dict = {}
+        with os.fdopen(fd, 'wb') as fh:
+            for key, label in label_state.items():
+                label  = np.asarray(label)
+                record = { "key"   : key,
+                           "shape" : label.shape,
+                           "dtype" : label.dtype.str,
+                           "blob"  : zlib.compress(np.ascontiguousarray(label).tobytes(), 1), }
+                entry_dict[key] = (self.path_spool, fh.tell())
+                pickle.dump(record, fh, protocol = pickle.HIGHEST_PROTOCOL)
+
+        return entry_dict
+
+
+    def close(self):
+        if self.path_spool is not None and os.path.exists(self.path_spool): os.remove(self.path_spool)
+
+        return None
+
+
+    def get_task(self, key_list):
+        ''' Return what a worker needs to read labels of `key_list`.
+        '''
+        return self.kind, self.label_mode, [ self.entry_dict[key] for key in key_list ]
+
+
+
+
+def read_labels(path_cxi, event_idx_list, task, layer_order):
+    ''' Return index-coded labels of one source in a worker.
+    '''
+    kind, label_mode, entry_list = task
+
+    if kind == "log": return [ to_index(decode_record(read_record(*entry)), label_mode, layer_order) for entry in entry_list ]
+
+    with open_read_only(path_cxi) as fh:
+        dataset    = fh.get(CXI_KEY["segmask"])
+        label_mode = dataset.attrs.get("label_mode", "index")
+
+        # h5py wants increasing indices for fancy reads...
+        order      = np.argsort(event_idx_list)
+        label_list = [None] * len(event_idx_list)
+        for i, label in zip(order, dataset[np.asarray(event_idx_list)[order].tolist()]):
+            label_list[i] = to_index(label, label_mode, layer_order)
+
+    return label_list
+
+
+
+
+def compare_group(path_cxi, event_idx_list, task_list, num_class, layer_order, encode_peak, max_distance, chunk_size = 64):
+    ''' Compare all pairs of sources on frames of one CXI file, reading
+        `chunk_size` frames of all sources at a time.
+
+        Return (per-frame rows, {pair : summed confusion}, {pair : summed peak counts}).
+    '''
+    pair_list      = list(itertools.combinations(range(len(task_list)), 2))
+    row_dict       = { pair : [] for pair in pair_list }
+    confusion_dict = { pair : np.zeros((num_class, num_class), dtype = np.int64) for pair in pair_list }
+    peak_dict      = { pair : np.zeros(3, dtype = np.int64) for pair in pair_list }
+    for idx_b in range(0, len(event_idx_list), chunk_size):
+        event_idx_chunk = event_idx_list[idx_b:idx_b + chunk_size]
+        label_table     = [ read_labels(path_cxi, event_idx_chunk, (kind, label_mode, entry_list[idx_b:idx_b + chunk_size]), layer_order)
+                            for kind, label_mode, entry_list in task_list ]
+
+        for i, j in pair_list:
+            for event_idx, label_a, label_b in zip(event_idx_chunk, label_table[i], label_table[j]):
+                confusion = get_confusion(label_a, label_b, num_class)
+                peak      = match_peaks(label_a, label_b, encode_peak, max_distance)
+                confusion_dict[(i, j)] += confusion
+                peak_dict[(i, j)]      += peak
+
+                row = { "path_cxi" : path_cxi, "event_idx" : int(event_idx), "pair" : f"{i}-{j}", "kappa" : get_kappa(confusion) }
+                row.update({ f"iou_{c}" : iou for c, iou in enumerate(get_iou(confusion)) })
+                row.update({ "num_peak_a" : peak[0], "num_peak_b" : peak[1], "num_matched" : peak[2], "f1_peak" : get_f1(*peak) })
+                row_dict[(i, j)].append(row)
+
+    row_list = [ row for pair in pair_list for row in row_dict[pair] ]
+
+    return row_list, confusion_dict, peak_dict
+
+
+
+
+def compute_agreement(source_list, num_class = 4,
+                      layer_order  = None,
+                      encode_peak  = 1,
+                      max_distance = 3.0,
+                      chunk_size   = 64,
+                      num_workers  = 4):
+    ''' Compare frames labeled in all sources, one CXI file per task.
+
+        Return (per-frame rows, aggregate report).
+    '''
+    layer_order = list(range(num_class)) if layer_order is None else layer_order
+
+    # Align frames...
+    key_set = set.intersection(*[ set(source.entry_dict) for source in source_list ])
+    key_dict = {}
+    for path_cxi, event_idx in sorted(key_set):
+        key_dict.setdefault(path_cxi, []).append(event_idx)
+    print(f"{len(key_set)} frames are labeled in all {len(source_list)} sources.")
+
+    row_list       = []
+    confusion_dict = {}
+    peak_dict      = {}
+    with ProcessPoolExecutor(max_workers = num_workers) as executor:
+        future_list = []
+        for path_cxi, event_idx_list in key_dict.items():
+            key_list  = [ (path_cxi, event_idx) for event_idx in event_idx_list ]
+            task_list = [ source.get_task(key_list) for source in source_list ]
+            future_list.append(executor.submit(compare_group, path_cxi, event_idx_list, task_list, num_class, layer_order, encode_peak, max_distance, chunk_size))
+
+        for future in future_list:
+            row_group, confusion_group, peak_group = future.result()
+            row_list.extend(row_group)
+            for pair in confusion_group:
+                confusion_dict[pair] = confusion_dict.get(pair, 0) + confusion_group[pair]
+                peak_dict[pair]      = peak_dict.get(pair, 0)      + peak_group[pair]
+
+    report = { "source" : [ source.path_source for source in source_list ], "num_frame" : len(key_set), "pair" : {} }
+    for (i, j), confusion in confusion_dict.items():
+        num_a, num_b, num_matched = peak_dict[(i, j)].tolist()
+        report["pair"][f"{i}-{j}"] = {
+            "kappa"     : float(get_kappa(confusion)),
+            "iou"       : [ None if np.isnan(iou) else float(iou) for iou in get_iou(confusion) ],
+            "confusion" : confusion.tolist(),
+            "peak"      : { "num_a" : num_a, "num_b" : num_b, "num_matched" : num_matched, "f1" : float(get_f1(num_a, num_b, num_matched)) },
+        }
+
+    return row_list, report
+
+
+
+
+def write_reports(path_output, row_list, report, kappa_threshold = 0.8):
+    with open(f"{path_output}.frames.csv", 'w', newline = '') as fh:
+        if row_list:
+            writer = csv.DictWriter(fh, fieldnames = list(row_list[0].keys()))
+            writer.writeheader()
+            writer.writerows(row_list)
+
+    with open(f"{path_output}.json", 'w') as fh:
+        json.dump(report, fh, indent = 2)
+
+    # Frames any pair disagrees on, ready to be opened in the labeler...
+    event_dict = {}
+    for row in row_list:
+        if not row["kappa"] >= kappa_threshold: event_dict.setdefault(row["path_cxi"], set()).add(row["event_idx"])
+    event_dict = { path_cxi : sorted(event_idx_set) for path_cxi, event_idx_set in event_dict.items() }
+
+    with open(f"{path_output}.adjudicate.yaml", 'w') as fh:
+        yaml.safe_dump({ "cxi" : list(event_dict.keys()), "event" : event_dict }, fh, default_flow_style = None, sort_keys = False)
+
+    num_adjudicate = sum(len(v) for v in event_dict.values())
+    print(f"{num_adjudicate} frames have kappa below {kappa_threshold}, listed in {path_output}.adjudicate.yaml.")
+
+    return None
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compute inter-annotator agreement of label sources.")
+    parser.add_argument("--source"         , required = True, nargs = '+', help = "Saved states (.pickle), edit logs or labeler YAMLs (.yaml) of segmasks.")
+    parser.add_argument("--path_output"    , required = True, help = "Prefix of reports.")
+    parser.add_argument("--label_mode"     , default = 'index', choices = ['index', 'bitplane'], help = "Label mode of saved states and edit logs.")
+    parser.add_argument("--num_class"      , type = int  , default = 4, help = "Number of layers including the background.")
+    parser.add_argument("--layer_order"    , type = int  , default = None, nargs = '+', help = "Order of bit-packed layers, the last on top.")
+    parser.add_argument("--encode_peak"    , type = int  , default = 1, help = "Layer of peaks.")
+    parser.add_argument("--max_distance"   , type = float, default = 3.0, help = "Largest distance of matched peaks in pixels.")
+    parser.add_argument("--kappa_threshold", type = float, default = 0.8, help = "Frames below this kappa need adjudication.")
+    parser.add_argument("--chunk_size"     , type = int  , default = 64, help = "Number of frames read at a time.")
+    parser.add_argument("--num_workers"    , type = int  , default = 4, help = "Number of worker processes.")
+    args = parser.parse_args()
+
+    assert len(args.source) >= 2, "At least two sources are required!!!"
+
+    source_list = [ LabelSource(path_source, label_mode = args.label_mode) for path_source in args.source ]
+    try:
+        row_list, report = compute_agreement(source_list, num_class    = args.num_class,
+                                                          layer_order  = args.layer_order,
+                                                          encode_peak  = args.encode_peak,
+                                                          max_distance = args.max_distance,
+                                                          chunk_size   = args.chunk_size,
+                                                          num_workers  = args.num_workers)
+    finally:
+        for source in source_list: source.close()
+    write_reports(args.path_output, row_list, report, kappa_threshold = args.kappa_threshold)
+
+    for pair, pair_report in report["pair"].items():
+        print(f"Sources {pair}: kappa {pair_report['kappa']:.3f}, peak F1 {pair_report['peak']['f1']:.3f}")
+
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Crash-safe autosave of edited labels.
+
+Each checkpoint appends labels of frames modified since the previous one to
+a recovery log, a stream of pickled records
+
+    { "key" : (path_cxi, event_idx), "shape" : ..., "dtype" : ..., "blob" : ..., "time" : ... }
+
+where `blob` is the zlib compressed label and `time` the wall clock time of
+the edit.  Records carried over to a new log keep their time, so that a
+resumed session doesn't make old edits look recent.  Static labels are
+keyed by (path_cxi or None, None) instead.  A checkpoint writes at most
+`budget_bytes`; frames beyond the budget wait for the next checkpoint.
+
+A checkpoint is split into `begin_checkpoint` and `end_checkpoint` on the
+GUI thread and `write_checkpoint` in between, which compresses and syncs
+labels shared copy-on-write and may run on a worker thread.
+
+Logs rotate by generation (`<path_recovery>.<generation>`).  When the current
+log grows beyond `max_bytes` and is mostly outdated records, a new generation
+starts, all frames of the old one are queued again, and the old log is removed
+once they are all rewritten.
+Reading the logs in generation order and letting later records win recovers
+the latest labels, even if the last record was cut by a crash.
+"""
+
+import os
+import glob
+import time
+import zlib
+import pickle
+import numpy as np
+
+from collections import OrderedDict
+
+
+def list_recovery(path_recovery):
+    ''' Return [(generation, path_log), ...] of recovery logs in order.
+    '''
+    log_list = []
+    for path_log in glob.glob(f"{glob.escape(path_recovery)}.*"):
+        generation = path_log.rsplit('.', 1)[-1]
+        if generation.isdigit(): log_list.append((int(generation), path_log))
+
+    return sorted(log_list)
+
+
+
+
+def iter_record(path_log):
+    ''' Yield (offset, record) of all complete records in a log.
+    '''
+    with open(path_log, 'rb') as fh:
+        while True:
+            offset = fh.tell()
+            try:
+                record = pickle.load(fh)
+            except (EOFError, pickle.UnpicklingError, ValueError):
+                # A truncated tail only loses the last record...
+                break
+
+            yield offset, record
+
+    return None
+
+
+
+
+def decode_record(record):
+    return np.frombuffer(zlib.decompress(record["blob"]), dtype = record["dtype"]).reshape(record["shape"]).copy()
+
+
+
+
+def read_recovery(path_recovery, returns_time = False):
+    ''' Return the latest labels in all recovery logs keyed by
+        (path_cxi, event_idx), and the times of their edits if
+        `returns_time` is True.
+    '''
+    label_state = {}
+    time_state  = {}
+    for generation, path_log in list_recovery(path_recovery):
+        for _, record in iter_record(path_log):
+            key = tuple(record["key"])
+            label_state[key] = decode_record(record)
+
+            # Logs without time stamps order by generation...
+            time_state[key] = record.get("time", float(generation))
+
+    return (label_state, time_state) if returns_time else label_state
+
+
+
+
+def remove_recovery(path_recovery):
+    for _, path_log in list_recovery(path_recovery): os.remove(path_log)
+
+    return None
+
+
+
+
+class Autosaver:
+
+    def __init__(self, data_manager, path_recovery, budget_bytes = 8 * 1024**2, max_bytes = 256 * 1024**2):
+        self.data_manager  = data_manager
+        self.path_recovery = path_recovery
+        self.budget_bytes  = budget_bytes
+        self.max_bytes     = max_bytes
+
+        # Continue after the newest generation on disk...
+        generation_list = [ generation for generation, _ in list_recovery(path_recovery) ]
+
+        # Internal variables...
+        self.generation  = max(generation_list) + 1 if generation_list else 0
+        self.dirty_dict  = OrderedDict()    # idx -> None, in the order of edits
+        self.nbytes_dict = {}               # idx -> size of its latest record in the current generation
+        self.pending_set = set()            # idx of old generations not rewritten yet
+        self.time_dict   = {}               # idx -> time of its latest edit
+        self.job         = None             # checkpoint in flight
+
+        return None
+
+
+    def get_path_log(self, generation):
+        return f"{self.path_recovery}.{generation}"
+
+
+    def mark_dirty(self, idx, time_edit = None):
+        self.time_dict[idx]  = time.time() if time_edit is None else time_edit
+        self.dirty_dict[idx] = None
+        self.dirty_dict.move_to_end(idx)
+
+        return None
+
+
+    def begin_checkpoint(self, budget_bytes = None):
+        ''' Take dirty labels for a checkpoint, shared copy-on-write with the
+            data manager so that `write_checkpoint` can run on a worker
+            thread while labels are edited.
+
+            Return False if there is nothing to write.
+        '''
+        if not self.dirty_dict: return False
+
+        frame_list = []
+        for idx in self.dirty_dict:
+            key, label = self.data_manager.get_edited_label(idx)
+            if label is None: continue
+
+            frame_list.append((idx, key, label, self.time_dict.get(idx, time.time())))
+        self.dirty_dict.clear()
+
+        self.job = { "path_log"     : self.get_path_log(self.generation),
+                     "budget_bytes" : self.budget_bytes if budget_bytes is None else budget_bytes,
+                     "frame_list"   : frame_list,
+                     "written_list" : [], }
+        self.data_manager.share_checkpoint([ idx for idx, _, _, _ in frame_list ])
+
+        return True
+
+
+    def write_checkpoint(self):
+        ''' Append labels of the current job to its log within the I/O
+            budget.  Safe to run off the GUI thread.
+        '''
+        job = self.job
+
+        # A log that can't be written leaves the frames for the next
+        # checkpoint...
+        num_bytes = 0
+        try:
+            with open(job["path_log"], 'ab') as fh:
+                for idx, key, label, time_edit in job["frame_list"]:
+                    if num_bytes >= job["budget_bytes"]: break
+
+                    record = { "key"   : key,
+                               "shape" : label.shape,
+                               "dtype" : label.dtype.str,
+                               "blob"  : zlib.compress(np.ascontiguousarray(label).tobytes(), 1),
+                               "time"  : time_edit, }
+                    pickle.dump(record, fh, protocol = pickle.HIGHEST_PROTOCOL)
+
+                    num_bytes += len(record["blob"])
+                    job["written_list"].append((idx, len(record["blob"])))
+
+                # Make it survive a crash...
+                fh.flush()
+                os.fsync(fh.fileno())
+        except OSError as e:
+            print(f"Failed to autosave {job['path_log']}: {e}")
+            job["written_list"] = []
+
+        return None
+
+
+    def end_checkpoint(self):
+        ''' Book-keep the job written by `write_checkpoint` and release its
+            labels.
+
+            Return the number of frames written.
+        '''
+        job = self.job
+        if job is None: return 0
+
+        self.job = None
+        self.data_manager.release_checkpoint()
+
+        for idx, nbytes in job["written_list"]:
+            self.nbytes_dict[idx] = nbytes
+            self.pending_set.discard(idx)
+
+        # Frames beyond the budget (or all of a failed write) go first in
+        # the next checkpoint, unless they were edited meanwhile...
+        for idx, _, _, _ in reversed(job["frame_list"][len(job["written_list"]):]):
+            if idx in self.dirty_dict: continue
+
+            self.dirty_dict[idx] = None
+            self.dirty_dict.move_to_end(idx, last = False)
+
+        # Drop old generations once all their frames are rewritten...
+        if not self.pending_set: self.remove_old_logs()
+
+        # Start a new generation when the log is too large and mostly made
+        # of outdated records...
+        path_log = job["path_log"]
+        size_log = os.path.getsize(path_log) if os.path.exists(path_log) else 0
+        if size_log > self.max_bytes and size_log > 2 * sum(self.nbytes_dict.values()) and not self.pending_set:
+            self.rotate()
+
+        return len(job["written_list"])
+
+
+    def checkpoint(self, budget_bytes = None):
+        ''' Append dirty labels to the current log within the I/O budget on
+            the calling thread.
+
+            Return the number of frames written.
+        '''
+        if not self.begin_checkpoint(budget_bytes): return 0
+
+        try:
+            self.write_checkpoint()
+        finally:
+            num_written = self.end_checkpoint()
+
+        return num_written
+
+
+    def remove_old_logs(self):
+        for generation, path_log in list_recovery(self.path_recovery):
+            if generation < self.generation: os.remove(path_log)
+
+        return None
+
+
+    def adopt(self, idx_list, time_state = None):
+        ''' Carry frames restored from old logs over to the current
+            generation before the old logs are removed.  Their records keep
+            the times of edits in `time_state`, keyed like `read_recovery`.
+        '''
+        time_state = {} if time_state is None else time_state
+        for idx in idx_list:
+            key, _ = self.data_manager.get_edited_label(idx)
+            self.pending_set.add(idx)
+            self.mark_dirty(idx, time_state.get(key))
+
+        return None
+
+
+    def restart(self, idx_list):
+        ''' Start a new generation holding only frames in `idx_list`, e.g.
+            after labels are replaced by a loaded state.  Older logs are
+            removed once these frames are written.
+        '''
+        self.generation += 1
+        self.dirty_dict  = OrderedDict()
+        self.nbytes_dict = {}
+        self.time_dict   = {}
+        self.pending_set = set(idx_list)
+        for idx in idx_list: self.mark_dirty(idx)
+
+        if not self.pending_set: self.remove_old_logs()
+
+        return None
+
+
+    def rotate(self):
+        self.generation += 1
+        self.pending_set = set(self.nbytes_dict.keys())
+        self.nbytes_dict = {}
+        for idx in self.pending_set:
+            if idx not in self.dirty_dict: self.dirty_dict[idx] = None
+
+        return None
+
+
+    def flush(self):
+        ''' Write all dirty labels regardless of the budget, until a
+            checkpoint fails to write any.
+        '''
+        while self.dirty_dict:
+            if self.checkpoint(budget_bytes = float('inf')) == 0: break
+
+        return None
@@ -3,12 +3,53 @@
 
 import os
 import h5py
+import pickle
 import yaml
 import numpy as np
 import random
-from datetime import datetime
+from datetime    import datetime
+from collections import OrderedDict
+
+from .utils     import set_seed, apply_mask, index_to_bitplane, set_layer, get_integral_image, BITPLANE_DTYPE
+from .diskcache import DiskFrameCache
+
+# Define the keys used in a CXI file...
+CXI_KEY = {
+    "num_peaks"      : "/entry_1/result_1/nPeaks",
+    "peak_y"         : "/entry_1/result_1/peakYPosRaw",
+    "peak_x"         : "/entry_1/result_1/peakXPosRaw",
+    "peak_intensity" : "/entry_1/result_1/peakTotalIntensity",
+    "model_output"   : "/entry_1/result_1/model_output",
+    "data"           : "/entry_1/data_1/data",
+    "mask"           : "/entry_1/data_1/mask",
+    "segmask"        : "/entry_1/data_1/segmask",
+}
+
+
+def open_read_only(path_cxi):
+    ''' Open a CXI file read-only without taking the HDF5 file lock, so
+        that other processes can keep it open.
+    '''
+    try:
+        return h5py.File(path_cxi, 'r', locking = False)
+    except TypeError:
+        return h5py.File(path_cxi, 'r')
+
+
+
+
+def composite_static(label, static_label, label_mode = 'index'):
+    ''' Return `label` with layers of `static_label` (None if there's none)
+        on top.
+    '''
+    if static_label is None: return label
+
+    if label_mode == 'bitplane': return label | static_label
+
+    return np.where(static_label != 0, static_label, label)
+
+
 
-from .utils  import set_seed, apply_mask
 
 class DataManager:
     def __init__(self):
@@ -71,16 +112,84 @@ class PeakNetData(DataManager):
     - CXI 1
       - EVENT 0
       - EVENT 1
+
+    An optional `event` entry in the YAML maps a CXI path to a subset of
+    event indices (e.g. an index written by `sampler.write_index`).  Only
+    these events are exposed when it is present.
+
+    With `follows_live` set, CXI files are opened in SWMR read mode so that
+    `refresh_idx_list` can pick up events appended by a running writer.
+
+    Labels edited in this session are kept in `label_dict` (only frames that
+    are edited).  `snapshot_labels` shares them with a background save, and
+    `detach_label` copies a shared label before it's edited again.
+
+    Autosave is off unless `autosave_interval` (seconds) is positive.  Its
+    recovery logs are written to `dir_autosave`, the directory of the YAML
+    by default.
+
+    With `label_mode` set to 'bitplane', labels are bit-packed so that a
+    pixel can belong to several layers at once (up to `num_bitplane`, 8 or
+    16).  Index-coded segmasks are converted when they are read.
+
+    Layers marked with `'is_static' : True` in the layer metadata (e.g. bad
+    pixels) are properties of the detector.  They are stored once per CXI
+    file (or once for all files with `static_scope` set to 'dataset') in
+    `static_label_dict`, keyed by (path_cxi or None, None), and composited
+    on top of every frame by `get_img`.
     """
 
     def __init__(self, config_data):
         super().__init__()
 
         # Imported variables...
-        self.path_yaml     = getattr(config_data, 'path_yaml'    , None)
-        self.username      = getattr(config_data, 'username'     , None)
-        self.seed          = getattr(config_data, 'seed'         , None)
-        self.layer_manager = getattr(config_data, 'layer_manager', None)
+        self.path_yaml          = getattr(config_data, 'path_yaml'         , None)
+        self.username           = getattr(config_data, 'username'          , None)
+        self.seed               = getattr(config_data, 'seed'              , None)
+        self.layer_manager      = getattr(config_data, 'layer_manager'     , None)
+        self.path_frame_cache   = getattr(config_data, 'path_frame_cache'  , None)
+        self.dir_disk_cache     = getattr(config_data, 'dir_disk_cache'    , None)
+        self.disk_cache_gb      = getattr(config_data, 'disk_cache_gb'     , 10)
+        self.follows_live       = getattr(config_data, 'follows_live'      , False)
+        self.follow_interval    = getattr(config_data, 'follow_interval'   , 2.0)
+        self.auto_advance       = getattr(config_data, 'auto_advance'      , True)
+        self.autosave_interval  = getattr(config_data, 'autosave_interval' , 0)
+        self.autosave_budget_mb = getattr(config_data, 'autosave_budget_mb', 8)
+        self.autosave_max_mb    = getattr(config_data, 'autosave_max_mb'   , 256)
+        self.dir_autosave       = getattr(config_data, 'dir_autosave'      , None)
+        self.label_mode         = getattr(config_data, 'label_mode'        , 'index')
+        self.num_bitplane       = getattr(config_data, 'num_bitplane'      , 8)
+        self.static_scope       = getattr(config_data, 'static_scope'      , 'cxi')
+        self.beam_center        = getattr(config_data, 'beam_center'       , None)
+        self.num_integral_cache = getattr(config_data, 'num_integral_cache', 2)
+        self.stats_half_size    = getattr(config_data, 'stats_half_size'   , 2)
+        self.stats_half_size_bg = getattr(config_data, 'stats_half_size_bg', 5)
+        self.predictor          = getattr(config_data, 'predictor'         , None)
+        self.predict_workers    = getattr(config_data, 'predict_workers'   , 2)
+        self.predict_ahead      = getattr(config_data, 'predict_ahead'     , 4)
+        self.predict_cache      = getattr(config_data, 'predict_cache'     , 32)
+        self.predict_threshold  = getattr(config_data, 'predict_threshold' , 0.5)
+        self.predict_color      = getattr(config_data, 'predict_color'     , '#FF00FF')
+        self.uses_scheduler     = getattr(config_data, 'uses_scheduler'    , False)
+        self.dir_model_output   = getattr(config_data, 'dir_model_output'  , None)
+        self.schedule_score     = getattr(config_data, 'schedule_score'    , 'entropy')
+        self.dir_session        = getattr(config_data, 'dir_session'       , None)
+        self.opens_read_only    = getattr(config_data, 'opens_read_only'   , self.dir_session is not None)
+        self.uses_filmstrip     = getattr(config_data, 'uses_filmstrip'    , False)
+        self.thumbnail_bin      = getattr(config_data, 'thumbnail_bin'     , 8)
+        self.thumbnail_size     = getattr(config_data, 'thumbnail_size'    , 96)
+        self.thumbnail_workers  = getattr(config_data, 'thumbnail_workers' , 2)
+        self.thumbnail_cache    = getattr(config_data, 'thumbnail_cache'   , 512)
+        self.dir_thumbnail      = getattr(config_data, 'dir_thumbnail'     , None)
+        self.thumbnail_cache_mb = getattr(config_data, 'thumbnail_cache_mb', 256)
+        self.uses_tiles         = getattr(config_data, 'uses_tiles'        , False)
+        self.tile_size          = getattr(config_data, 'tile_size'         , 512)
+        self.tile_cache         = getattr(config_data, 'tile_cache'        , 64)
+        self.tile_max_visible   = getattr(config_data, 'tile_max_visible'  , 16)
+        self.tile_overview_size = getattr(config_data, 'tile_overview_size', 1024)
+
+        # Recovery logs go next to the YAML unless told otherwise...
+        if self.dir_autosave is None and self.path_yaml is not None: self.dir_autosave = os.path.dirname(os.path.abspath(self.path_yaml))
 
         if self.layer_manager is None:
             layer_metadata = {
@@ -95,47 +204,76 @@ class PeakNetData(DataManager):
                                    'layer_order'    : layer_order,
                                    'layer_active'   : layer_active, }
 
+        if self.label_mode == 'bitplane':
+            assert self.num_bitplane in BITPLANE_DTYPE, f"num_bitplane must be one of {list(BITPLANE_DTYPE)}!!!"
+            assert max(self.layer_manager['layer_metadata']) <= self.num_bitplane, \
+                f"Only {self.num_bitplane} layers fit in bit-packed labels!!!"
+
         # Load the YAML file
         with open(self.path_yaml, 'r') as fh:
             config = yaml.safe_load(fh)
         path_cxi_list = config['cxi']
+        event_dict    = config.get('event') or {}
 
-        # Define the keys used below...
-        CXI_KEY = {
-            "num_peaks" : "/entry_1/result_1/nPeaks",
-            "peak_y"    : "/entry_1/result_1/peakYPosRaw",
-            "peak_x"    : "/entry_1/result_1/peakXPosRaw",
-            "data"      : "/entry_1/data_1/data",
-            "mask"      : "/entry_1/data_1/mask",
-            "segmask"   : "/entry_1/data_1/segmask",
-        }
+        self.CXI_KEY = CXI_KEY
 
         # Open all cxi files and track their status...
         cxi_dict = {}
         for path_cxi in path_cxi_list:
             # Open a new file???
             if path_cxi not in cxi_dict:
+                fh = h5py.File(path_cxi, 'r', libver = 'latest', swmr = True) if self.follows_live    else \
+                     open_read_only(path_cxi)                                   if self.opens_read_only else \
+                     h5py.File(path_cxi, 'a')
                 cxi_dict[path_cxi] = {
-                    "file_handle" : h5py.File(path_cxi, 'a'),
+                    "file_handle" : fh,
                     "is_open"     : True,
+                    "num_event"   : 0,
+                    "is_subset"   : path_cxi in event_dict,
+                    "label_mode"  : fh.get(CXI_KEY["segmask"]).attrs.get("label_mode", "index"),
                 }
 
         # Build an entire idx list...
         idx_list = []
         for path_cxi, cxi in cxi_dict.items():
             fh = cxi["file_handle"]
-            k  = CXI_KEY["num_peaks"]
-            num_event = fh.get(k)[()]
-            for event_idx in range(len(num_event)):
-                idx_list.append((path_cxi, event_idx, fh))
+            num_event = self.get_num_event(fh)
+            cxi["num_event"] = num_event
+
+            # Only use the selected events if a subset is specified...
+            event_idx_list = event_dict.get(path_cxi, range(num_event))
+            for event_idx in event_idx_list:
+                idx_list.append((path_cxi, int(event_idx), fh))
 
 
         # Internal variables...
         self.cxi_dict      = cxi_dict
-        self.CXI_KEY       = CXI_KEY
         self.path_cxi_list = path_cxi_list
         self.idx_list      = idx_list
 
+        # Edited labels and those shared with a snapshot or a checkpoint...
+        self.label_dict               = {}
+        self.static_label_dict        = {}
+        self.shared_label_idx_set     = set()
+        self.checkpoint_label_idx_set = set()
+
+        # Summed-area tables of recently viewed frames...
+        self.integral_cache = OrderedDict()
+
+        # Connect to the node-local frame cache if available...
+        self.frame_cache = None
+        if self.path_frame_cache is not None:
+            try:
+                from .shmcache import FrameCacheClient
+                self.frame_cache = FrameCacheClient(self.path_frame_cache)
+            except (ImportError, OSError) as e:
+                print(f"Frame cache at {self.path_frame_cache} is not used: {e}")
+
+        # Serve revisits from a local disk if available...
+        self.disk_cache = None
+        if self.dir_disk_cache is not None:
+            self.disk_cache = DiskFrameCache(self.dir_disk_cache, int(self.disk_cache_gb * 1024**3))
+
         set_seed(self.seed)
 
         return None
@@ -145,7 +283,52 @@ class PeakNetData(DataManager):
         return self
 
 
+    def get_num_event(self, fh):
+        ''' Return the number of events that are complete in all datasets.
+        '''
+        num_event_list = []
+        for k in ("num_peaks", "data", "segmask"):
+            dataset = fh.get(self.CXI_KEY[k])
+            if self.follows_live: dataset.refresh()
+            num_event_list.append(len(dataset))
+
+        # Per-event masks grow with the data...
+        dataset = fh.get(self.CXI_KEY["mask"])
+        if dataset.ndim == 3:
+            if self.follows_live: dataset.refresh()
+            num_event_list.append(len(dataset))
+
+        return min(num_event_list)
+
+
+    def refresh_idx_list(self):
+        ''' Append events written since the last refresh to `idx_list`.
+            Only metadata is read, so it's cheap to poll.
+
+            Return the number of new events.
+        '''
+        num_new = 0
+        for path_cxi, cxi in self.cxi_dict.items():
+            # Files with an explicit subset of events are not followed...
+            if cxi["is_subset"] or not cxi["is_open"]: continue
+
+            # Growing files are modified, check cached frames against them again...
+            if self.disk_cache is not None: self.disk_cache.forget_source(path_cxi)
+
+            fh        = cxi["file_handle"]
+            num_event = self.get_num_event(fh)
+            for event_idx in range(cxi["num_event"], num_event):
+                self.idx_list.append((path_cxi, event_idx, fh))
+                num_new += 1
+            cxi["num_event"] = max(num_event, cxi["num_event"])
+
+        return num_new
+
+
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.frame_cache is not None: self.frame_cache.close()
+        if self.disk_cache  is not None: self.disk_cache.close()
+
         for path_cxi, cxi in self.cxi_dict.items():
             is_open = cxi.get("is_open")
             if is_open:
@@ -154,24 +337,60 @@ class PeakNetData(DataManager):
                 print(f"{path_cxi} is closed.")
 
 
-    def get_img(self, idx):
-        path_cxi, event_idx, fh = self.idx_list[idx]
+    def read_dataset(self, path_cxi, fh, k, event_idx = None):
+        ''' Read one event (or the whole dataset if `event_idx` is None),
+            through the local disk cache if available.  Segmasks are labels
+            that can change on disk at any time, so they are always read
+            from the file.
+        '''
+        if self.disk_cache is not None and k != self.CXI_KEY["segmask"]: return self.disk_cache.read(fh, path_cxi, k, event_idx)
+
+        dataset = fh.get(k)
+
+        return dataset[()] if event_idx is None else dataset[event_idx]
 
+
+    def read_masked_img(self, path_cxi, fh, event_idx):
         # Obtain the image...
         k   = self.CXI_KEY["data"]
-        img = fh.get(k)[event_idx]
+        img = self.read_dataset(path_cxi, fh, k, event_idx)
 
         # Obtain the bad pixel mask...
         k    = self.CXI_KEY['mask']
-        mask = fh.get(k)
-        mask = mask[event_idx] if mask.ndim == 3 else mask[()]
+        mask = self.read_dataset(path_cxi, fh, k, event_idx if fh.get(k).ndim == 3 else None)
 
         # Apply mask...
         img = apply_mask(img, 1 - mask, mask_value = 0)
 
-        # Obtain the segmask...
-        k       = self.CXI_KEY["segmask"]
-        segmask = fh.get(k)[event_idx]
+        return img
+
+
+    def get_img(self, idx, includes_static = True):
+        path_cxi, event_idx, fh = self.idx_list[idx]
+
+        # Obtain the masked image, shared with other labelers if possible...
+        if self.frame_cache is None:
+            img = self.read_masked_img(path_cxi, fh, event_idx)
+        else:
+            key = f"{os.path.realpath(path_cxi)}:{event_idx}"
+            img = self.frame_cache.get(key)
+            if img is None:
+                img = self.read_masked_img(path_cxi, fh, event_idx)
+                img = self.frame_cache.put(key, img)
+
+        # Obtain the segmask, or its edited version...
+        if idx in self.label_dict:
+            label = self.label_dict[idx]
+        else:
+            k     = self.CXI_KEY["segmask"]
+            label = self.read_dataset(path_cxi, fh, k, event_idx)[None,]
+
+            # Segmasks on disk are index-coded unless marked otherwise...
+            if self.label_mode == 'bitplane' and self.cxi_dict[path_cxi]["label_mode"] != 'bitplane':
+                label = index_to_bitplane(label, self.num_bitplane)
+
+        # Put static layers on top...
+        if includes_static: label = self.composite_label(idx, label)
 
         # Save random state...
         # Might not be useful for this labeler
@@ -182,4 +401,200 @@ class PeakNetData(DataManager):
             self.state_random = self.img_state_dict[idx]
             self.set_random_state()
 
-        return img[None,], segmask[None,]
+        return img[None,], label
+
+
+    def get_peak_candidates(self, idx):
+        ''' Return (position, intensity) of peaks listed in the CXI peak
+            table of frame `idx`, where `position` is (N, 2) in (row, col).
+            Intensities are 0 if the table has none.
+        '''
+        path_cxi, event_idx, fh = self.idx_list[idx]
+
+        num_peak = int(self.read_dataset(path_cxi, fh, self.CXI_KEY["num_peaks"], event_idx))
+        peak_y   = self.read_dataset(path_cxi, fh, self.CXI_KEY["peak_y"], event_idx)[:num_peak]
+        peak_x   = self.read_dataset(path_cxi, fh, self.CXI_KEY["peak_x"], event_idx)[:num_peak]
+        position = np.stack([peak_y, peak_x], axis = 1).astype(np.float64)
+
+        intensity = np.zeros(num_peak, dtype = np.float64)
+        if fh.get(self.CXI_KEY["peak_intensity"]) is not None:
+            intensity = self.read_dataset(path_cxi, fh, self.CXI_KEY["peak_intensity"], event_idx)[:num_peak].astype(np.float64)
+
+        return position, intensity
+
+
+    def get_integral_image(self, idx, img = None):
+        ''' Return summed-area tables of frame `idx`, built on first use from
+            `img` (H, W) if the caller already has the frame.
+        '''
+        if idx in self.integral_cache:
+            self.integral_cache.move_to_end(idx)
+            return self.integral_cache[idx]
+
+        if img is None: img = self.get_img(idx, includes_static = False)[0][0]
+        integral_tuple = get_integral_image(img)
+
+        self.integral_cache[idx] = integral_tuple
+        while len(self.integral_cache) > self.num_integral_cache: self.integral_cache.popitem(last = False)
+
+        return integral_tuple
+
+
+    def detach_label(self, idx, label):
+        ''' Return the label of frame `idx` that is safe to edit in place.
+
+            The label is registered in `label_dict`, and copied first if it's
+            shared with a pending snapshot (copy-on-write).
+        '''
+        label = self.label_dict.get(idx, label)
+        if self.is_shared(idx):
+            label = label.copy()
+            self.unshare(idx)
+        self.label_dict[idx] = label
+
+        return label
+
+
+    def is_static_layer(self, encode):
+        return self.layer_manager['layer_metadata'].get(encode, {}).get('is_static', False)
+
+
+    def get_static_key(self, idx):
+        ''' Return the key of the static label that frame `idx` uses.
+        '''
+        path_cxi, _, _ = self.idx_list[idx]
+
+        return (path_cxi if self.static_scope == 'cxi' else None, None)
+
+
+    def detach_static_label(self, key, label):
+        ''' Return the static label of `key` that is safe to edit in place,
+            an empty one like `label` if there is none yet.
+        '''
+        static_label = self.static_label_dict.get(key)
+        if static_label is None:
+            static_label = np.zeros_like(label)
+        elif self.is_shared(key):
+            static_label = static_label.copy()
+            self.unshare(key)
+        self.static_label_dict[key] = static_label
+
+        return static_label
+
+
+    def import_static_mask(self, mask_dict, encode):
+        ''' Set static layer `encode` on pixels in {path_cxi or None : mask},
+            where a mask keyed by None applies to all files.
+
+            Return keys of static labels that are updated.
+        '''
+        key_set = set()
+        for path_cxi, cxi in self.cxi_dict.items():
+            mask = mask_dict.get(path_cxi, mask_dict.get(None))
+            if mask is None: continue
+
+            dtype = BITPLANE_DTYPE[self.num_bitplane] if self.label_mode == 'bitplane' else \
+                    cxi["file_handle"].get(self.CXI_KEY["segmask"]).dtype
+            key   = (path_cxi if self.static_scope == 'cxi' else None, None)
+            static_label = self.detach_static_label(key, np.zeros((1, ) + mask.shape, dtype = dtype))
+            set_layer(static_label[0], encode, where = mask, label_mode = self.label_mode)
+            key_set.add(key)
+
+        return key_set
+
+
+    def composite_label(self, idx, label):
+        ''' Return `label` of frame `idx` with static layers on top.
+        '''
+        return composite_static(label, self.static_label_dict.get(self.get_static_key(idx)), self.label_mode)
+
+
+    def get_edited_label(self, k):
+        ''' Return (key, label) of edited frame `k`, or of a static label if
+            `k` is a static key.
+        '''
+        if isinstance(k, tuple): return k, self.static_label_dict.get(k)
+
+        path_cxi, event_idx, _ = self.idx_list[k]
+
+        return (path_cxi, event_idx), self.label_dict.get(k)
+
+
+    def snapshot_labels(self):
+        ''' Return edited labels keyed by (path_cxi, event_idx), and static
+            labels by their keys, without copying them.  They stay unchanged
+            until `release_snapshot`.
+        '''
+        self.shared_label_idx_set = set(self.label_dict.keys()) | set(self.static_label_dict.keys())
+
+        label_state = {}
+        for idx, label in self.label_dict.items():
+            path_cxi, event_idx, _ = self.idx_list[idx]
+            label_state[(path_cxi, event_idx)] = label
+        label_state.update(self.static_label_dict)
+
+        return label_state
+
+
+    def release_snapshot(self):
+        self.shared_label_idx_set = set()
+
+        return None
+
+
+    def share_checkpoint(self, k_list):
+        ''' Share labels of frames or static keys in `k_list` with an
+            autosave checkpoint until `release_checkpoint`.
+        '''
+        self.checkpoint_label_idx_set = set(k_list)
+
+        return None
+
+
+    def release_checkpoint(self):
+        self.checkpoint_label_idx_set = set()
+
+        return None
+
+
+    def is_shared(self, k):
+        return k in self.shared_label_idx_set or k in self.checkpoint_label_idx_set
+
+
+    def unshare(self, k):
+        self.shared_label_idx_set.discard(k)
+        self.checkpoint_label_idx_set.discard(k)
+
+        return None
+
+
+    def restore_labels(self, label_state):
+        ''' Restore edited labels saved by `snapshot_labels`.
+        '''
+        idx_dict = { (path_cxi, event_idx) : idx for idx, (path_cxi, event_idx, _) in enumerate(self.idx_list) }
+
+        self.label_dict        = {}
+        self.static_label_dict = {}
+        for k, label in label_state.items():
+            if k[1] is None    : self.static_label_dict[k] = label
+            elif k in idx_dict : self.label_dict[idx_dict[k]] = label
+
+        return None
+
+
+
+
+def save_state(path_state, obj_to_save, progress_callback = None):
+    ''' Pickle a session state to a temporary path and rename it on
+        completion, so an interrupted save never clobbers the last state.
+    '''
+    if progress_callback is not None: progress_callback(0, 1)
+
+    path_tmp = f"{path_state}.tmp"
+    with open(path_tmp, 'wb') as fh:
+        pickle.dump(obj_to_save, fh, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(path_tmp, path_state)
+
+    if progress_callback is not None: progress_callback(1, 1)
+
+    return None
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Read-through cache of CXI frames on a node-local disk.
+
+Each cached array is saved as a zlib compressed `.npy` blob.  An SQLite index
+next to the blobs keeps its size, CRC32 checksum, last access time and the
+stat of the source CXI file, so that
+
+- the cache survives restarts and can be shared by processes on a node,
+- blobs are evicted in LRU order once the size cap is exceeded,
+- corrupted blobs and blobs of modified source files are never served.
+
+Source files are statted at most once every `stat_ttl` seconds, or again
+after `forget_source`, to spare the parallel filesystem metadata servers
+while still noticing files rewritten during a session.
+"""
+
+import os
+import io
+import time
+import zlib
+import sqlite3
+import hashlib
+import numpy as np
+
+
+class DiskFrameCache:
+
+    def __init__(self, dir_cache, max_bytes, compresslevel = 1, stat_ttl = 60):
+        self.dir_cache     = dir_cache
+        self.max_bytes     = max_bytes
+        self.compresslevel = compresslevel
+        self.stat_ttl      = stat_ttl
+
+        os.makedirs(dir_cache, exist_ok = True)
+
+        # Internal variables...
+        self.source_stat_dict = {}    # path_cxi -> (mtime, size, time of the stat)
+
+        self.db = sqlite3.connect(os.path.join(dir_cache, "index.sqlite"), timeout = 30)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS entry (
+                key          TEXT PRIMARY KEY,
+                nbytes       INTEGER,
+                crc          INTEGER,
+                atime        REAL,
+                source_mtime REAL,
+                source_size  INTEGER
+            )
+        """)
+        self.db.commit()
+
+        return None
+
+
+    def get_source_stat(self, path_cxi):
+        ''' Return (mtime, size) of a source file, statted again once the
+            last stat is older than `stat_ttl`.
+        '''
+        source_stat = self.source_stat_dict.get(path_cxi)
+        if source_stat is None or time.time() - source_stat[2] > self.stat_ttl:
+            stat = os.stat(path_cxi)
+            source_stat = (stat.st_mtime, stat.st_size, time.time())
+            self.source_stat_dict[path_cxi] = source_stat
+
+        return source_stat[:2]
+
+
+    def forget_source(self, path_cxi = None):
+        ''' Stat a source file (all if None) again on its next use.
+        '''
+        if path_cxi is None: self.source_stat_dict.clear()
+        else               : self.source_stat_dict.pop(path_cxi, None)
+
+        return None
+
+
+    def get_key(self, path_cxi, dataset_key, event_idx):
+        return f"{os.path.realpath(path_cxi)}:{dataset_key}:{event_idx}"
+
+
+    def get_path_blob(self, key):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+
+        return os.path.join(self.dir_cache, digest[:2], f"{digest}.npy.z")
+
+
+    def remove(self, key):
+        self.db.execute("DELETE FROM entry WHERE key = ?", (key, ))
+        self.db.commit()
+
+        path_blob = self.get_path_blob(key)
+        if os.path.exists(path_blob): os.remove(path_blob)
+
+        return None
+
+
+    def get(self, path_cxi, dataset_key, event_idx):
+        ''' Return the cached array or None if it's missing, stale or corrupted.
+        '''
+        key = self.get_key(path_cxi, dataset_key, event_idx)
+        row = self.db.execute("SELECT nbytes, crc, source_mtime, source_size FROM entry WHERE key = ?", (key, )).fetchone()
+        if row is None: return None
+
+        nbytes, crc, source_mtime, source_size = row
+
+        # Drop blobs of modified source files...
+        if (source_mtime, source_size) != self.get_source_stat(path_cxi):
+            self.remove(key)
+            return None
+
+        # Verify the integrity...
+        path_blob = self.get_path_blob(key)
+        try:
+            with open(path_blob, 'rb') as fh:
+                blob = fh.read()
+        except OSError:
+            blob = b""
+        if len(blob) != nbytes or zlib.crc32(blob) != crc:
+            print(f"Corrupted cache of {key} is removed.")
+            self.remove(key)
+            return None
+
+        self.db.execute("UPDATE entry SET atime = ? WHERE key = ?", (time.time(), key))
+        self.db.commit()
+
+        return np.load(io.BytesIO(zlib.decompress(blob)), allow_pickle = False)
+
+
+    def put(self, path_cxi, dataset_key, event_idx, arr):
+        key = self.get_key(path_cxi, dataset_key, event_idx)
+
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(arr), allow_pickle = False)
+        blob = zlib.compress(buffer.getvalue(), self.compresslevel)
+
+        # Write atomically so that readers never see a partial blob...
+        path_blob = self.get_path_blob(key)
+        os.makedirs(os.path.dirname(path_blob), exist_ok = True)
+        path_tmp = f"{path_blob}.{os.getpid()}.tmp"
+        with open(path_tmp, 'wb') as fh:
+            fh.write(blob)
+        os.replace(path_tmp, path_blob)
+
+        source_mtime, source_size = self.get_source_stat(path_cxi)
+        self.db.execute("INSERT OR REPLACE INTO entry VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, len(blob), zlib.crc32(blob), time.time(), source_mtime, source_size))
+        self.db.commit()
+
+        self.evict()
+
+        return None
+
+
+    def evict(self):
+        ''' Remove least recently used blobs until the cache fits.
+        '''
+        num_bytes = self.db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM entry").fetchone()[0]
+        if num_bytes <= self.max_bytes: return None
+
+        for key, nbytes in self.db.execute("SELECT key, nbytes FROM entry ORDER BY atime").fetchall():
+            if num_bytes <= self.max_bytes: break
+
+            self.remove(key)
+            num_bytes -= nbytes
+
+        return None
+
+
+    def read(self, fh, path_cxi, dataset_key, event_idx = None):
+        ''' Read `fh[dataset_key][event_idx]` (the whole dataset if
+            `event_idx` is None) through the cache.
+        '''
+        arr = self.get(path_cxi, dataset_key, event_idx)
+        if arr is None:
+            dataset = fh.get(dataset_key)
+            arr     = dataset[()] if event_idx is None else dataset[event_idx]
+            self.put(path_cxi, dataset_key, event_idx, arr)
+
+        return arr
+
+
+    def close(self):
+        self.db.close()
+
+        return None
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Export labeled (image, label) pairs into fixed-size HDF5 shards for training.
+
+Frames are streamed from a data manager (anything that offers `get_img` and
+either `idx_list` or `data_list`) and only a few shards are held in memory at
+a time.  Shards are written by a pool of background threads, like thumbnails
+of the filmstrip, so that a labeler can export without worker processes
+(forked ones would inherit the HDF5 state of its open files, and spawned
+ones would re-run unguarded launch scripts).  Frames of CXI files are read
+by the threads through the file handles of the data manager (h5py
+serializes HDF5 calls), while masking and stacking overlap.
+
+Layout of `dir_shard`:
+
+    index.json            - shapes, dtypes and the list of finished shards
+    shard_00000.h5        - /image (N, ...) and /label (N, ...)
+    shard_00001.h5
+    ...
+
+With a compression filter, datasets are chunked per frame.  Without one
+(`compression = None`), datasets are contiguous and their byte offsets are
+recorded in the index so that shards can be opened with `np.memmap`.
+
+An interrupted export resumes from the shards listed in the index whose
+frames, labels and compression match and whose files exist.  Labels are
+compared by a digest of those edited in the data manager (all labels of a
+data list).
+"""
+
+import os
+import json
+import h5py
+import hashlib
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .data  import CXI_KEY, composite_static
+from .utils import apply_mask, index_to_bitplane
+
+
+def write_shard(path_shard, img_array, label_array, compression = 'gzip', compression_opts = 4):
+    ''' Write one shard atomically and return the byte offsets of its
+        datasets (None if they are chunked).
+    '''
+    path_tmp = f"{path_shard}.tmp"
+    with h5py.File(path_tmp, 'w') as fh:
+        offset_dict = {}
+        for k, arr in (("image", img_array), ("label", label_array)):
+            if compression is None:
+                dataset = fh.create_dataset(k, data = arr)
+            else:
+                dataset = fh.create_dataset(k, data = arr,
+                                            chunks           = (1, ) + arr.shape[1:],
+                                            compression      = compression,
+                                            compression_opts = compression_opts)
+            fh.flush()
+            offset_dict[k] = dataset.id.get_offset()
+    os.replace(path_tmp, path_shard)
+
+    return offset_dict
+
+
+
+
+def read_cxi_shard(frame_list, label_override, static_label_dict, static_scope = 'cxi', label_mode = 'index', num_bitplane = 8):
+    ''' Read (image, label) of frames [(path_cxi, event_idx, fh), ...] of
+        open CXI files like `PeakNetData.get_img`, labels in
+        `label_override` (keyed by position) replacing segmasks.
+    '''
+    img_list   = []
+    label_list = []
+    for i, (path_cxi, event_idx, fh) in enumerate(frame_list):
+        dataset_mask = fh.get(CXI_KEY["mask"])
+        mask = dataset_mask[event_idx] if dataset_mask.ndim == 3 else dataset_mask[()]
+        img  = apply_mask(fh.get(CXI_KEY["data"])[event_idx], 1 - mask, mask_value = 0)
+
+        label = label_override.get(i)
+        if label is None:
+            dataset_segmask = fh.get(CXI_KEY["segmask"])
+            label = dataset_segmask[event_idx][None,]
+            if label_mode == 'bitplane' and dataset_segmask.attrs.get("label_mode", "index") != 'bitplane':
+                label = index_to_bitplane(label, num_bitplane)
+
+        static_key = (path_cxi if static_scope == 'cxi' else None, None)
+        img_list.append(img[None,])
+        label_list.append(composite_static(label, static_label_dict.get(static_key), label_mode))
+
+    return np.stack(img_list), np.stack(label_list)
+
+
+
+
+def export_shard(path_shard, shard_data, compression = 'gzip', compression_opts = 4):
+    ''' Write one shard from arrays, or from frames read in this thread by
+        `read_cxi_shard`.
+
+        Return (byte offsets, shapes and dtypes of "image" and "label").
+    '''
+    kind, data = shard_data
+    img_array, label_array = read_cxi_shard(*data) if kind == "cxi" else data
+    offset_dict = write_shard(path_shard, img_array, label_array, compression, compression_opts)
+
+    meta_dict = { "image" : { "shape" : list(img_array.shape[1:])  , "dtype" : img_array.dtype.str   },
+                  "label" : { "shape" : list(label_array.shape[1:]), "dtype" : label_array.dtype.str }, }
+
+    return offset_dict, meta_dict
+
+
+
+
+class ShardExporter:
+
+    def __init__(self, dir_shard, num_frame_per_shard = 256, num_workers = 4, compression = 'gzip', compression_opts = 4):
+        self.dir_shard           = dir_shard
+        self.num_frame_per_shard = num_frame_per_shard
+        self.num_workers         = num_workers
+        self.compression         = compression
+        self.compression_opts    = compression_opts
+
+        os.makedirs(dir_shard, exist_ok = True)
+
+        # Internal variables...
+        self.path_index = os.path.join(dir_shard, "index.json")
+        self.index      = self.load_index()
+
+        return None
+
+
+    def load_index(self):
+        if os.path.exists(self.path_index):
+            with open(self.path_index, 'r') as fh:
+                index = json.load(fh)
+
+            assert index["num_frame_per_shard"] == self.num_frame_per_shard, \
+                f"Can't resume an export with {index['num_frame_per_shard']} frames per shard using {self.num_frame_per_shard}!!!"
+
+            return index
+
+        index = { "num_frame_per_shard" : self.num_frame_per_shard,
+                  "shard"               : {}, }
+
+        return index
+
+
+    def save_index(self):
+        path_tmp = f"{self.path_index}.tmp"
+        with open(path_tmp, 'w') as fh:
+            json.dump(self.index, fh, indent = 2)
+        os.replace(path_tmp, self.path_index)
+
+        return None
+
+
+    def get_source(self, data_manager, idx):
+        ''' Return where a frame comes from, (path_cxi, event_idx) for CXI
+            files or the index in the data list otherwise.
+        '''
+        if hasattr(data_manager, 'idx_list'):
+            path_cxi, event_idx, _ = data_manager.idx_list[idx]
+            return [path_cxi, event_idx]
+
+        return idx
+
+
+    def get_label_digest(self, data_manager, idx_list):
+        ''' Return a digest of labels that may differ from a previous export
+            of the same frames, i.e. edited and static labels of CXI files or
+            all labels of a data list.
+        '''
+        dm     = data_manager
+        digest = hashlib.sha1()
+
+        def update(k, label):
+            label = np.ascontiguousarray(label)
+            digest.update(repr((k, label.shape, label.dtype.str)).encode())
+            digest.update(label.tobytes())
+
+        if not hasattr(dm, 'idx_list'):
+            for idx in idx_list: update(idx, dm.data_list[idx][1])
+
+            return digest.hexdigest()
+
+        digest.update(dm.label_mode.encode())
+        for i, idx in enumerate(idx_list):
+            if idx in dm.label_dict: update(i, dm.label_dict[idx])
+
+        static_key_set = { dm.get_static_key(idx) for idx in idx_list }
+        for k in sorted(static_key_set, key = repr):
+            if k in dm.static_label_dict: update(k, dm.static_label_dict[k])
+
+        return digest.hexdigest()
+
+
+    def is_done(self, shard_id, source_list, label_digest):
+        ''' Return True if a shard of the same frames, labels and compression
+            is finished.
+        '''
+        shard = self.index["shard"].get(str(shard_id))
+        if shard is None: return False
+
+        return shard["source"]               == source_list           and \
+               shard.get("label_digest")     == label_digest          and \
+               shard.get("compression")      == self.compression      and \
+               shard.get("compression_opts") == self.compression_opts and \
+               os.path.exists(os.path.join(self.dir_shard, shard["path"]))
+
+
+    def read_shard(self, data_manager, idx_list):
+        img_list   = []
+        label_list = []
+        for idx in idx_list:
+            img, label = data_manager.get_img(idx)
+            img_list.append(np.asarray(img))
+            label_list.append(np.asarray(label))
+
+        return np.stack(img_list), np.stack(label_list)
+
+
+    def get_shard_data(self, data_manager, idx_list):
+        ''' Return what a thread needs to write a shard, frames to read in
+            the thread for CXI files and arrays otherwise.
+        '''
+        if not hasattr(data_manager, 'idx_list'): return "array", self.read_shard(data_manager, idx_list)
+
+        dm = data_manager
+        frame_list        = [ dm.idx_list[idx] for idx in idx_list ]
+        label_override    = { i : dm.label_dict[idx] for i, idx in enumerate(idx_list) if idx in dm.label_dict }
+        static_key_set    = { dm.get_static_key(idx) for idx in idx_list }
+        static_label_dict = { k : v for k, v in dm.static_label_dict.items() if k in static_key_set }
+
+        return "cxi", (frame_list, label_override, static_label_dict, dm.static_scope, dm.label_mode, dm.num_bitplane)
+
+
+    def export(self, data_manager, idx_list = None):
+        if idx_list is None:
+            num_img  = len(data_manager.idx_list) if hasattr(data_manager, 'idx_list') else len(data_manager.data_list)
+            idx_list = list(range(num_img))
+
+        n = self.num_frame_per_shard
+        shard_idx_list = [ idx_list[i:i + n] for i in range(0, len(idx_list), n) ]
+
+        # Drop shards of a previous, larger export...
+        shard_stale_list = [ k for k in self.index["shard"] if int(k) >= len(shard_idx_list) ]
+        for k in shard_stale_list:
+            path_shard = os.path.join(self.dir_shard, self.index["shard"].pop(k)["path"])
+            if os.path.exists(path_shard): os.remove(path_shard)
+        if shard_stale_list: print(f"{len(shard_stale_list)} stale shards are removed.")
+
+        # Skip shards finished in a previous run with the same frames and
+        # labels, and forget the others until they are written again...
+        label_digest_list = [ self.get_label_digest(data_manager, idx_shard) for idx_shard in shard_idx_list ]
+        shard_todo_list   = []
+        for shard_id, idx_shard in enumerate(shard_idx_list):
+            source_list = [ self.get_source(data_manager, idx) for idx in idx_shard ]
+            if self.is_done(shard_id, source_list, label_digest_list[shard_id]): continue
+
+            self.index["shard"].pop(str(shard_id), None)
+            shard_todo_list.append(shard_id)
+        if len(shard_todo_list) < len(shard_idx_list):
+            print(f"Resuming export, {len(shard_idx_list) - len(shard_todo_list)}/{len(shard_idx_list)} shards are done.")
+
+        with ThreadPoolExecutor(max_workers = self.num_workers) as executor:
+            future_dict = {}
+            for shard_id in shard_todo_list:
+                # Bound the number of shards held in memory...
+                while len(future_dict) > self.num_workers:
+                    self.collect(future_dict, is_blocking = True)
+
+                idx_shard  = shard_idx_list[shard_id]
+                shard_data = self.get_shard_data(data_manager, idx_shard)
+
+                path_shard = os.path.join(self.dir_shard, f"shard_{shard_id:05d}.h5")
+                future = executor.submit(export_shard, path_shard, shard_data, self.compression, self.compression_opts)
+                future_dict[future] = { "path"             : os.path.basename(path_shard),
+                                        "shard_id"         : shard_id,
+                                        "num_frame"        : len(idx_shard),
+                                        "compression"      : self.compression,
+                                        "compression_opts" : self.compression_opts,
+                                        "label_digest"     : label_digest_list[shard_id],
+                                        "source"           : [ self.get_source(data_manager, idx) for idx in idx_shard ], }
+
+                self.collect(future_dict, is_blocking = False)
+
+            while future_dict: self.collect(future_dict, is_blocking = True)
+
+        self.index["num_frame"] = sum(shard["num_frame"] for shard in self.index["shard"].values())
+        self.save_index()
+
+        print(f"{self.index['num_frame']} frames are exported to {self.dir_shard}.")
+
+        return None
+
+
+    def collect(self, future_dict, is_blocking = False):
+        ''' Record finished shards in the index.
+        '''
+        future_done_list = [ future for future in future_dict if future.done() ]
+        if is_blocking and not future_done_list:
+            future = next(iter(future_dict))
+            future.result()
+            future_done_list = [future]
+
+        for future in future_done_list:
+            shard = future_dict.pop(future)
+            shard["offset"], meta_dict = future.result()
+
+            # Record shapes and dtypes once...
+            if "image" not in self.index: self.index.update(meta_dict)
+
+            self.index["shard"][str(shard.pop("shard_id"))] = shard
+            self.save_index()
+
+        return None
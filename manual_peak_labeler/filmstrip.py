@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Thumbnails of frames for the filmstrip.
+
+A thumbnail is a (image, label) pair binned by `bin_size`.  The image is the
+mean of good pixels in each block (bad pixels in the CXI mask don't count)
+and the label keeps any layer present in a block.  Thumbnails are rendered
+by a pool of background threads through the file handles of the labeler
+(h5py serializes reads, binning runs without the GIL), held in an LRU cache
+in memory and persisted in a `DiskFrameCache`, so that reopening a run
+doesn't render them again.
+"""
+
+import numpy as np
+
+from collections        import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .data      import CXI_KEY
+from .utils     import downsample, apply_mask, index_to_bitplane, hex_to_rgb, has_layer
+from .diskcache import DiskFrameCache
+
+
+def block_reduce_label(label, bin_size, label_mode = 'index'):
+    ''' Bin a (H, W) label, keeping the highest encode (index-coded) or all
+        layers (bit-packed) of each block.
+    '''
+    label = np.asarray(label)
+    H, W  = label.shape
+
+    # Pad partial blocks at the edges with the background...
+    H_pad = -(-H // bin_size) * bin_size
+    W_pad = -(-W // bin_size) * bin_size
+    if (H_pad, W_pad) != (H, W): label = np.pad(label, ((0, H_pad - H), (0, W_pad - W)))
+
+    block = label.reshape(H_pad // bin_size, bin_size, W_pad // bin_size, bin_size)
+    if label_mode == 'bitplane': return np.bitwise_or.reduce(np.bitwise_or.reduce(block, axis = 3), axis = 1)
+
+    return block.max(axis = (1, 3))
+
+
+
+
+def render_thumbnail(fh, event_idx, bin_size, label_mode = 'index', num_bitplane = 8):
+    ''' Return (image, label) thumbnails of one event of an open CXI file.
+    '''
+    img          = fh.get(CXI_KEY["data"])[event_idx]
+    dataset_mask = fh.get(CXI_KEY["mask"])
+    mask         = dataset_mask[event_idx] if dataset_mask.ndim == 3 else dataset_mask[()]
+    img_thumb    = downsample(apply_mask(img, 1 - mask, mask_value = 0), bin_size, bin_size, mask = 1 - mask)
+
+    dataset_segmask = fh.get(CXI_KEY["segmask"])
+    label           = dataset_segmask[event_idx]
+    if label_mode == 'bitplane' and dataset_segmask.attrs.get("label_mode", "index") != 'bitplane':
+        label = index_to_bitplane(label, num_bitplane)
+
+    return img_thumb, block_reduce_label(label, bin_size, label_mode)
+
+
+
+
+def colorize_thumbnail(img_thumb, label_thumb, layer_manager, label_mode = 'index', alpha = 0.5):
+    ''' Return a (H, W, 3) uint8 thumbnail with labels blended over the
+        image, the top layer last.
+    '''
+    vmin = np.mean(img_thumb)
+    vmax = vmin + 2 * np.std(img_thumb)
+    gray = np.clip((img_thumb - vmin) / max(vmax - vmin, np.finfo(np.float32).eps), 0, 1) * 255
+
+    rgb = np.repeat(gray[..., None], 3, axis = -1)
+    for encode in layer_manager['layer_order']:
+        color_hex = layer_manager['layer_metadata'][encode]['color']
+        if encode == 0 or color_hex == '#FFFFFF': continue
+
+        is_on = has_layer(label_thumb, encode, label_mode)
+        rgb[is_on] = (1 - alpha) * rgb[is_on] + alpha * np.array(hex_to_rgb(color_hex))
+
+    return rgb.astype(np.uint8)
+
+
+
+
+class ThumbnailPool:
+
+    def __init__(self, bin_size = 8, label_mode = 'index', num_bitplane = 8,
+                 num_workers = 2,
+                 num_cache   = 512,
+                 dir_cache   = None,
+                 cache_bytes = 256 * 1024**2):
+        self.bin_size     = bin_size
+        self.label_mode   = label_mode
+        self.num_bitplane = num_bitplane
+        self.num_cache    = num_cache
+
+        self.executor   = ThreadPoolExecutor(max_workers = num_workers)
+        self.disk_cache = DiskFrameCache(dir_cache, cache_bytes) if dir_cache is not None else None
+
+        # Internal variables...
+        self.future_dict = {}               # idx -> (future, path_cxi, event_idx)
+        self.cache       = OrderedDict()    # idx -> (image, label)
+
+        return None
+
+
+    def get_dataset_key(self, k):
+        return f"thumbnail/{self.bin_size}/{self.label_mode}/{k}"
+
+
+    def has(self, idx):
+        return idx in self.cache or idx in self.future_dict
+
+
+    def add(self, idx, thumbnail):
+        self.cache[idx] = thumbnail
+        self.cache.move_to_end(idx)
+        while len(self.cache) > self.num_cache: self.cache.popitem(last = False)
+
+        return None
+
+
+    def submit(self, idx, path_cxi, event_idx, fh):
+        if self.has(idx): return None
+
+        # Reuse thumbnails of a previous session...
+        if self.disk_cache is not None:
+            img_thumb   = self.disk_cache.get(path_cxi, self.get_dataset_key("image"), event_idx)
+            label_thumb = self.disk_cache.get(path_cxi, self.get_dataset_key("label"), event_idx)
+            if img_thumb is not None and label_thumb is not None:
+                self.add(idx, (img_thumb, label_thumb))
+                return None
+
+        future = self.executor.submit(render_thumbnail, fh, event_idx, self.bin_size, self.label_mode, self.num_bitplane)
+        self.future_dict[idx] = (future, path_cxi, event_idx)
+
+        return None
+
+
+    def collect(self):
+        ''' Move finished thumbnails into the cache.
+
+            Return indices of new thumbnails.
+        '''
+        idx_done_list = []
+        for idx, (future, path_cxi, event_idx) in list(self.future_dict.items()):
+            if not future.done(): continue
+
+            del self.future_dict[idx]
+            try:
+                img_thumb, label_thumb = future.result()
+            except Exception as e:
+                print(f"Thumbnail of frame {idx} failed: {e!r}")
+                continue
+
+            self.add(idx, (img_thumb, label_thumb))
+            idx_done_list.append(idx)
+
+            if self.disk_cache is not None:
+                self.disk_cache.put(path_cxi, self.get_dataset_key("image"), event_idx, img_thumb)
+                self.disk_cache.put(path_cxi, self.get_dataset_key("label"), event_idx, label_thumb)
+
+        return idx_done_list
+
+
+    def get(self, idx):
+        thumbnail = self.cache.get(idx)
+        if thumbnail is not None: self.cache.move_to_end(idx)
+
+        return thumbnail
+
+
+    def cancel(self, idx_keep_set):
+        ''' Cancel queued thumbnails of frames not in `idx_keep_set`.
+        '''
+        for idx in list(self.future_dict.keys()):
+            if idx not in idx_keep_set and self.future_dict[idx][0].cancel(): del self.future_dict[idx]
+
+        return None
+
+
+    def close(self):
+        for future, _, _ in self.future_dict.values(): future.cancel()
+        self.executor.shutdown(wait = True)
+        if self.disk_cache is not None: self.disk_cache.close()
+
+        return None
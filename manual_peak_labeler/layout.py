@@ -5,7 +5,7 @@ import os
 import sys
 
 from pyqtgraph          import LayoutWidget, ImageView, PlotItem, ImageItem, ViewBox
-from pyqtgraph.Qt       import QtWidgets
+from pyqtgraph.Qt       import QtWidgets, QtCore
 from pyqtgraph.dockarea import DockArea, Dock
 
 class MainLayout(QtWidgets.QWidget):
@@ -77,6 +77,32 @@ class MainLayout(QtWidgets.QWidget):
         return btn_prev, btn_next
 
 
+    def config_filmstrip(self, size_icon = 96):
+        ''' Dock of thumbnails of frames below the buttons.
+        '''
+        dock = Dock("Filmstrip", size = (1, size_icon + 40))
+        self.area.addDock(dock, "bottom", self.dock_dict["ImgQryButton"])
+        dock.hideTitleBar()
+        self.dock_dict["Filmstrip"] = dock
+
+        # Items of the same size let Qt lay out thousands of frames lazily...
+        wdgt = QtWidgets.QListWidget()
+        wdgt.setViewMode(QtWidgets.QListView.IconMode)
+        wdgt.setFlow(QtWidgets.QListView.LeftToRight)
+        wdgt.setWrapping(False)
+        wdgt.setMovement(QtWidgets.QListView.Static)
+        wdgt.setUniformItemSizes(True)
+        wdgt.setIconSize(QtCore.QSize(size_icon, size_icon))
+        wdgt.setGridSize(QtCore.QSize(size_icon + 8, size_icon + 24))
+        wdgt.setHorizontalScrollMode(QtWidgets.QAbstractItemView.ScrollPerPixel)
+        wdgt.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        wdgt.setFixedHeight(size_icon + 48)
+
+        dock.addWidget(wdgt)
+
+        return wdgt
+
+
     def config_image(self):
         ''' Display image.
         '''
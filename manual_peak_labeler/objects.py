@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Labeled objects (connected components of each layer) of a frame.
+
+`ObjectIndex` keeps one object map per layer, where each pixel holds the id
+of the object it belongs to, and a record per object
+
+    { "id" : ..., "encode" : ..., "bbox" : (x_b, x_e, y_b, y_e), "centroid" : (x, y), "num_pixel" : ... }
+
+Edits are picked up by `update`, which only relabels the neighborhood of
+changed pixels.  A click hits an object in O(1) through the object maps, and
+near misses fall back to the nearest centroid in a KD-tree.
+"""
+
+import numpy as np
+
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from .utils import has_layer
+
+
+class ObjectIndex:
+
+    def __init__(self, label, layer_list, label_mode = 'index'):
+        ''' `label` is (H, W) and `layer_list` holds encodes of layers to
+            index (0 is skipped).
+        '''
+        self.layer_list = [ encode for encode in layer_list if encode != 0 ]
+        self.label_mode = label_mode
+
+        # Internal variables...
+        self.label           = np.array(label)
+        self.object_dict     = {}
+        self.object_map_dict = { encode : np.zeros(label.shape, dtype = np.int32) for encode in self.layer_list }
+        self.next_id         = 1
+        self.tree            = None
+        self.tree_id_list    = []
+
+        # 8-connectivity keeps diagonal pixels of a peak together...
+        self.structure = np.ones((3, 3), dtype = bool)
+
+        size_x, size_y = label.shape
+        for encode in self.layer_list: self.relabel(encode, (0, size_x, 0, size_y), [])
+
+        return None
+
+
+    def relabel(self, encode, region, id_list):
+        ''' Replace objects in `id_list` with components of layer `encode`
+            found in `region`, leaving other objects in the region alone.
+        '''
+        x_b, x_e, y_b, y_e = region
+        object_map = self.object_map_dict[encode][x_b:x_e, y_b:y_e]
+
+        is_old  = np.isin(object_map, id_list)
+        is_free = (object_map == 0) | is_old
+        is_on   = has_layer(self.label[x_b:x_e, y_b:y_e], encode, self.label_mode) & is_free
+
+        for object_id in id_list: self.object_dict.pop(object_id, None)
+        object_map[is_old] = 0
+
+        component, num_component = ndimage.label(is_on, structure = self.structure)
+        if num_component == 0: return None
+
+        # Assign new ids...
+        id_lookup     = np.zeros(num_component + 1, dtype = np.int32)
+        id_lookup[1:] = np.arange(self.next_id, self.next_id + num_component)
+        self.next_id += num_component
+        object_map[component > 0] = id_lookup[component[component > 0]]
+
+        # Pixel count and centroid of all components in one pass...
+        component_flat = component.ravel()
+        grid_x, grid_y = np.indices(component.shape)
+        num_pixel  = np.bincount(component_flat, minlength = num_component + 1)
+        centroid_x = np.bincount(component_flat, weights = grid_x.ravel(), minlength = num_component + 1)
+        centroid_y = np.bincount(component_flat, weights = grid_y.ravel(), minlength = num_component + 1)
+
+        for i, (slice_x, slice_y) in enumerate(ndimage.find_objects(component), start = 1):
+            object_id = int(id_lookup[i])
+            self.object_dict[object_id] = {
+                "id"        : object_id,
+                "encode"    : encode,
+                "bbox"      : (x_b + slice_x.start, x_b + slice_x.stop, y_b + slice_y.start, y_b + slice_y.stop),
+                "centroid"  : (x_b + centroid_x[i] / num_pixel[i], y_b + centroid_y[i] / num_pixel[i]),
+                "num_pixel" : int(num_pixel[i]),
+            }
+
+        self.tree = None
+
+        return None
+
+
+    def update(self, label):
+        ''' Sync with an edited (H, W) label.
+
+            Return the number of layers that are relabeled.
+        '''
+        label = np.asarray(label)
+
+        idx_x, idx_y = np.nonzero(label != self.label)
+        if len(idx_x) == 0: return 0
+
+        size_x, size_y = label.shape
+        x_b, x_e = max(idx_x.min() - 1, 0), min(idx_x.max() + 2, size_x)
+        y_b, y_e = max(idx_y.min() - 1, 0), min(idx_y.max() + 2, size_y)
+
+        label_old = self.label[x_b:x_e, y_b:y_e].copy()
+        self.label[x_b:x_e, y_b:y_e] = label[x_b:x_e, y_b:y_e]
+
+        num_relabeled = 0
+        for encode in self.layer_list:
+            is_changed = has_layer(label_old, encode, self.label_mode) != has_layer(label[x_b:x_e, y_b:y_e], encode, self.label_mode)
+            if not np.any(is_changed): continue
+
+            # Grow the region to cover objects touching the changed pixels...
+            id_list = np.unique(self.object_map_dict[encode][x_b:x_e, y_b:y_e])
+            id_list = [ int(object_id) for object_id in id_list if object_id != 0 ]
+            region  = [x_b, x_e, y_b, y_e]
+            for object_id in id_list:
+                bbox = self.object_dict[object_id]["bbox"]
+                region = [ min(region[0], bbox[0]), max(region[1], bbox[1]),
+                           min(region[2], bbox[2]), max(region[3], bbox[3]) ]
+
+            self.relabel(encode, region, id_list)
+            num_relabeled += 1
+
+        return num_relabeled
+
+
+    def hit_test(self, x, y, max_distance = 3.0):
+        ''' Return the id of the object at (x, y), the topmost layer first,
+            or of the nearest object within `max_distance` (None if none).
+        '''
+        size_x, size_y = self.label.shape
+        if 0 <= x < size_x and 0 <= y < size_y:
+            for encode in reversed(self.layer_list):
+                object_id = int(self.object_map_dict[encode][x, y])
+                if object_id != 0: return object_id
+
+        if not self.object_dict: return None
+
+        # Build the KD-tree of centroids lazily after edits...
+        if self.tree is None:
+            self.tree_id_list = list(self.object_dict.keys())
+            self.tree = cKDTree([ self.object_dict[object_id]["centroid"] for object_id in self.tree_id_list ])
+
+        distance, i = self.tree.query((x, y), distance_upper_bound = max_distance)
+        if not np.isfinite(distance): return None
+
+        return self.tree_id_list[i]
+
+
+    def get_mask(self, object_id):
+        ''' Return (bbox, mask) of the pixels of an object within its bbox.
+        '''
+        obj = self.object_dict[object_id]
+        x_b, x_e, y_b, y_e = obj["bbox"]
+
+        return obj["bbox"], self.object_map_dict[obj["encode"]][x_b:x_e, y_b:y_e] == object_id
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Rebuild CXI peak tables from (edited) segmasks.
+
+Each connected component of the peak layer is a peak.  Its intensity is
+the sum of the masked image over its pixels and its position is the
+intensity-weighted centroid (the geometric one if the sum isn't positive).
+Tables follow the CXI layout in `data.CXI_KEY`, with row positions in
+`peakYPosRaw` and column positions in `peakXPosRaw`.
+
+Edits kept in a saved state (File > Save State) or in an edit log (e.g. one
+merged by `session merge`) override segmasks on disk.
+Files are processed in parallel, one worker per file, and tables are
+written chunk by chunk either in place or into a sidecar file per CXI file
+
+    python -m manual_peak_labeler.peaks --path_yaml data.yaml --path_state labels.pickle --dir_output peaks/
+
+In-place writes need the labeler to be closed, as it holds CXI files open;
+sidecar writes don't.
+"""
+
+import os
+import h5py
+import yaml
+import pickle
+import argparse
+import numpy as np
+
+from scipy import ndimage
+from concurrent.futures import ProcessPoolExecutor
+
+from .data     import CXI_KEY, open_read_only
+from .utils    import has_layer, apply_mask
+from .autosave import read_recovery
+
+
+def find_peaks(img, label, encode = 1, label_mode = 'index'):
+    ''' Return (y, x, intensity) arrays of peaks in a (H, W) label.
+    '''
+    component, num_peak = ndimage.label(has_layer(label, encode, label_mode), structure = np.ones((3, 3), dtype = bool))
+    if num_peak == 0: return np.zeros(0), np.zeros(0), np.zeros(0)
+
+    component_flat = component.ravel()
+    weight         = np.asarray(img, dtype = np.float64).ravel()
+    grid_y, grid_x = np.indices(component.shape)
+    grid_y, grid_x = grid_y.ravel(), grid_x.ravel()
+
+    n = num_peak + 1
+    num_pixel = np.bincount(component_flat, minlength = n)[1:]
+    intensity = np.bincount(component_flat, weights = weight, minlength = n)[1:]
+    sum_y     = np.bincount(component_flat, weights = weight * grid_y, minlength = n)[1:]
+    sum_x     = np.bincount(component_flat, weights = weight * grid_x, minlength = n)[1:]
+    mean_y    = np.bincount(component_flat, weights = grid_y, minlength = n)[1:] / num_pixel
+    mean_x    = np.bincount(component_flat, weights = grid_x, minlength = n)[1:] / num_pixel
+
+    # Fall back to the geometric centroid of dim peaks...
+    is_bright = intensity > 0
+    y = np.where(is_bright, sum_y / np.where(is_bright, intensity, 1), mean_y)
+    x = np.where(is_bright, sum_x / np.where(is_bright, intensity, 1), mean_x)
+
+    return y, x, intensity
+
+
+
+
+def get_path_sidecar(path_cxi, dir_output):
+    basename = os.path.splitext(os.path.basename(path_cxi))[0]
+
+    return os.path.join(dir_output, f"{basename}.peaks.cxi")
+
+
+
+
+def prepare_tables(fh_out, num_event, max_peaks, chunk_size):
+    ''' Return peak table datasets in `fh_out`, created if missing.
+    '''
+    # Match the width of existing tables...
+    dataset_x = fh_out.get(CXI_KEY["peak_x"])
+    if dataset_x is not None: max_peaks = dataset_x.shape[1]
+
+    dataset_dict = {}
+    for k in ("num_peaks", "peak_y", "peak_x", "peak_intensity"):
+        dataset = fh_out.get(CXI_KEY[k])
+        if dataset is None:
+            shape   = (num_event, ) if k == "num_peaks" else (num_event, max_peaks)
+            dtype   = 'int32' if k == "num_peaks" else 'float32'
+            chunks  = (min(chunk_size, num_event), ) + shape[1:]
+            dataset = fh_out.create_dataset(CXI_KEY[k], shape = shape, dtype = dtype, chunks = chunks, fillvalue = 0)
+        dataset_dict[k] = dataset
+
+    return dataset_dict
+
+
+
+
+def write_peak_tables(path_cxi, label_state = None,
+                      encode     = 1,
+                      label_mode = 'index',
+                      dir_output = None,
+                      max_peaks  = 2048,
+                      chunk_size = 64):
+    ''' Rebuild peak tables of one CXI file, in place if `dir_output` is
+        None, otherwise into its sidecar file.  `label_state` maps
+        (path_cxi, event_idx) to edited (1, H, W) labels.
+
+        Return (number of events, number of peaks).
+    '''
+    label_state = label_state or {}
+
+    # A sidecar leaves the source untouched, read it without the file lock so
+    # that a running labeler can keep it open...
+    fh     = open_read_only(path_cxi) if dir_output is not None else h5py.File(path_cxi, 'a')
+    fh_out = fh if dir_output is None else h5py.File(get_path_sidecar(path_cxi, dir_output), 'a')
+    try:
+        dataset_data    = fh.get(CXI_KEY["data"])
+        dataset_mask    = fh.get(CXI_KEY["mask"])
+        dataset_segmask = fh.get(CXI_KEY["segmask"])
+        num_event       = min(len(dataset_data), len(dataset_segmask))
+        mask_static     = dataset_mask[()] if dataset_mask.ndim == 2 else None
+        segmask_mode    = dataset_segmask.attrs.get("label_mode", "index")
+
+        dataset_dict = prepare_tables(fh_out, num_event, max_peaks, chunk_size)
+        max_peaks    = dataset_dict["peak_x"].shape[1]
+        if fh_out is not fh: fh_out.attrs["source"] = os.path.abspath(path_cxi)
+
+        num_peak_total = 0
+        for idx_start in range(0, num_event, chunk_size):
+            idx_end = min(idx_start + chunk_size, num_event)
+            img_batch     = dataset_data[idx_start:idx_end]
+            mask_batch    = mask_static if mask_static is not None else dataset_mask[idx_start:idx_end]
+            img_batch     = apply_mask(img_batch, 1 - mask_batch, mask_value = 0)
+            segmask_batch = dataset_segmask[idx_start:idx_end]
+
+            num_peak_chunk = np.zeros(idx_end - idx_start, dtype = 'int32')
+            table_chunk    = np.zeros((3, idx_end - idx_start, max_peaks), dtype = 'float32')
+            for i, event_idx in enumerate(range(idx_start, idx_end)):
+                # Edited labels win over the segmask on disk...
+                label = label_state.get((path_cxi, event_idx))
+                if label is None:
+                    label, mode = segmask_batch[i], segmask_mode
+                else:
+                    label, mode = label[0], label_mode
+
+                y, x, intensity = find_peaks(img_batch[i], label, encode, mode)
+                if len(y) > max_peaks:
+                    print(f"{path_cxi}:{event_idx} has {len(y)} peaks, only the {max_peaks} brightest are kept.")
+                    order = np.argsort(intensity)[::-1][:max_peaks]
+                    y, x, intensity = y[order], x[order], intensity[order]
+
+                num_peak_chunk[i] = len(y)
+                table_chunk[:, i, :len(y)] = y, x, intensity
+
+            dataset_dict["num_peaks"     ][idx_start:idx_end] = num_peak_chunk
+            dataset_dict["peak_y"        ][idx_start:idx_end] = table_chunk[0]
+            dataset_dict["peak_x"        ][idx_start:idx_end] = table_chunk[1]
+            dataset_dict["peak_intensity"][idx_start:idx_end] = table_chunk[2]
+            num_peak_total += int(num_peak_chunk.sum())
+
+    finally:
+        if fh_out is not fh: fh_out.close()
+        fh.close()
+
+    return num_event, num_peak_total
+
+
+
+
+def write_all_peak_tables(path_cxi_list, label_state = None, num_workers = 4, **kwargs):
+    ''' Rebuild peak tables of all files in parallel, one file per worker.
+    '''
+    label_state = label_state or {}
+    if kwargs.get("dir_output") is not None: os.makedirs(kwargs["dir_output"], exist_ok = True)
+
+    with ProcessPoolExecutor(max_workers = num_workers) as executor:
+        future_dict = {}
+        for path_cxi in path_cxi_list:
+            # Only send edits of this file to its worker...
+            label_state_file = { k : v for k, v in label_state.items() if k[0] == path_cxi and k[1] is not None }
+            future = executor.submit(write_peak_tables, path_cxi, label_state_file, **kwargs)
+            future_dict[future] = path_cxi
+
+        for future, path_cxi in future_dict.items():
+            num_event, num_peak = future.result()
+            print(f"{path_cxi}: {num_peak} peaks in {num_event} events are written.")
+
+    return None
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Rebuild CXI peak tables from segmasks and saved edits.")
+    parser.add_argument("--path_yaml"  , required = True, help = "YAML listing CXI files.")
+    parser.add_argument("--path_state" , default = None, help = "Saved labeler state with edited labels.")
+    parser.add_argument("--path_edits" , default = None, help = "Edit log with edited labels, e.g. merged.edits.")
+    parser.add_argument("--dir_output" , default = None, help = "Directory of sidecar files, tables are written in place if not given.")
+    parser.add_argument("--encode"     , type = int, default = 1, help = "Layer of peaks.")
+    parser.add_argument("--label_mode" , default = 'index', choices = ['index', 'bitplane'], help = "Label mode of the saved state.")
+    parser.add_argument("--max_peaks"  , type = int, default = 2048, help = "Width of new peak tables.")
+    parser.add_argument("--chunk_size" , type = int, default = 64, help = "Events per write.")
+    parser.add_argument("--num_workers", type = int, default = 4, help = "Number of worker processes.")
+    args = parser.parse_args()
+
+    with open(args.path_yaml, 'r') as fh:
+        path_cxi_list = yaml.safe_load(fh)['cxi']
+
+    label_state = {}
+    if args.path_state is not None:
+        with open(args.path_state, 'rb') as fh:
+            obj_saved = pickle.load(fh)
+        if len(obj_saved) > 4: label_state = obj_saved[4]
+    if args.path_edits is not None: label_state.update(read_recovery(args.path_edits))
+
+    write_all_peak_tables(path_cxi_list, label_state,
+                          num_workers = args.num_workers,
+                          encode      = args.encode,
+                          label_mode  = args.label_mode,
+                          dir_output  = args.dir_output,
+                          max_peaks   = args.max_peaks,
+                          chunk_size  = args.chunk_size)
+
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Run-wide per-pixel statistics for finding hot and bad pixels.
+
+Masked frames (the same ones `data.PeakNetData.get_img` serves) are reduced
+into per-pixel count, mean, variance, max and the number of frames above a
+threshold.  Events are split into chunks that worker processes reduce
+independently; partial results are merged with the parallel variance
+formula (Chan et al.), so memory stays at a few (H, W) arrays per worker
+regardless of the run length.
+
+Run it on the YAML used by the labeler
+
+    python -m manual_peak_labeler.pixelstats --path_yaml data.yaml --threshold 500 --path_output stats.npz
+
+and import the proposed mask into a static layer from the File menu.
+"""
+
+import yaml
+import argparse
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from .data  import CXI_KEY, open_read_only
+from .utils import apply_mask
+
+
+class PixelStats:
+
+    def __init__(self, shape, threshold):
+        self.shape     = tuple(shape)
+        self.threshold = threshold
+
+        self.count     = 0
+        self.mean      = np.zeros(shape, dtype = np.float64)
+        self.m2        = np.zeros(shape, dtype = np.float64)
+        self.max       = np.full (shape, -np.inf, dtype = np.float64)
+        self.num_above = np.zeros(shape, dtype = np.int64)
+
+        return None
+
+
+    def merge_moments(self, count, mean, m2):
+        ''' Merge moments of another set of frames into this one.
+        '''
+        if count == 0: return None
+
+        count_total = self.count + count
+        delta       = mean - self.mean
+        self.mean  += delta * (count / count_total)
+        self.m2    += m2 + delta**2 * (self.count * count / count_total)
+        self.count  = count_total
+
+        return None
+
+
+    def update(self, img_batch):
+        ''' Add a batch of frames of shape (B, H, W).
+        '''
+        img_batch = np.asarray(img_batch, dtype = np.float64)
+
+        mean = img_batch.mean(axis = 0)
+        m2   = ((img_batch - mean)**2).sum(axis = 0)
+        self.merge_moments(len(img_batch), mean, m2)
+
+        np.maximum(self.max, img_batch.max(axis = 0), out = self.max)
+        self.num_above += (img_batch > self.threshold).sum(axis = 0)
+
+        return None
+
+
+    def merge(self, other):
+        self.merge_moments(other.count, other.mean, other.m2)
+
+        np.maximum(self.max, other.max, out = self.max)
+        self.num_above += other.num_above
+
+        return self
+
+
+    def get_variance(self):
+        return self.m2 / max(self.count - 1, 1)
+
+
+    def get_frac_above(self):
+        return self.num_above / max(self.count, 1)
+
+
+    def propose_mask(self, num_mad = 10.0, frac_hot = 0.5):
+        ''' Return a boolean mask of bad pixels, which are
+
+            - dead       : never above zero,
+            - hot        : above the threshold in more than `frac_hot` of frames,
+            - outlier    : mean or variance beyond `num_mad` median absolute
+                           deviations from the median over the detector.
+        '''
+        is_dead = self.max <= 0
+        is_hot  = self.get_frac_above() > frac_hot
+
+        is_outlier = np.zeros(self.shape, dtype = bool)
+        for stat in (self.mean, self.get_variance()):
+            median = np.median(stat[~is_dead]) if np.any(~is_dead) else 0.0
+            mad    = np.median(np.abs(stat[~is_dead] - median)) if np.any(~is_dead) else 0.0
+            is_outlier |= np.abs(stat - median) > num_mad * max(mad, np.finfo(np.float64).eps)
+
+        return is_dead | is_hot | is_outlier
+
+
+    def save(self, path_stats, mask = None):
+        np.savez(path_stats, count     = self.count,
+                             threshold = self.threshold,
+                             mean      = self.mean,
+                             variance  = self.get_variance(),
+                             max       = self.max,
+                             frac_hot  = self.get_frac_above(),
+                             mask      = self.propose_mask() if mask is None else mask)
+
+        return None
+
+
+
+
+def reduce_chunk(path_cxi, event_idx_list, threshold, batch_size = 16):
+    ''' Reduce masked frames of `event_idx_list` in a CXI file.
+    '''
+    # Read-only access to files the labeler may hold open for writing...
+    with open_read_only(path_cxi) as fh:
+        dataset_data = fh.get(CXI_KEY["data"])
+        dataset_mask = fh.get(CXI_KEY["mask"])
+        mask_static  = dataset_mask[()] if dataset_mask.ndim == 2 else None
+
+        stats = PixelStats(dataset_data.shape[-2:], threshold)
+        for i in range(0, len(event_idx_list), batch_size):
+            # h5py wants increasing indices for fancy reads...
+            event_idx_batch = sorted(event_idx_list[i:i + batch_size])
+            img_batch  = dataset_data[event_idx_batch]
+            mask_batch = mask_static if mask_static is not None else dataset_mask[event_idx_batch]
+            stats.update(apply_mask(img_batch, 1 - mask_batch, mask_value = 0))
+
+    return stats
+
+
+
+
+def list_event(path_yaml):
+    ''' Return {path_cxi : event_idx_list} of events in the labeler YAML.
+    '''
+    with open(path_yaml, 'r') as fh:
+        config = yaml.safe_load(fh)
+    event_dict = config.get('event') or {}
+
+    event_list_dict = {}
+    for path_cxi in config['cxi']:
+        if path_cxi in event_dict:
+            event_list_dict[path_cxi] = [ int(i) for i in event_dict[path_cxi] ]
+            continue
+
+        # Read-only access to files the labeler may hold open for writing...
+        with open_read_only(path_cxi) as fh:
+            num_event = min(len(fh.get(CXI_KEY[k])) for k in ("num_peaks", "data", "segmask"))
+        event_list_dict[path_cxi] = list(range(num_event))
+
+    return event_list_dict
+
+
+
+
+def compute_pixel_stats(event_list_dict, threshold,
+                        chunk_size  = 256,
+                        batch_size  = 16,
+                        num_workers = 4,
+                        is_per_file = False):
+    ''' Reduce all events in `event_list_dict` ({path_cxi : event_idx_list})
+        in parallel chunks.
+
+        Return {path_cxi : PixelStats} if `is_per_file`, otherwise
+        {None : PixelStats} over all files.
+    '''
+    chunk_list = []
+    for path_cxi, event_idx_list in event_list_dict.items():
+        for i in range(0, len(event_idx_list), chunk_size):
+            chunk_list.append((path_cxi, event_idx_list[i:i + chunk_size]))
+
+    stats_dict = {}
+    with ProcessPoolExecutor(max_workers = num_workers) as executor:
+        future_dict = {}
+        num_done    = 0
+        for path_cxi, event_idx_list in chunk_list:
+            # Bound the number of partial results in flight...
+            while len(future_dict) >= 2 * num_workers:
+                num_done += merge_done(future_dict, stats_dict)
+                print(f"{num_done}/{len(chunk_list)} chunks are reduced.")
+
+            future = executor.submit(reduce_chunk, path_cxi, event_idx_list, threshold, batch_size)
+            future_dict[future] = path_cxi if is_per_file else None
+
+        while future_dict: num_done += merge_done(future_dict, stats_dict)
+        print(f"{num_done}/{len(chunk_list)} chunks are reduced.")
+
+    return stats_dict
+
+
+
+
+def merge_done(future_dict, stats_dict):
+    ''' Wait for finished chunks and merge them into `stats_dict`.
+    '''
+    future_done_set, _ = wait(future_dict, return_when = FIRST_COMPLETED)
+    for future in future_done_set:
+        k     = future_dict.pop(future)
+        stats = future.result()
+        stats_dict[k] = stats if k not in stats_dict else stats_dict[k].merge(stats)
+
+    return len(future_done_set)
+
+
+
+
+def save_mask(path_mask, mask_dict):
+    ''' Save {path_cxi or None : mask} that `load_mask` reads back.
+    '''
+    path_cxi_list = list(mask_dict.keys())
+    np.savez(path_mask, path_cxi = np.array([ '' if k is None else k for k in path_cxi_list ]),
+                        mask     = np.stack([ mask_dict[k] for k in path_cxi_list ]))
+
+    return None
+
+
+
+
+def load_mask(path_mask):
+    ''' Return {path_cxi or None : mask} from a file written by `save_mask`
+        or a stats file written by `PixelStats.save`.
+    '''
+    with np.load(path_mask) as npz:
+        if 'path_cxi' not in npz: return { None : npz['mask'].astype(bool) }
+
+        return { (k if k else None) : mask.astype(bool) for k, mask in zip(npz['path_cxi'].tolist(), npz['mask']) }
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compute per-pixel statistics of a run and propose a bad pixel mask.")
+    parser.add_argument("--path_yaml"  , required = True, help = "YAML listing CXI files (and optional events).")
+    parser.add_argument("--threshold"  , required = True, type = float, help = "Intensity threshold for hot pixels.")
+    parser.add_argument("--path_output", required = True, help = "Output .npz of statistics (or masks with --per_file).")
+    parser.add_argument("--chunk_size" , type = int  , default = 256, help = "Events per chunk.")
+    parser.add_argument("--num_workers", type = int  , default = 4  , help = "Number of worker processes.")
+    parser.add_argument("--num_mad"    , type = float, default = 10.0, help = "Outlier cut in median absolute deviations.")
+    parser.add_argument("--frac_hot"   , type = float, default = 0.5 , help = "Fraction of frames above threshold of a hot pixel.")
+    parser.add_argument("--per_file"   , action = "store_true", help = "Propose one mask per CXI file.")
+    args = parser.parse_args()
+
+    event_list_dict = list_event(args.path_yaml)
+    stats_dict = compute_pixel_stats(event_list_dict, args.threshold,
+                                     chunk_size  = args.chunk_size,
+                                     num_workers = args.num_workers,
+                                     is_per_file = args.per_file)
+
+    mask_dict = { k : stats.propose_mask(num_mad = args.num_mad, frac_hot = args.frac_hot) for k, stats in stats_dict.items() }
+    if args.per_file:
+        save_mask(args.path_output, mask_dict)
+    else:
+        stats_dict[None].save(args.path_output, mask = mask_dict[None])
+
+    for k, mask in mask_dict.items():
+        print(f"{'All files' if k is None else k}: {mask.sum()} bad pixels are proposed.")
+
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Model predictions for upcoming frames, computed by a pool of background
+threads.
+
+Like thumbnails of the filmstrip, frames ahead of navigation are read through
+the file handles of the labeler (h5py serializes reads) rather than by worker
+processes.  Forked workers would inherit the HDF5 state of files the labeler
+holds open, and spawned ones would re-run unguarded launch scripts.  Models
+that release the GIL (numpy, torch, ...) still predict in parallel, and the
+predictor must be safe to call from several threads.
+
+A predictor is given in the data config as `predictor`, either
+
+- "package.module:name", a callable (or a class instance with `predict`), or
+- a path to a pickled model (.pkl/.pickle).
+
+It takes a masked (H, W) image and returns a (H, W) array, either integer
+layer encodes or float probabilities of the peak layer that are cut at
+`threshold`.  Predictions are cached per frame in LRU order.
+"""
+
+import pickle
+import importlib
+import numpy as np
+
+from collections        import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .data  import CXI_KEY
+from .utils import apply_mask
+
+
+def load_predictor(spec):
+    if spec.endswith((".pkl", ".pickle")):
+        with open(spec, 'rb') as fh:
+            predictor = pickle.load(fh)
+    else:
+        module_name, _, attr_name = spec.partition(":")
+        predictor = getattr(importlib.import_module(module_name), attr_name)
+
+    return predictor.predict if hasattr(predictor, "predict") else predictor
+
+
+
+
+def read_masked_img(fh, event_idx):
+    ''' Return the masked image of one event of an open CXI file.
+    '''
+    img          = fh.get(CXI_KEY["data"])[event_idx]
+    dataset_mask = fh.get(CXI_KEY["mask"])
+    mask         = dataset_mask[event_idx] if dataset_mask.ndim == 3 else dataset_mask[()]
+
+    return apply_mask(img, 1 - mask, mask_value = 0)
+
+
+
+
+def run_predictor(predictor, img = None, fh = None, event_idx = None):
+    if img is None: img = read_masked_img(fh, event_idx)
+
+    return np.asarray(predictor(img))
+
+
+
+
+class PredictionPool:
+
+    def __init__(self, spec, num_workers = 2, num_cache = 32, threshold = 0.5):
+        self.spec      = spec
+        self.num_cache = num_cache
+        self.threshold = threshold
+
+        self.predictor = load_predictor(spec)
+        self.executor  = ThreadPoolExecutor(max_workers = num_workers)
+
+        # Internal variables...
+        self.future_dict = {}               # idx -> future
+        self.cache       = OrderedDict()    # idx -> (H, W) label
+
+        return None
+
+
+    def has(self, idx):
+        return idx in self.cache or idx in self.future_dict
+
+
+    def submit(self, idx, fh, event_idx, img = None):
+        ''' Predict frame `idx`, from `img` if it's already in memory or read
+            through the open CXI file `fh` otherwise.
+        '''
+        if self.has(idx): return None
+
+        self.future_dict[idx] = self.executor.submit(run_predictor, self.predictor, img, fh, event_idx)
+
+        return None
+
+
+    def to_label(self, pred):
+        if np.issubdtype(pred.dtype, np.floating): return (pred > self.threshold).astype(np.uint8)
+
+        return pred.astype(np.uint8)
+
+
+    def collect(self):
+        ''' Move finished predictions into the cache.
+        '''
+        for idx, future in list(self.future_dict.items()):
+            if not future.done(): continue
+
+            del self.future_dict[idx]
+            try:
+                self.cache[idx] = self.to_label(future.result())
+            except Exception as e:
+                print(f"Prediction of frame {idx} failed: {e!r}")
+                continue
+
+            while len(self.cache) > self.num_cache: self.cache.popitem(last = False)
+
+        return None
+
+
+    def get(self, idx):
+        ''' Return the predicted label of frame `idx`, or None if it isn't
+            ready yet.
+        '''
+        self.collect()
+
+        label = self.cache.get(idx)
+        if label is not None: self.cache.move_to_end(idx)
+
+        return label
+
+
+    def cancel(self, idx_keep_list):
+        ''' Cancel queued predictions of frames not in `idx_keep_list`.
+        '''
+        for idx in list(self.future_dict.keys()):
+            if idx not in idx_keep_list and self.future_dict[idx].cancel(): del self.future_dict[idx]
+
+        return None
+
+
+    def close(self):
+        # Only running predictions are waited for...
+        for future in self.future_dict.values(): future.cancel()
+        self.executor.shutdown(wait = True)
+
+        return None
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import yaml
+import random
+import numpy as np
+
+from .data import CXI_KEY, open_read_only
+
+
+class StratifiedReservoirSampler:
+    """
+    Draw a fixed number of events per stratum from a stream of unknown length
+    in a single pass (reservoir sampling, Algorithm R).
+
+    The stratum of an event is decided by a metadata value, e.g. the number of
+    peaks.  When `bin_edges` is given, values are binned by `np.digitize`,
+    otherwise each distinct value is a stratum of its own.
+
+    Memory is bounded by (number of strata) x `num_sample_per_stratum`
+    records.  The selection only depends on `seed` and the stream order.
+    """
+
+    def __init__(self, num_sample_per_stratum, bin_edges = None, seed = None):
+        self.num_sample_per_stratum = num_sample_per_stratum
+        self.bin_edges              = bin_edges
+        self.seed                   = seed
+
+        # Internal variables...
+        self.rng            = random.Random(seed)
+        self.reservoir_dict = {}
+        self.num_seen_dict  = {}
+
+        return None
+
+
+    def get_stratum(self, value_list):
+        value_list = np.asarray(value_list)
+
+        if self.bin_edges is None: return value_list.astype(int)
+
+        return np.digitize(value_list, self.bin_edges)
+
+
+    def add(self, record_list, value_list):
+        ''' Feed a batch of records (any hashable, e.g. (path_cxi, event_idx))
+            and their metadata values into the reservoirs.
+        '''
+        stratum_list = self.get_stratum(value_list)
+
+        k = self.num_sample_per_stratum
+        for record, stratum in zip(record_list, stratum_list.tolist()):
+            reservoir = self.reservoir_dict.setdefault(stratum, [])
+            num_seen  = self.num_seen_dict.get(stratum, 0) + 1
+            self.num_seen_dict[stratum] = num_seen
+
+            # Fill the reservoir first...
+            if len(reservoir) < k:
+                reservoir.append(record)
+                continue
+
+            # Replace a random record with the probability of k / num_seen...
+            j = self.rng.randrange(num_seen)
+            if j < k: reservoir[j] = record
+
+        return None
+
+
+    def get_selected(self):
+        ''' Return selected records grouped by stratum and sorted within each.
+        '''
+        selected_dict = {}
+        for stratum in sorted(self.reservoir_dict):
+            selected_dict[stratum] = sorted(self.reservoir_dict[stratum])
+
+        return selected_dict
+
+
+
+
+def iter_cxi_metadata(path_cxi_list, key = CXI_KEY["num_peaks"], chunk_size = 4096):
+    ''' Stream one metadata value per event from CXI files chunk by chunk.
+
+        Datasets with extra dimensions (e.g. peak intensities) are reduced to
+        a scalar per event by summation.
+
+        Yield (path_cxi, event_idx_list, value_list).
+    '''
+    for path_cxi in path_cxi_list:
+        # Without the file lock, so that a running labeler can keep it open...
+        with open_read_only(path_cxi) as fh:
+            dataset   = fh.get(key)
+            num_event = len(dataset)
+            for idx_start in range(0, num_event, chunk_size):
+                idx_end    = min(idx_start + chunk_size, num_event)
+                value_list = dataset[idx_start:idx_end]
+                if value_list.ndim > 1:
+                    value_list = value_list.reshape(len(value_list), -1).sum(axis = 1)
+
+                yield path_cxi, np.arange(idx_start, idx_end), value_list
+
+
+
+
+def write_index(path_index, selected_dict, sampler = None, key = None):
+    ''' Write selected events into a YAML that `data.PeakNetData` reads as
+        `path_yaml`.
+
+        Events are grouped by CXI file so the index stays compact.
+    '''
+    event_dict = {}
+    for record_list in selected_dict.values():
+        for path_cxi, event_idx in record_list:
+            event_dict.setdefault(path_cxi, []).append(int(event_idx))
+
+    for path_cxi in event_dict: event_dict[path_cxi].sort()
+
+    index = {
+        "cxi"   : list(event_dict.keys()),
+        "event" : event_dict,
+    }
+
+    # Record how the subset was drawn for reproducibility...
+    if sampler is not None:
+        index["sampler"] = {
+            "key"                    : key,
+            "seed"                   : sampler.seed,
+            "bin_edges"              : None if sampler.bin_edges is None else [ float(i) for i in sampler.bin_edges ],
+            "num_sample_per_stratum" : sampler.num_sample_per_stratum,
+            "num_seen"               : { int(k) : int(v) for k, v in sampler.num_seen_dict.items() },
+        }
+
+    with open(path_index, 'w') as fh:
+        yaml.safe_dump(index, fh, default_flow_style = None, sort_keys = False)
+
+    return None
+
+
+
+
+def sample_cxi(path_yaml, path_index, num_sample_per_stratum,
+               key        = CXI_KEY["num_peaks"],
+               bin_edges  = None,
+               seed       = None,
+               chunk_size = 4096):
+    ''' Draw a stratified subset of events from all CXI files listed in
+        `path_yaml` and write its index to `path_index`.
+    '''
+    with open(path_yaml, 'r') as fh:
+        config = yaml.safe_load(fh)
+    path_cxi_list = config['cxi']
+
+    sampler = StratifiedReservoirSampler(num_sample_per_stratum, bin_edges = bin_edges, seed = seed)
+    for path_cxi, event_idx_list, value_list in iter_cxi_metadata(path_cxi_list, key = key, chunk_size = chunk_size):
+        record_list = [ (path_cxi, event_idx) for event_idx in event_idx_list.tolist() ]
+        sampler.add(record_list, value_list)
+
+    selected_dict = sampler.get_selected()
+    write_index(path_index, selected_dict, sampler = sampler, key = key)
+
+    num_selected = sum(len(v) for v in selected_dict.values())
+    print(f"{num_selected} events are selected from {len(selected_dict)} strata, saved in {path_index}.")
+
+    return selected_dict
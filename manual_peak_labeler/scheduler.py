@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Active-learning order of frames from stored model outputs.
+
+Model outputs are probability maps of the peak layer, kept per CXI file at
+`CXI_KEY["model_output"]`, either in the CXI file itself or in a sidecar
+`<name>.model.cxi` next to it.  They are (N, H, W) for one model or
+(N, M, H, W) for an ensemble of M models.
+
+Frames are scored in batches by the mean binary entropy of the (ensemble
+mean) probability, or by the disagreement of an ensemble (mean variance
+across models), and served from a priority queue, most uncertain first.
+"""
+
+import os
+import heapq
+import h5py
+import numpy as np
+
+from .data import CXI_KEY
+
+
+def get_entropy_score(prob_batch):
+    ''' Return the mean binary entropy of (B, H, W) or (B, M, H, W)
+        probabilities per frame.
+    '''
+    prob_batch = np.asarray(prob_batch, dtype = np.float32)
+    if prob_batch.ndim == 4: prob_batch = prob_batch.mean(axis = 1)
+
+    prob_batch = np.clip(prob_batch, 1e-6, 1 - 1e-6)
+    entropy    = -(prob_batch * np.log(prob_batch) + (1 - prob_batch) * np.log(1 - prob_batch))
+
+    return entropy.reshape(len(entropy), -1).mean(axis = 1)
+
+
+
+
+def get_disagreement_score(prob_batch):
+    ''' Return the mean variance across models of (B, M, H, W)
+        probabilities per frame.
+    '''
+    prob_batch = np.asarray(prob_batch, dtype = np.float32)
+    if prob_batch.ndim != 4: raise ValueError("Disagreement needs outputs of an ensemble (B, M, H, W).")
+
+    return prob_batch.var(axis = 1).reshape(len(prob_batch), -1).mean(axis = 1)
+
+
+SCORE_FUNC_DICT = {
+    "entropy"      : get_entropy_score,
+    "disagreement" : get_disagreement_score,
+}
+
+
+
+
+def get_path_model_output(path_cxi, dir_model_output):
+    basename = os.path.splitext(os.path.basename(path_cxi))[0]
+
+    return os.path.join(dir_model_output, f"{basename}.model.cxi")
+
+
+
+
+def score_model_output(dataset, event_idx_list, score = "entropy", batch_size = 64):
+    ''' Return scores of `event_idx_list` (increasing) in a model output
+        dataset, read `batch_size` frames at a time.
+    '''
+    score_func = SCORE_FUNC_DICT[score]
+    event_idx_list = np.asarray(event_idx_list)
+
+    score_list = np.zeros(len(event_idx_list), dtype = np.float32)
+    for i in range(0, len(event_idx_list), batch_size):
+        event_idx_batch = event_idx_list[i:i + batch_size]
+        idx_b, idx_e    = event_idx_batch[0], event_idx_batch[-1] + 1
+
+        # Read dense batches as one slice, sparse ones event by event...
+        if idx_e - idx_b <= 2 * len(event_idx_batch):
+            prob_batch = dataset[idx_b:idx_e][event_idx_batch - idx_b]
+        else:
+            prob_batch = dataset[event_idx_batch.tolist()]
+        score_list[i:i + batch_size] = score_func(prob_batch)
+
+    return score_list
+
+
+
+
+def build_scheduler(data_manager, dir_model_output = None, score = "entropy", batch_size = 64):
+    ''' Return a `FrameScheduler` over frames of `data_manager` that have
+        model outputs.
+    '''
+    idx_dict = {}
+    for idx, (path_cxi, event_idx, _) in enumerate(data_manager.idx_list):
+        idx_dict.setdefault(path_cxi, []).append((event_idx, idx))
+
+    scheduler = FrameScheduler()
+    for path_cxi, event_list in idx_dict.items():
+        event_list.sort()
+        event_idx_list = [ event_idx for event_idx, _ in event_list ]
+        idx_list       = [ idx       for _, idx       in event_list ]
+
+        if dir_model_output is None:
+            fh = data_manager.cxi_dict[path_cxi]["file_handle"]
+            dataset = fh.get(CXI_KEY["model_output"])
+            if dataset is None: continue
+            score_list = score_model_output(dataset, event_idx_list, score, batch_size)
+        else:
+            path_model_output = get_path_model_output(path_cxi, dir_model_output)
+            if not os.path.exists(path_model_output): continue
+            with h5py.File(path_model_output, 'r') as fh:
+                score_list = score_model_output(fh.get(CXI_KEY["model_output"]), event_idx_list, score, batch_size)
+
+        scheduler.update(idx_list, score_list)
+
+    print(f"{len(scheduler)} frames are scheduled by {score}.")
+
+    return scheduler
+
+
+
+
+class FrameScheduler:
+    ''' Priority queue of frames, the highest score first.
+
+        Scores can be updated at any time; stale heap entries are skipped
+        when they surface (lazy deletion), so updates cost O(log n).
+    '''
+
+    def __init__(self):
+        self.heap       = []
+        self.score_dict = {}
+        self.done_set   = set()
+
+        return None
+
+
+    def update(self, idx_list, score_list):
+        for idx, score in zip(np.asarray(idx_list).tolist(), np.asarray(score_list, dtype = np.float64).tolist()):
+            self.score_dict[idx] = score
+            heapq.heappush(self.heap, (-score, idx))
+
+        return None
+
+
+    def mark_done(self, idx):
+        self.done_set.add(idx)
+
+        return None
+
+
+    def pop(self):
+        ''' Return the most informative frame not done yet (None if there's
+            none) and mark it done.
+        '''
+        while self.heap:
+            score, idx = heapq.heappop(self.heap)
+            if idx in self.done_set or self.score_dict.get(idx) != -score: continue
+
+            self.done_set.add(idx)
+            return idx
+
+        return None
+
+
+    def __len__(self):
+        return len(set(self.score_dict) - self.done_set)
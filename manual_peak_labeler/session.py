@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Multi-annotator sessions over one CXI set.
+
+Work is split into one YAML per annotator, either by frame ranges or by
+striding, out of all events of the labeler YAML or of a query result (e.g.
+an index written by `sampler`)
+
+    python -m manual_peak_labeler.session assign --path_yaml data.yaml --username alice bob --dir_output shards/
+
+Each annotator runs the labeler on `shards/<username>.yaml` with
+`dir_session` set in the data config.  CXI files are then opened read-only
+and edits are appended to the annotator's own edit log
+`<dir_session>/<username>.edits.<generation>` (the autosave record format),
+so annotators never write to a shared file and need no locks.
+
+Logs are merged into one log of final labels without touching CXI files
+
+    python -m manual_peak_labeler.session merge --dir_session session/ --path_output merged.edits
+
+Frames edited by one annotator are copied as is.  Frames edited by several
+are resolved by `policy`, either 'latest' (the latest edit wins) or 'vote'
+(per-pixel majority, ties go to the latest edit), and reported in
+`<path_output>.conflicts.csv`.  The merged log reads back with
+`autosave.read_recovery` and feeds `peaks --path_edits`.
+"""
+
+import os
+import csv
+import glob
+import zlib
+import yaml
+import pickle
+import random
+import argparse
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .autosave   import list_recovery, iter_record, decode_record
+from .pixelstats import list_event
+
+
+def get_path_edit_log(dir_session, username):
+    return os.path.join(dir_session, f"{username}.edits")
+
+
+
+
+def list_edit_log(dir_session):
+    ''' Return {username : path_edit_log} of all edit logs in a session.
+    '''
+    log_dict = {}
+    for path_log in glob.glob(os.path.join(glob.escape(dir_session), "*.edits.*")):
+        path_edit_log, _, generation = path_log.rpartition('.')
+        if not generation.isdigit(): continue
+
+        username = os.path.basename(path_edit_log)[:-len(".edits")]
+        log_dict[username] = path_edit_log
+
+    return log_dict
+
+
+
+
+def assign_shards(event_list_dict, username_list, mode = 'range', frac_overlap = 0.0, seed = None):
+    ''' Split events in `event_list_dict` ({path_cxi : event_idx_list})
+        among annotators.
+
+        With `mode` set to 'range' each annotator gets a contiguous block of
+        frames, with 'stride' every n-th frame.  A fraction `frac_overlap` of
+        each shard is also given to the next annotator for double labeling.
+
+        Return {username : {path_cxi : event_idx_list}}.
+    '''
+    record_list = [ (path_cxi, event_idx) for path_cxi, event_idx_list in event_list_dict.items() for event_idx in event_idx_list ]
+    num_shard   = len(username_list)
+
+    if mode == 'range':
+        bound_list = np.linspace(0, len(record_list), num_shard + 1).astype(int)
+        shard_list = [ record_list[bound_list[i]:bound_list[i + 1]] for i in range(num_shard) ]
+    elif mode == 'stride':
+        shard_list = [ record_list[i::num_shard] for i in range(num_shard) ]
+    else:
+        raise ValueError(f"Unknown mode {mode}, use 'range' or 'stride'.")
+
+    # Double label a random part of each shard...
+    rng = random.Random(seed)
+    shard_extra_list = [ [] for _ in range(num_shard) ]
+    if num_shard > 1 and frac_overlap > 0:
+        for i, shard in enumerate(shard_list):
+            num_overlap = int(round(len(shard) * frac_overlap))
+            shard_extra_list[(i + 1) % num_shard].extend(rng.sample(shard, num_overlap))
+
+    shard_dict = {}
+    for username, shard, shard_extra in zip(username_list, shard_list, shard_extra_list):
+        event_dict = {}
+        for path_cxi, event_idx in sorted(set(shard + shard_extra)):
+            event_dict.setdefault(path_cxi, []).append(int(event_idx))
+        shard_dict[username] = event_dict
+
+    return shard_dict
+
+
+
+
+def write_shards(dir_output, shard_dict, mode = None):
+    ''' Write one YAML per annotator that `data.PeakNetData` reads as
+        `path_yaml`.
+    '''
+    os.makedirs(dir_output, exist_ok = True)
+
+    for username, event_dict in shard_dict.items():
+        index = {
+            "cxi"   : list(event_dict.keys()),
+            "event" : event_dict,
+            "shard" : { "username" : username, "mode" : mode, "num_shard" : len(shard_dict) },
+        }
+
+        path_shard = os.path.join(dir_output, f"{username}.yaml")
+        with open(path_shard, 'w') as fh:
+            yaml.safe_dump(index, fh, default_flow_style = None, sort_keys = False)
+
+        print(f"{sum(len(v) for v in event_dict.values())} events are assigned to {username} in {path_shard}.")
+
+    return None
+
+
+
+
+def index_edit_log(path_edit_log):
+    ''' Return {key : (time, path_log, offset)} of the latest record of
+        each frame in all generations of an edit log.  Labels aren't
+        decompressed.
+    '''
+    entry_dict = {}
+    for generation, path_log in list_recovery(path_edit_log):
+        for offset, record in iter_record(path_log):
+            # Logs without time stamps order by generation...
+            entry_dict[tuple(record["key"])] = (record.get("time", float(generation)), path_log, offset)
+
+    return entry_dict
+
+
+
+
+def read_record(path_log, offset):
+    with open(path_log, 'rb') as fh:
+        fh.seek(offset)
+        record = pickle.load(fh)
+
+    return record
+
+
+
+
+def resolve_conflict(label_list, policy = 'latest'):
+    ''' Return (label, number of disputed pixels) of labels of one frame,
+        the oldest edit first.  'vote' needs at least three labels to have
+        a majority, otherwise the latest edit wins.
+    '''
+    label_stack = np.stack(label_list)
+    is_disputed  = np.any(label_stack != label_stack[-1], axis = 0)
+    num_disputed = int(is_disputed.sum())
+
+    if policy == 'latest' or len(label_list) < 3 or num_disputed == 0: return label_stack[-1], num_disputed
+
+    # Count the labels that agree with each one at every pixel...
+    num_agree = np.zeros(label_stack.shape, dtype = np.int16)
+    for label in label_stack: num_agree += label_stack == label
+
+    # Look from the latest edit so that ties go to it...
+    idx_best = len(label_stack) - 1 - np.argmax(num_agree[::-1], axis = 0)
+    label    = np.take_along_axis(label_stack, idx_best[None], axis = 0)[0]
+
+    return label, num_disputed
+
+
+
+
+def merge_group(entry_group, path_part, policy = 'latest'):
+    ''' Merge frames of one CXI file into a part of the merged log.
+
+        `entry_group` is [(key, [(time, username, path_log, offset), ...]), ...].
+
+        Return a list of conflicts.
+    '''
+    conflict_list = []
+    with open(path_part, 'wb') as fh:
+        for key, entry_list in entry_group:
+            entry_list    = sorted(entry_list)
+            record_list   = [ read_record(path_log, offset) for _, _, path_log, offset in entry_list ]
+            username_list = [ username for _, username, _, _ in entry_list ]
+
+            record = record_list[-1]
+            record = { "key"    : key,
+                       "shape"  : record["shape"],
+                       "dtype"  : record["dtype"],
+                       "blob"   : record["blob"],
+                       "time"   : entry_list[-1][0],
+                       "source" : username_list, }
+
+            # Only frames edited by several annotators differently are resolved...
+            is_same = all(r["blob"] == record["blob"] for r in record_list)
+            if not is_same:
+                label_list = [ decode_record(r) for r in record_list ]
+                if len(set(label.shape for label in label_list)) > 1:
+                    num_disputed, resolution = -1, "latest"
+                else:
+                    label, num_disputed = resolve_conflict(label_list, policy)
+                    resolution = policy if len(label_list) >= 3 else "latest"
+                    if num_disputed > 0:
+                        record["blob"] = zlib.compress(np.ascontiguousarray(label).tobytes(), 1)
+
+                if num_disputed != 0:
+                    conflict_list.append({ "path_cxi"     : key[0],
+                                           "event_idx"    : key[1],
+                                           "username"     : ' '.join(username_list),
+                                           "num_disputed" : num_disputed,
+                                           "resolution"   : resolution, })
+
+            pickle.dump(record, fh, protocol = pickle.HIGHEST_PROTOCOL)
+
+    return conflict_list
+
+
+
+
+def merge_edit_logs(log_dict, path_output, policy = 'latest', num_workers = 4):
+    ''' Merge edit logs ({username : path_edit_log}) into one log of final
+        labels at `path_output.0`, one worker per CXI file.
+
+        Return a list of conflicts.
+    '''
+    # Index all logs, labels stay on disk...
+    entry_dict = {}
+    for username, path_edit_log in log_dict.items():
+        for key, (time_edit, path_log, offset) in index_edit_log(path_edit_log).items():
+            entry_dict.setdefault(key, []).append((time_edit, username, path_log, offset))
+
+    entry_group_dict = {}
+    for key in sorted(entry_dict, key = lambda key: (key[0] or '', -1 if key[1] is None else key[1])):
+        entry_group_dict.setdefault(key[0], []).append((key, entry_dict[key]))
+
+    path_merged = f"{path_output}.0"
+    path_part_list = [ f"{path_merged}.part{i}" for i in range(len(entry_group_dict)) ]
+
+    conflict_list = []
+    with ProcessPoolExecutor(max_workers = num_workers) as executor:
+        future_list = [ executor.submit(merge_group, entry_group, path_part, policy)
+                        for entry_group, path_part in zip(entry_group_dict.values(), path_part_list) ]
+        for future in future_list: conflict_list.extend(future.result())
+
+    # Stitch parts together and replace the merged log in one go...
+    path_tmp = f"{path_merged}.tmp"
+    with open(path_tmp, 'wb') as fh:
+        for path_part in path_part_list:
+            with open(path_part, 'rb') as fh_part:
+                while True:
+                    chunk = fh_part.read(64 * 1024**2)
+                    if not chunk: break
+                    fh.write(chunk)
+            os.remove(path_part)
+    os.replace(path_tmp, path_merged)
+
+    print(f"{len(entry_dict)} frames from {len(log_dict)} annotators are merged into {path_merged}, {len(conflict_list)} with conflicts.")
+
+    return conflict_list
+
+
+
+
+def write_conflicts(path_report, conflict_list):
+    with open(path_report, 'w', newline = '') as fh:
+        writer = csv.DictWriter(fh, fieldnames = ["path_cxi", "event_idx", "username", "num_disputed", "resolution"])
+        writer.writeheader()
+        writer.writerows(conflict_list)
+
+    return None
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Assign shards to annotators and merge their edit logs.")
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+
+    parser_assign = subparsers.add_parser("assign", help = "Write one labeler YAML per annotator.")
+    parser_assign.add_argument("--path_yaml"   , required = True, help = "YAML listing CXI files (and optional events).")
+    parser_assign.add_argument("--username"    , required = True, nargs = '+', help = "Annotators.")
+    parser_assign.add_argument("--dir_output"  , required = True, help = "Directory of YAML files of annotators.")
+    parser_assign.add_argument("--mode"        , default = 'range', choices = ['range', 'stride'], help = "Frame ranges or every n-th frame.")
+    parser_assign.add_argument("--frac_overlap", type = float, default = 0.0, help = "Fraction of each shard also given to the next annotator.")
+    parser_assign.add_argument("--seed"        , type = int, default = None, help = "Seed of the overlap.")
+
+    parser_merge = subparsers.add_parser("merge", help = "Merge edit logs of a session.")
+    parser_merge.add_argument("--dir_session" , required = True, help = "Directory of edit logs.")
+    parser_merge.add_argument("--path_output" , required = True, help = "Merged edit log (written to <path_output>.0).")
+    parser_merge.add_argument("--username"    , default = None, nargs = '+', help = "Only merge these annotators.")
+    parser_merge.add_argument("--policy"      , default = 'latest', choices = ['latest', 'vote'], help = "Resolution of conflicts.")
+    parser_merge.add_argument("--num_workers" , type = int, default = 4, help = "Number of worker processes.")
+
+    args = parser.parse_args()
+
+    if args.command == "assign":
+        shard_dict = assign_shards(list_event(args.path_yaml), args.username,
+                                   mode         = args.mode,
+                                   frac_overlap = args.frac_overlap,
+                                   seed         = args.seed)
+        write_shards(args.dir_output, shard_dict, mode = args.mode)
+
+    if args.command == "merge":
+        log_dict = list_edit_log(args.dir_session)
+        if args.username is not None: log_dict = { k : v for k, v in log_dict.items() if k in args.username }
+
+        conflict_list = merge_edit_logs(log_dict, args.path_output, policy = args.policy, num_workers = args.num_workers)
+        write_conflicts(f"{args.path_output}.conflicts.csv", conflict_list)
+
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Node-local frame cache shared by labeler processes.
+
+A `FrameCacheServer` owns shared memory segments that hold decoded, masked
+frames.  Labeler processes talk to it through a Unix socket with a JSON line
+protocol and map the segments zero-copy with `FrameCacheClient`.
+
+Each segment is reference counted per connection, and segments that are no
+longer referenced are evicted in LRU order once the size cap is exceeded.
+References held by a client are dropped automatically when it disconnects,
+and segments never marked ready (e.g. their client crashed while filling
+them) expire after `ready_timeout` seconds.  A client that loses the server
+reconnects once per request and otherwise reports misses, so frames are
+read from their files.
+
+Start a server on a node with
+
+    python -m manual_peak_labeler.shmcache --path_socket /tmp/labeler.sock --max_gb 8
+
+and set `path_frame_cache` in the data config of each labeler.
+
+Requires Python 3.8+ (`multiprocessing.shared_memory`).
+"""
+
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+import socketserver
+import numpy as np
+
+from collections import OrderedDict
+from multiprocessing import shared_memory, resource_tracker
+
+
+def attach_shared_memory(name):
+    ''' Map an existing segment without letting this process' resource
+        tracker unlink it on exit (the server owns the segment).
+    '''
+    try:
+        shm = shared_memory.SharedMemory(name = name, track = False)
+    except TypeError:
+        # Python < 3.13 always tracks attached segments...
+        shm = shared_memory.SharedMemory(name = name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+
+    return shm
+
+
+
+
+class FrameCacheServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path_socket, max_bytes, ready_timeout = 30):
+        self.path_socket   = path_socket
+        self.max_bytes     = max_bytes
+        self.ready_timeout = ready_timeout
+
+        # Internal variables...
+        self.lock       = threading.Lock()
+        self.entry_dict = OrderedDict()    # key -> entry, in LRU order
+        self.num_bytes  = 0
+
+        if os.path.exists(path_socket): os.remove(path_socket)
+
+        super().__init__(path_socket, FrameCacheHandler)
+
+        return None
+
+
+    def acquire(self, key):
+        with self.lock:
+            entry = self.entry_dict.get(key)
+            if entry is None or not entry["is_ready"]: return None
+
+            entry["refcount"] += 1
+            self.entry_dict.move_to_end(key)
+
+            return entry
+
+
+    def allocate(self, key, shape, dtype):
+        ''' Return (entry, is_new).  Only the client that gets `is_new` fills
+            the segment and marks it ready.
+        '''
+        with self.lock:
+            entry = self.entry_dict.get(key)
+
+            # Replace a segment its client never finished...
+            if entry is not None and not entry["is_ready"]:
+                if entry["refcount"] == 0 or time.time() - entry["time_allocate"] > self.ready_timeout:
+                    self.remove(key)
+                    entry = None
+
+            if entry is not None: return entry, False
+
+            nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+            shm = shared_memory.SharedMemory(create = True, size = nbytes)
+            entry = { "shm"           : shm,
+                      "name"          : shm.name,
+                      "shape"         : list(shape),
+                      "dtype"         : dtype,
+                      "nbytes"        : nbytes,
+                      "refcount"      : 1,
+                      "is_ready"      : False,
+                      "time_allocate" : time.time(), }
+            self.entry_dict[key] = entry
+            self.num_bytes += nbytes
+
+            self.evict()
+
+            return entry, True
+
+
+    def mark_ready(self, entry):
+        with self.lock:
+            entry["is_ready"] = True
+
+        return None
+
+
+    def release(self, entry):
+        ''' Drop a reference to `entry`, which may have expired meanwhile.
+        '''
+        with self.lock:
+            if entry["refcount"] > 0: entry["refcount"] -= 1
+
+            self.evict()
+
+        return None
+
+
+    def remove(self, key):
+        ''' Unlink a segment, clients that mapped it keep their mapping.
+            Must be called with the lock held.
+        '''
+        entry = self.entry_dict.pop(key)
+        self.num_bytes -= entry["nbytes"]
+        entry["shm"].close()
+        entry["shm"].unlink()
+
+        return None
+
+
+    def evict(self):
+        ''' Drop unreferenced segments from the LRU end until the cache fits.
+            Must be called with the lock held.
+        '''
+        for key in list(self.entry_dict.keys()):
+            if self.num_bytes <= self.max_bytes: break
+
+            entry = self.entry_dict[key]
+            if entry["refcount"] > 0: continue
+
+            self.remove(key)
+
+        return None
+
+
+    def server_close(self):
+        super().server_close()
+
+        with self.lock:
+            for entry in self.entry_dict.values():
+                entry["shm"].close()
+                entry["shm"].unlink()
+            self.entry_dict.clear()
+            self.num_bytes = 0
+
+        if os.path.exists(self.path_socket): os.remove(self.path_socket)
+
+        return None
+
+
+
+
+class FrameCacheHandler(socketserver.StreamRequestHandler):
+    ''' Serve one client connection.  References are tracked per connection
+        so a crashed labeler can't pin segments forever.
+    '''
+
+    def handle(self):
+        server     = self.server
+        ref_dict   = {}    # key -> [entry, ...] referenced by this client
+        alloc_dict = {}    # key -> entry this client is filling
+
+        try:
+            for line in self.rfile:
+                request = json.loads(line)
+                op      = request["op"]
+                key     = request["key"]
+                reply   = {}
+
+                if op == "acquire":
+                    entry = server.acquire(key)
+                    if entry is not None:
+                        ref_dict.setdefault(key, []).append(entry)
+                        reply = { "name" : entry["name"], "shape" : entry["shape"], "dtype" : entry["dtype"] }
+
+                elif op == "allocate":
+                    entry, is_new = server.allocate(key, request["shape"], request["dtype"])
+                    if is_new:
+                        ref_dict.setdefault(key, []).append(entry)
+                        alloc_dict[key] = entry
+                    reply = { "name" : entry["name"], "is_new" : is_new }
+
+                elif op == "ready":
+                    # Only the segment this client allocated, even if it expired...
+                    entry = alloc_dict.pop(key, None)
+                    if entry is not None: server.mark_ready(entry)
+
+                elif op == "release":
+                    if ref_dict.get(key): server.release(ref_dict[key].pop())
+
+                self.wfile.write((json.dumps(reply) + "\n").encode())
+                self.wfile.flush()
+
+        finally:
+            for entry_list in ref_dict.values():
+                for entry in entry_list: server.release(entry)
+
+        return None
+
+
+
+
+class FrameCacheClient:
+    ''' Map frames cached by a `FrameCacheServer`.
+
+        Up to `num_pinned` recently used frames stay referenced by this
+        client.  Arrays handed out are read-only views into shared memory.
+
+        If the server dies or restarts, each request reconnects once; when
+        that fails too, `get` misses and `put` returns the frame unshared.
+    '''
+
+    def __init__(self, path_socket, num_pinned = 4):
+        self.path_socket = path_socket
+        self.num_pinned  = num_pinned
+
+        # Internal variables...
+        self.sock         = None
+        self.fh           = None
+        self.pinned_dict  = OrderedDict()    # key -> (shm, shape, dtype)
+        self.closing_list = []
+
+        self.connect()
+
+        return None
+
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path_socket)
+        except OSError:
+            sock.close()
+            raise
+
+        self.sock = sock
+        self.fh   = sock.makefile('rwb')
+
+        return None
+
+
+    def disconnect(self):
+        ''' Drop the connection, references it held are released by the
+            server.
+        '''
+        for f in (self.fh, self.sock):
+            try:
+                if f is not None: f.close()
+            except OSError:
+                pass
+        self.fh   = None
+        self.sock = None
+
+        # Mappings stay valid until no array views them...
+        self.closing_list.extend(shm for shm, _, _ in self.pinned_dict.values())
+        self.pinned_dict.clear()
+
+        return None
+
+
+    def request(self, op, key, **kwargs):
+        ''' Return the reply of the server, or None if it can't be reached
+            even after reconnecting.
+        '''
+        line = (json.dumps(dict(op = op, key = key, **kwargs)) + "\n").encode()
+
+        is_connected = self.fh is not None
+        for _ in range(2):
+            try:
+                if self.fh is None: self.connect()
+                self.fh.write(line)
+                self.fh.flush()
+
+                reply = self.fh.readline()
+                if not reply: raise ConnectionError("connection closed by the server")
+
+                return json.loads(reply)
+            except (OSError, ValueError) as e:
+                if is_connected: print(f"Frame cache at {self.path_socket} is lost ({e}), frames are read from files.")
+                is_connected = False
+                self.disconnect()
+
+        return None
+
+
+    def pin(self, key, shm, shape, dtype):
+        self.pinned_dict[key] = (shm, shape, dtype)
+        self.pinned_dict.move_to_end(key)
+
+        # Release frames beyond the pinning budget...
+        while len(self.pinned_dict) > self.num_pinned:
+            key_old, (shm_old, _, _) = self.pinned_dict.popitem(last = False)
+            self.request("release", key_old)
+            self.closing_list.append(shm_old)
+
+        # Unmap released segments no longer viewed by any array...
+        closing_list = []
+        for shm_old in self.closing_list:
+            try:
+                shm_old.close()
+            except BufferError:
+                closing_list.append(shm_old)
+        self.closing_list = closing_list
+
+        arr = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+        arr.flags.writeable = False
+
+        return arr
+
+
+    def get(self, key):
+        ''' Return the cached frame or None on a miss.
+        '''
+        if key in self.pinned_dict: return self.pin(key, *self.pinned_dict[key])
+
+        reply = self.request("acquire", key)
+        if not reply: return None
+
+        try:
+            shm = attach_shared_memory(reply["name"])
+        except FileNotFoundError:
+            self.request("release", key)
+            return None
+
+        return self.pin(key, shm, tuple(reply["shape"]), reply["dtype"])
+
+
+    def put(self, key, img):
+        ''' Publish a frame and return its shared, read-only view.  If another
+            process publishes the same frame first, its copy is used once ready.
+        '''
+        img   = np.ascontiguousarray(img)
+        dtype = img.dtype.str
+        reply = self.request("allocate", key, shape = list(img.shape), dtype = dtype)
+        if reply is None: return img
+
+        if not reply["is_new"]:
+            img_cached = self.get(key)
+            return img if img_cached is None else img_cached
+
+        shm = attach_shared_memory(reply["name"])
+        np.ndarray(img.shape, dtype = dtype, buffer = shm.buf)[...] = img
+
+        # Keep the frame unshared if the server is lost meanwhile...
+        if self.request("ready", key) is None:
+            shm.close()
+            return img
+
+        return self.pin(key, shm, img.shape, dtype)
+
+
+    def close(self):
+        if self.fh is not None:
+            for key in self.pinned_dict: self.request("release", key)
+        self.disconnect()
+
+        return None
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Serve a node-local frame cache for labeler processes.")
+    parser.add_argument("--path_socket", required = True, help = "Path to the Unix socket.")
+    parser.add_argument("--max_gb"     , type = float, default = 4.0, help = "Size cap of cached frames in GB.")
+    args = parser.parse_args()
+
+    with FrameCacheServer(args.path_socket, int(args.max_gb * 1024**3)) as server:
+        print(f"Frame cache is serving at {args.path_socket}.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+    return None
+
+
+if __name__ == "__main__":
+    main()
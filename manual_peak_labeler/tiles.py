@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tiled rendering of large frames.
+
+A `TileLayer` splits a (X, Y) frame into `tile_size` tiles, each shown by an
+`ImageItem` of its own.  Only tiles intersecting the visible range of the
+ViewBox are rendered and uploaded; tiles scrolled out of view are hidden but
+kept (up to `num_cache` of them, LRU), so panning back costs nothing.  Edits
+invalidate single tiles.
+
+When more than `max_visible` tiles are in view (zoomed out), tiles are
+hidden and an optional overview, rendered once at a coarser step, is shown
+instead.
+
+Tiles are rendered by `render_func(x_b, x_e, y_b, y_e)` and the overview by
+`overview_func(step)`, so layers that are computed per pixel (e.g. label
+colors) are only computed for what is on screen.
+"""
+
+import math
+import numpy as np
+
+from collections import OrderedDict
+
+from pyqtgraph    import ImageItem
+from pyqtgraph.Qt import QtGui
+
+
+def get_changed_tiles(label_old, label_new, tile_size):
+    ''' Return {(i, j), ...} of tiles where two labels differ.
+    '''
+    idx_x, idx_y = np.nonzero(label_old != label_new)
+
+    return set(zip((idx_x // tile_size).tolist(), (idx_y // tile_size).tolist()))
+
+
+
+
+def get_overview_step(shape, overview_size):
+    return max(math.ceil(max(shape) / overview_size), 1)
+
+
+
+
+class TileLayer:
+
+    def __init__(self, view_box, tile_size = 512, z_value = 0, num_cache = 64, max_visible = 16, overview_size = 1024):
+        self.view_box      = view_box
+        self.tile_size     = tile_size
+        self.z_value       = z_value
+        self.num_cache     = num_cache
+        self.max_visible   = max_visible
+        self.overview_size = overview_size
+
+        # Internal variables...
+        self.shape             = None
+        self.render_func       = None
+        self.overview_func     = None
+        self.levels            = None
+        self.lut               = None
+        self.is_visible        = True
+        self.item_dict         = OrderedDict()    # (i, j) -> ImageItem, in LRU order
+        self.dirty_set         = set()
+        self.overview_item     = None
+        self.is_overview_dirty = True
+
+        return None
+
+
+    def create_item(self):
+        item = ImageItem(None)
+        item.setZValue(self.z_value)
+        if self.lut is not None: item.setLookupTable(self.lut)
+        self.view_box.addItem(item)
+
+        return item
+
+
+    def set_source(self, shape, render_func, overview_func = None, levels = None):
+        ''' Show a new frame, all cached tiles become stale.
+        '''
+        self.shape         = tuple(shape)
+        self.render_func   = render_func
+        self.overview_func = overview_func
+        self.levels        = levels
+        self.is_visible    = True
+
+        self.dirty_set         = set(self.item_dict.keys())
+        self.is_overview_dirty = True
+        self.update()
+
+        return None
+
+
+    def get_visible_tiles(self):
+        (x_min, x_max), (y_min, y_max) = self.view_box.viewRange()
+        size_x, size_y = self.shape
+        num_x = -(-size_x // self.tile_size)
+        num_y = -(-size_y // self.tile_size)
+
+        i_b = min(max(int(x_min // self.tile_size), 0), num_x)
+        i_e = min(max(int(x_max // self.tile_size) + 1, 0), num_x)
+        j_b = min(max(int(y_min // self.tile_size), 0), num_y)
+        j_e = min(max(int(y_max // self.tile_size) + 1, 0), num_y)
+
+        return [ (i, j) for i in range(i_b, i_e) for j in range(j_b, j_e) ]
+
+
+    def update(self):
+        ''' Render and upload visible tiles that are new or stale.
+        '''
+        if self.shape is None or not self.is_visible: return None
+
+        tile_list = self.get_visible_tiles()
+        is_coarse = len(tile_list) > self.max_visible
+        if is_coarse: tile_list = []
+
+        tile_set = set(tile_list)
+        for k, item in self.item_dict.items():
+            if k not in tile_set: item.hide()
+
+        for i, j in tile_list:
+            item = self.item_dict.get((i, j))
+            if item is None:
+                item = self.create_item()
+                self.item_dict[(i, j)] = item
+                self.dirty_set.add((i, j))
+
+            if (i, j) in self.dirty_set:
+                x_b, y_b = i * self.tile_size, j * self.tile_size
+                x_e, y_e = min(x_b + self.tile_size, self.shape[0]), min(y_b + self.tile_size, self.shape[1])
+                item.setImage(self.render_func(x_b, x_e, y_b, y_e), levels = self.levels, autoLevels = False)
+                item.setPos(x_b, y_b)
+                self.dirty_set.discard((i, j))
+
+            item.show()
+            self.item_dict.move_to_end((i, j))
+
+        # Free tiles out of view beyond the cache size...
+        for k in list(self.item_dict.keys()):
+            if len(self.item_dict) <= max(self.num_cache, len(tile_list)): break
+            if k in tile_set: continue
+
+            self.view_box.removeItem(self.item_dict.pop(k))
+            self.dirty_set.discard(k)
+
+        self.update_overview(is_coarse)
+
+        return None
+
+
+    def update_overview(self, is_coarse):
+        if self.overview_func is None: return None
+
+        if self.overview_item is None: self.overview_item = self.create_item()
+
+        if is_coarse and self.is_overview_dirty:
+            step = get_overview_step(self.shape, self.overview_size)
+            self.overview_item.setImage(self.overview_func(step), levels = self.levels, autoLevels = False)
+            self.overview_item.setTransform(QtGui.QTransform.fromScale(step, step))
+            self.is_overview_dirty = False
+
+        self.overview_item.setVisible(is_coarse)
+
+        return None
+
+
+    def invalidate(self, tile_set = None):
+        ''' Mark tiles in `tile_set` (all if None) stale and refresh those
+            in view.
+        '''
+        if tile_set is None: tile_set = set(self.item_dict.keys())
+        if not tile_set: return None
+
+        self.dirty_set |= set(tile_set) & set(self.item_dict.keys())
+        self.is_overview_dirty = True
+        self.update()
+
+        return None
+
+
+    def set_levels(self, levels):
+        self.levels = levels
+        for item in self.item_dict.values(): item.setLevels(levels)
+
+        return None
+
+
+    def set_lookup_table(self, lut):
+        self.lut = lut
+        for item in self.item_dict.values(): item.setLookupTable(lut)
+
+        return None
+
+
+    def clear(self):
+        ''' Hide the layer until the next `set_source`.
+        '''
+        self.is_visible = False
+        for item in self.item_dict.values(): item.hide()
+        if self.overview_item is not None: self.overview_item.hide()
+
+        return None
@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import random
+import threading
 import numpy as np
-import skimage.measure as sm
 import psana
 
+from collections        import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
 def set_seed(seed):
     random.seed(seed)
     np.random.seed(seed)
@@ -117,22 +121,90 @@ class PerfMetric:
 
 
 
+def block_sum(data, bin_row, bin_col):
+    """ Sum (B, H, W) over blocks of (bin_row, bin_col) with reshapes.
+
+        Edges that don't divide evenly are summed as partial blocks, without
+        padding the whole stack.
+    """
+    B, H, W = data.shape
+    H_main  = H - H % bin_row
+    W_main  = W - W % bin_col
+    H_block = H_main // bin_row
+    W_block = W_main // bin_col
+
+    out = np.zeros((B, -(-H // bin_row), -(-W // bin_col)), dtype = np.result_type(data.dtype, np.float32))
+
+    # Full blocks...
+    out[:, :H_block, :W_block] = data[:, :H_main, :W_main].reshape(B, H_block, bin_row, W_block, bin_col).sum(axis = (2, 4))
+
+    # Partial blocks at the bottom and right edges...
+    if H_main < H:
+        out[:, -1, :W_block] = data[:, H_main:, :W_main].reshape(B, H - H_main, W_block, bin_col).sum(axis = (1, 3))
+    if W_main < W:
+        out[:, :H_block, -1] = data[:, :H_main, W_main:].reshape(B, H_block, bin_row, W - W_main).sum(axis = (2, 3))
+    if H_main < H and W_main < W:
+        out[:, -1, -1] = data[:, H_main:, W_main:].sum(axis = (1, 2))
+
+    return out
+
+
+
+
 def downsample(assem, bin_row=2, bin_col=2, mask=None):
-    """ Downsample an SPI image.  
+    """ Downsample an SPI image (H, W) or a stack of images (B, H, W) by
+        mask-weighted binning.  A (H, W) mask is shared by all images.
+
+        Each block is the sum of all its pixels divided by the weight of its
+        good pixels in `mask`, so bad pixels must be zeroed beforehand for
+        a mean of good pixels.
         Adopted from https://github.com/chuckie82/DeepProjection/blob/master/DeepProjection/utils.py
     """
+    assem = np.asarray(assem)
+    is_2d = assem.ndim == 2
+    if is_2d: assem = assem[None]
+
+    B, H, W = assem.shape
+
     if mask is None:
-        combinedMask = np.ones_like(assem)
+        # Count pixels per block directly instead of binning an all-ones mask...
+        count_row = np.full(-(-H // bin_row), bin_row)
+        count_col = np.full(-(-W // bin_col), bin_col)
+        count_row[-1] = H - (len(count_row) - 1) * bin_row
+        count_col[-1] = W - (len(count_col) - 1) * bin_col
+        downWeight = np.outer(count_row, count_col)[None]
+        downCalib  = block_sum(assem, bin_row, bin_col)
     else:
-        combinedMask = mask
-    downCalib  = sm.block_reduce(assem       , block_size=(bin_row, bin_col), func=np.sum)
-    downWeight = sm.block_reduce(combinedMask, block_size=(bin_row, bin_col), func=np.sum)
-    warr       = np.zeros_like(downCalib, dtype='float32')
-    ind        = np.where(downWeight > 0)
-    warr[ind]  = downCalib[ind] / downWeight[ind]
+        mask = np.asarray(mask)
+        if mask.ndim == 2: mask = mask[None]
+        downWeight = block_sum(mask, bin_row, bin_col)
+        downCalib  = block_sum(assem, bin_row, bin_col)
+
+    warr = np.zeros(downCalib.shape, dtype='float32')
+    np.divide(downCalib, downWeight, out = warr, where = downWeight > 0, casting = 'unsafe')
+
+    return warr[0] if is_2d else warr
+
+
 
-    return warr
 
+def downsample_dataset(dataset, bin_row=2, bin_col=2, mask=None, chunk_size=64, out=None):
+    """ Downsample a whole (N, H, W) dataset, e.g. an h5py dataset or a
+        memmap, chunk by chunk so that only `chunk_size` frames are in memory.
+
+        `mask` is either (H, W) or (N, H, W).  `out` can be any preallocated
+        array-like (e.g. an h5py dataset) of the binned shape.
+    """
+    N, H, W = dataset.shape
+    if out is None: out = np.zeros((N, -(-H // bin_row), -(-W // bin_col)), dtype = 'float32')
+
+    for idx_start in range(0, N, chunk_size):
+        idx_end    = min(idx_start + chunk_size, N)
+        mask_chunk = mask if mask is None or mask.ndim == 2 else mask[idx_start:idx_end]
+
+        out[idx_start:idx_end] = downsample(dataset[idx_start:idx_end], bin_row, bin_col, mask_chunk)
+
+    return out
 
 
 
@@ -140,38 +212,235 @@ class PsanaImg:
     """
     It serves as an image accessing layer based on the data management system
     psana in LCLS.  
+
+    Images are assembled from calibrated panels with a pixel index map that
+    is computed once per run and detector and shared by all instances.
+
+    Pass `path_timestamps` to persist the event-to-timestamp index, so that
+    later sessions skip `run.times()`.
     """
 
-    def __init__(self, exp, run, mode, detector_name):
+    # Pixel index maps keyed by (exp, run, detector_name)...
+    pixel_index_map_cache = {}
+
+    def __init__(self, exp, run, mode, detector_name, path_timestamps = None):
+        self.exp             = exp
+        self.run             = run
+        self.detector_name   = detector_name
+        self.path_timestamps = path_timestamps
 
         # Biolerplate code to access an image
         # Set up data source
         self.datasource_id = f"exp={exp}:run={run}:{mode}"
         self.datasource    = psana.DataSource( self.datasource_id )
         self.run_current   = next(self.datasource.runs())
-        self.timestamps    = self.run_current.times()
+        self.timestamps    = self.load_timestamps()
 
         # Set up detector
         self.detector = psana.Detector(detector_name)
 
+        # Serialize access to psana, which isn't thread-safe...
+        self.lock = threading.Lock()
 
-    def get(self, event_num, multipanel = None, mode = "image"):
-        # Fetch the timestamp according to event number...
-        timestamp = self.timestamps[int(event_num)]
 
-        # Access each event based on timestamp...
-        event = self.run_current.event(timestamp)
+    def load_timestamps(self):
+        ''' Return timestamps of all events, from `path_timestamps` if it's
+            been saved before.
+        '''
+        if self.path_timestamps is not None and os.path.exists(self.path_timestamps):
+            # Each row is (seconds, nanoseconds, fiducial)...
+            timestamp_array = np.load(self.path_timestamps)
+            timestamps = [ psana.EventTime(int((sec << 32) | nsec), int(fid)) for sec, nsec, fid in timestamp_array.tolist() ]
+
+            return timestamps
+
+        timestamps = self.run_current.times()
+
+        if self.path_timestamps is not None:
+            timestamp_array = np.array([ (t.seconds(), t.nanoseconds(), t.fiducial()) for t in timestamps ], dtype = 'uint64')
+
+            # Write through a file handle so that `np.save` doesn't append .npy...
+            with open(self.path_timestamps, 'wb') as fh:
+                np.save(fh, timestamp_array)
+
+        return timestamps
+
+
+    def get_pixel_index_map(self):
+        ''' Return the flat index of each panel pixel in the assembled image,
+            and the shape of the assembled image.
+        '''
+        key = (self.exp, self.run, self.detector_name)
+        if key not in PsanaImg.pixel_index_map_cache:
+            # Same geometry used by `detector.image`, i.e. img[iX, iY] = calib...
+            iX, iY = self.detector.indexes_xy(int(self.run))
+            iX, iY = np.asarray(iX).ravel(), np.asarray(iY).ravel()
+
+            shape    = (int(iX.max()) + 1, int(iY.max()) + 1)
+            flat_idx = np.ravel_multi_index((iX, iY), shape)
+
+            PsanaImg.pixel_index_map_cache[key] = (flat_idx, shape)
+
+        return PsanaImg.pixel_index_map_cache[key]
+
+
+    def assemble(self, multipanel, out = None, is_batch = None):
+        ''' Assemble one event (panel, H, W) or a batch of events
+            (B, panel, H, W) into images with a single scatter.  A batch is
+            told by its 4 dimensions unless `is_batch` says otherwise, e.g.
+            for single-panel detectors.
+
+            Pass a preallocated `out` of shape (H_img, W_img) or
+            (B, H_img, W_img) to reuse the output buffer.  Pixels outside of
+            panels are left untouched in a reused buffer.
+        '''
+        flat_idx, shape = self.get_pixel_index_map()
+
+        multipanel = np.asarray(multipanel)
+        is_batch   = multipanel.ndim == 4 if is_batch is None else is_batch
+        num_batch  = len(multipanel) if is_batch else 1
+
+        if out is None: out = np.zeros((num_batch, ) + shape, dtype = multipanel.dtype)
+
+        out_flat = out.reshape(num_batch, -1)
+        out_flat[:, flat_idx] = multipanel.reshape(num_batch, -1)
+
+        return out if is_batch else out.reshape(shape)
 
+
+    def get(self, event_num, multipanel = None, mode = "image"):
         # Only three modes are supported...
-        assert mode in ("raw", "image", "calib"), f"Mode {mode} is not allowed!!!  Only 'raw' or 'image' are supported."
+        assert mode in ("raw", "image", "calib"), f"Mode {mode} is not allowed!!!  Only 'raw', 'image' or 'calib' are supported."
+
+        with self.lock:
+            # Fetch the timestamp according to event number...
+            timestamp = self.timestamps[int(event_num)]
+
+            # Access each event based on timestamp...
+            event = self.run_current.event(timestamp)
+
+            # Fetch image data based on timestamp from detector...
+            if mode != "image":
+                read = { "raw"   : self.detector.raw,
+                         "calib" : self.detector.calib }
+                img = read[mode](event) if multipanel is None else read[mode](event, multipanel)
+
+                return img
+
+            if multipanel is None: multipanel = self.detector.calib(event)
+
+        # Assemble calibrated panels using the cached pixel index map...
+        return None if multipanel is None else self.assemble(multipanel)
+
+
+    def get_batch(self, event_num_list, mode = "image", out = None):
+        ''' Return images of many events stacked along the first axis.  Events
+            without data are filled with zeros.
+        '''
+        read = { "raw"   : self.detector.raw,
+                 "calib" : self.detector.calib,
+                 "image" : self.detector.calib }
+
+        multipanel_list = []
+        with self.lock:
+            for event_num in event_num_list:
+                event      = self.run_current.event(self.timestamps[int(event_num)])
+                multipanel = read[mode](event)
+                multipanel_list.append(multipanel)
+
+        # Fill missing events with zeros...
+        shape_panel = next((i.shape for i in multipanel_list if i is not None), None)
+        if shape_panel is None: return None
+        multipanel_list = [ np.zeros(shape_panel, dtype = 'float32') if i is None else i for i in multipanel_list ]
+        multipanel_list = np.stack(multipanel_list)
+
+        if mode != "image": return multipanel_list
+
+        return self.assemble(multipanel_list, out = out, is_batch = True)
+
+
+
+
+
+class PsanaPrefetcher:
+    """
+    Fetch and calibrate psana events on background threads ahead of the
+    consumer.
+
+    At most `depth` events are in flight or held, so memory stays bounded.
+    psana access itself is serialized by `PsanaImg.lock`; image assembly and
+    the consumer run concurrently with it.
+
+    - `get(event_num)` serves browsing and schedules the following events.
+    - `iter(event_num_list)` streams (event_num, img) in order for exports.
+    """
+
+    def __init__(self, psana_img, mode = "image", num_workers = 1, depth = 16):
+        self.psana_img   = psana_img
+        self.mode        = mode
+        self.num_workers = num_workers
+        self.depth       = depth
+
+        # Internal variables...
+        self.executor    = ThreadPoolExecutor(max_workers = num_workers)
+        self.future_dict = OrderedDict()
+
+        return None
+
+
+    def submit(self, event_num):
+        ''' Schedule an event unless it's scheduled already, and make it the
+            most recently used one.
+        '''
+        if event_num in self.future_dict:
+            self.future_dict.move_to_end(event_num)
+
+            return self.future_dict[event_num]
+
+        self.future_dict[event_num] = self.executor.submit(self.psana_img.get, event_num, mode = self.mode)
+
+        # Forget the least recently used events beyond the depth...
+        while len(self.future_dict) > self.depth:
+            _, future = self.future_dict.popitem(last = False)
+            future.cancel()
+
+        return self.future_dict[event_num]
+
 
-        # Fetch image data based on timestamp from detector...
-        read = { "image" : self.detector.image,
-                 "calib" : self.detector.calib }
-        img = read[mode](event) if multipanel is None else read[mode](event, multipanel)
+    def get(self, event_num, num_ahead = None):
+        num_event = len(self.psana_img.timestamps)
+        num_ahead = self.depth - 1 if num_ahead is None else min(num_ahead, self.depth - 1)
 
-        return img
+        future = self.submit(event_num)
 
+        # Schedule upcoming events, those already in flight are refreshed so
+        # that only events behind are evicted...
+        for event_num_next in range(event_num + 1, min(event_num + 1 + num_ahead, num_event)):
+            self.submit(event_num_next)
+
+        return future.result()
+
+
+    def iter(self, event_num_list):
+        future_queue = deque()
+        for event_num in event_num_list:
+            future_queue.append((event_num, self.executor.submit(self.psana_img.get, event_num, mode = self.mode)))
+
+            if len(future_queue) >= self.depth:
+                event_num_done, future = future_queue.popleft()
+                yield event_num_done, future.result()
+
+        while future_queue:
+            event_num_done, future = future_queue.popleft()
+            yield event_num_done, future.result()
+
+
+    def close(self):
+        for future in self.future_dict.values(): future.cancel()
+        self.future_dict.clear()
+        self.executor.shutdown(wait = True)
+
+        return None
 
 
 
@@ -194,3 +463,257 @@ def apply_mask(data, mask, mask_value = np.nan):
     data_masked = np.where(mask, data, mask_value)
 
     return data_masked
+
+
+
+
+# Bit-packed labels store layer `encode` (1, 2, ...) in bit `encode - 1`, so
+# overlapping layers fit in one uint8 (8 layers) or uint16 (16 layers) per
+# pixel.  0 stays the background.  Index-coded labels store one layer per
+# pixel.  Editing functions below work in place and accept a boolean `where`.
+BITPLANE_DTYPE = { 8 : np.uint8, 16 : np.uint16 }
+
+def get_bitplane(encode):
+    return 1 << (encode - 1)
+
+
+
+
+def index_to_bitplane(label, num_bitplane = 8):
+    ''' Convert an index-coded label into a bit-packed one.
+    '''
+    dtype = BITPLANE_DTYPE[num_bitplane]
+    label = np.asarray(label)
+
+    label_packed = np.zeros(label.shape, dtype = dtype)
+    is_labeled   = (label > 0) & (label <= num_bitplane)
+    label_packed[is_labeled] = dtype(1) << (label[is_labeled].astype(dtype) - 1)
+
+    return label_packed
+
+
+
+
+def bitplane_to_index(label, layer_order):
+    ''' Convert a bit-packed label into an index-coded one, where layers
+        later in `layer_order` win on overlapping pixels.
+    '''
+    label_index = np.zeros(label.shape, dtype = 'uint8')
+    for encode in layer_order:
+        if encode == 0: continue
+        label_index[(label & get_bitplane(encode)) != 0] = encode
+
+    return label_index
+
+
+
+
+def has_layer(label, encode, label_mode = 'index'):
+    if encode == 0 or label_mode != 'bitplane': return label == encode
+
+    return (label & get_bitplane(encode)) != 0
+
+
+
+
+def set_layer(label, encode, where = True, label_mode = 'index'):
+    if label_mode == 'bitplane':
+        np.bitwise_or(label, label.dtype.type(get_bitplane(encode)), out = label, where = where)
+    else:
+        np.copyto(label, encode, where = where)
+
+    return label
+
+
+
+
+def clear_layer(label, encode = None, where = True, label_mode = 'index'):
+    ''' Clear one layer, or all layers if `encode` is None.
+    '''
+    if encode is None:
+        np.copyto(label, 0, where = where)
+    elif label_mode == 'bitplane':
+        np.bitwise_and(label, np.invert(label.dtype.type(get_bitplane(encode))), out = label, where = where)
+    else:
+        np.copyto(label, 0, where = np.logical_and(where, label == encode))
+
+    return label
+
+
+
+
+def toggle_layer(label, encode, where = True, label_mode = 'index'):
+    if label_mode == 'bitplane':
+        np.bitwise_xor(label, label.dtype.type(get_bitplane(encode)), out = label, where = where)
+    else:
+        is_on = label == encode
+        np.copyto(label, 0     , where = np.logical_and(where,  is_on))
+        np.copyto(label, encode, where = np.logical_and(where, ~is_on))
+
+    return label
+
+
+
+
+# Radius maps keyed by (shape, center), computed once per detector geometry...
+RADIUS_MAP_CACHE = OrderedDict()
+RADIUS_MAP_CACHE_SIZE = 8
+
+def get_radius_map(shape, center = None):
+    ''' Return the read-only (H, W) map of pixel distances from `center`
+        (row, col), the image center by default.
+    '''
+    H, W = shape
+    if center is None: center = ((H - 1) / 2, (W - 1) / 2)
+
+    key = ((H, W), (float(center[0]), float(center[1])))
+    if key in RADIUS_MAP_CACHE:
+        RADIUS_MAP_CACHE.move_to_end(key)
+        return RADIUS_MAP_CACHE[key]
+
+    row = np.arange(H, dtype = np.float32) - np.float32(center[0])
+    col = np.arange(W, dtype = np.float32) - np.float32(center[1])
+    radius_map = np.sqrt(row[:, None]**2 + col[None, :]**2)
+    radius_map.flags.writeable = False
+
+    RADIUS_MAP_CACHE[key] = radius_map
+    if len(RADIUS_MAP_CACHE) > RADIUS_MAP_CACHE_SIZE: RADIUS_MAP_CACHE.popitem(last = False)
+
+    return radius_map
+
+
+
+
+def radius_to_q(radius, pixel_size, distance, wavelength):
+    ''' Convert radii in pixels into momentum transfer q = 4 pi sin(theta) / wavelength,
+        in the inverse unit of `wavelength`.  `pixel_size` and `distance`
+        share one unit.
+    '''
+    two_theta = np.arctan(np.asarray(radius) * pixel_size / distance)
+
+    return 4 * np.pi * np.sin(two_theta / 2) / wavelength
+
+
+
+
+def get_radial_profile(img, radius_map, mask = None, bin_size = 1.0):
+    ''' Return the mean intensity in rings of `bin_size` pixels, the ring i
+        covering [i * bin_size, (i + 1) * bin_size).
+    '''
+    bin_idx = (radius_map / bin_size).astype(np.int64).ravel()
+    weight  = np.asarray(img, dtype = np.float64).ravel()
+    count   = np.ones_like(weight)
+    if mask is not None:
+        mask    = np.asarray(mask, dtype = bool).ravel()
+        bin_idx = bin_idx[mask]
+        weight  = weight [mask]
+        count   = count  [mask]
+
+    profile_sum   = np.bincount(bin_idx, weights = weight)
+    profile_count = np.bincount(bin_idx, weights = count, minlength = len(profile_sum))
+
+    profile = np.zeros(len(profile_sum), dtype = np.float64)
+    np.divide(profile_sum, profile_count, out = profile, where = profile_count > 0)
+
+    return profile
+
+
+
+
+def suggest_rings(profile, bin_size = 1.0, size_window = 15, num_mad = 5.0):
+    ''' Return [(radius_min, radius_max), ...] of rings where the radial
+        profile stands out from its running median.
+    '''
+    profile = np.asarray(profile, dtype = np.float64)
+    if len(profile) < size_window: return []
+
+    # Running median as the baseline...
+    half     = size_window // 2
+    padded   = np.pad(profile, half, mode = 'edge')
+    baseline = np.median(np.lib.stride_tricks.sliding_window_view(padded, size_window), axis = 1)
+    residual = profile - baseline
+    mad      = np.median(np.abs(residual - np.median(residual)))
+    is_ring  = residual > num_mad * max(mad, np.finfo(np.float64).eps)
+
+    # Group consecutive ring bins...
+    edge_list = np.flatnonzero(np.diff(np.concatenate(([0], is_ring.astype(np.int8), [0]))))
+    ring_list = [ (float(idx_b * bin_size), float(idx_e * bin_size)) for idx_b, idx_e in zip(edge_list[0::2], edge_list[1::2]) ]
+
+    return ring_list
+
+
+
+
+def get_integral_image(img):
+    ''' Return summed-area tables of (sum, squared sum, number of unmasked
+        pixels) of a (H, W) image, each padded to (H + 1, W + 1) with a
+        leading zero row and column.  Masked pixels are zeros.
+    '''
+    img = np.asarray(img, dtype = np.float64)
+
+    integral_list = []
+    for arr in (img, img**2, (img != 0).astype(np.int32)):
+        integral = np.zeros((arr.shape[0] + 1, arr.shape[1] + 1), dtype = arr.dtype)
+        np.cumsum(arr, axis = 0, out = integral[1:, 1:])
+        np.cumsum(integral[1:, 1:], axis = 1, out = integral[1:, 1:])
+        integral_list.append(integral)
+
+    return tuple(integral_list)
+
+
+
+
+def get_box_sum(integral, x_b, x_e, y_b, y_e):
+    ''' Return the sum over [x_b, x_e) x [y_b, y_e) in O(1).
+    '''
+    return integral[x_e, y_e] - integral[x_b, y_e] - integral[x_e, y_b] + integral[x_b, y_b]
+
+
+
+
+def get_box_moments(integral_tuple, x_b, x_e, y_b, y_e):
+    ''' Return (sum, squared sum, number of unmasked pixels) in a box,
+        clipped to the image.
+    '''
+    size_x, size_y = integral_tuple[0].shape[0] - 1, integral_tuple[0].shape[1] - 1
+    x_b, x_e = min(max(x_b, 0), size_x), min(max(x_e, 0), size_x)
+    y_b, y_e = min(max(y_b, 0), size_y), min(max(y_e, 0), size_y)
+
+    return tuple(get_box_sum(integral, x_b, x_e, y_b, y_e) for integral in integral_tuple)
+
+
+
+
+def get_box_stats(integral_tuple, x_b, x_e, y_b, y_e):
+    ''' Return (sum, mean, std, number of unmasked pixels) in a box.
+    '''
+    total, total_sq, n = get_box_moments(integral_tuple, x_b, x_e, y_b, y_e)
+    if n == 0: return total, 0.0, 0.0, 0
+
+    mean = total / n
+    std  = np.sqrt(max(total_sq / n - mean**2, 0.0))
+
+    return total, mean, std, int(n)
+
+
+
+
+def get_local_stats(integral_tuple, x, y, half_size = 2, half_size_bg = 5):
+    ''' Return (integrated intensity, background, SNR) of the box of
+        `half_size` around (x, y), where the background comes from the ring
+        between it and the box of `half_size_bg`.
+    '''
+    total   , total_sq   , n    = get_box_moments(integral_tuple, x - half_size   , x + half_size    + 1, y - half_size   , y + half_size    + 1)
+    total_bg, total_sq_bg, n_bg = get_box_moments(integral_tuple, x - half_size_bg, x + half_size_bg + 1, y - half_size_bg, y + half_size_bg + 1)
+
+    # Ring = outer box - inner box...
+    n_ring = n_bg - n
+    if n_ring == 0: return total, 0.0, 0.0
+
+    bg_mean = (total_bg - total) / n_ring
+    bg_std  = np.sqrt(max((total_sq_bg - total_sq) / n_ring - bg_mean**2, 0.0))
+
+    intensity = total - n * bg_mean
+    snr       = intensity / (bg_std * np.sqrt(n)) if bg_std > 0 and n > 0 else 0.0
+
+    return intensity, bg_mean, snr
@@ -3,16 +3,57 @@
 
 import os
 import sys
+import copy
 import pickle
 import numpy as np
 
-from .utils import hex_to_rgb
+from .utils      import hex_to_rgb, has_layer, set_layer, clear_layer, toggle_layer, downsample, \
+                         get_radius_map, get_radial_profile, suggest_rings, get_box_stats, get_local_stats
+from .data       import save_state
+from .autosave   import Autosaver, list_recovery, read_recovery, remove_recovery
+from .pixelstats import load_mask
+from .objects    import ObjectIndex
+from .predict    import PredictionPool
+from .scheduler  import build_scheduler
+from .session    import get_path_edit_log
+from .filmstrip  import ThumbnailPool, block_reduce_label, colorize_thumbnail
+from .tiles      import TileLayer, get_changed_tiles, get_overview_step
+
+from scipy.spatial import cKDTree
 
 import pyqtgraph as pg
 
 from pyqtgraph    import LabelItem, ImageItem, SignalProxy, PolyLineROI, GraphicsLayoutWidget
 from pyqtgraph.Qt import QtWidgets, QtCore, QtGui
 
+class SaveWorker(QtCore.QThread):
+    ''' Run `func(path, progress_callback)` on a worker thread so that the
+        UI stays responsive during a save.
+    '''
+    sigProgress = QtCore.Signal(int, int)
+    sigDone     = QtCore.Signal(str, str)    # (path, error message)
+
+    def __init__(self, func, path):
+        super().__init__()
+
+        self.func = func
+        self.path = path
+
+        return None
+
+
+    def run(self):
+        msg_error = ""
+        try:
+            self.func(self.path, self.sigProgress.emit)
+        except Exception as e:
+            msg_error = repr(e)
+
+        self.sigDone.emit(self.path, msg_error)
+
+
+
+
 class Window(QtWidgets.QMainWindow):
     def __init__(self, layout, data_manager):
         super().__init__()
@@ -47,20 +88,96 @@ class Window(QtWidgets.QMainWindow):
 
         self.layer_panel = { 'wgt' : None, 'panel' : None }
 
+        # Labeled objects of the current frame and the selected ones...
+        self.object_index        = None
+        self.object_index_idx    = None
+        self.selected_id_list    = []
+        self.selection_item_list = []
+
+        # Peak candidates of the current frame for peak-to-peak navigation...
+        self.candidate      = None
+        self.uses_nearest   = False
+        self.candidate_item = pg.ScatterPlotItem(size = 16, pen = pg.mkPen('c', width = 2), brush = None, symbol = 'o')
+        self.layout.viewer_img.getView().addItem(self.candidate_item)
+
+        # Model predictions shown next to labels...
+        self.prediction_pool  = None
+        self.timer_predict    = None
+        self.shows_prediction = True
+        self.prediction_idx   = None
+        self.prediction_item  = ImageItem(None)
+        self.layout.viewer_img.getView().addItem(self.prediction_item)
+        if self.data_manager.predictor is not None: self.setupPrediction()
+
+        # Upload only tiles in view for large frames...
+        self.image_tiles     = None
+        self.label_tiles     = None
+        self.label_tiled     = None
+        self.label_tiled_key = None
+        if self.data_manager.uses_tiles: self.setupTiles()
+
+        # Serve the most informative frames first if model outputs exist...
+        self.scheduler        = None
+        self.schedule_history = []
+        if self.data_manager.uses_scheduler: self.toggleScheduler()
+
         self.requires_overlay = True
         self.uses_auto_range = True
 
         self.proxy_click = None
         self.proxy_moved = None
 
+        self.save_worker     = None
+        self.num_edit_saving = 0
+
+        # Autosave edited labels for crash recovery...
+        self.autosaver        = None
+        self.autosave_worker  = None
+        self.timer_autosave   = None
+        self.num_edit_unsaved = 0
+        if getattr(self.data_manager, 'autosave_interval', 0) > 0 or self.data_manager.dir_session is not None: self.setupAutosave()
+
+        # Thumbnails of frames around the current one...
+        self.filmstrip              = None
+        self.thumbnail_pool         = None
+        self.timer_filmstrip        = None
+        self.thumbnail_icon_idx_set = set()
+        if self.data_manager.uses_filmstrip: self.setupFilmstrip()
+
         self.fetchMousePosition()
 
         self.dispImg()
 
+        # Poll growing CXI files in live-follow mode...
+        self.timer_follow = None
+        if getattr(self.data_manager, 'follows_live', False):
+            self.timer_follow = QtCore.QTimer(self)
+            self.timer_follow.timeout.connect(self.followLive)
+            self.timer_follow.start(int(self.data_manager.follow_interval * 1000))
+
         return None
 
 
     def closeEvent(self, event):
+        # Let a running save finish...
+        if self.save_worker is not None: self.save_worker.wait()
+
+        if self.prediction_pool is not None: self.prediction_pool.close()
+        if self.thumbnail_pool  is not None:
+            self.timer_filmstrip.stop()
+            self.thumbnail_pool.close()
+
+        # Keep the recovery logs only if there are edits not in a saved state,
+        # edit logs of a session are always kept...
+        if self.autosaver is not None:
+            if self.timer_autosave is not None: self.timer_autosave.stop()
+            self.waitCheckpoint()
+
+            if self.num_edit_unsaved > 0 or self.data_manager.dir_session is not None:
+                self.autosaver.flush()
+            else:
+                remove_recovery(self.autosaver.path_recovery)
+
         QtWidgets.QApplication.closeAllWindows()
         event.accept()
 
@@ -78,6 +195,17 @@ class Window(QtWidgets.QMainWindow):
         QtWidgets.QShortcut(QtCore.Qt.Key_S    , self, self.switchOffOverlay)
         QtWidgets.QShortcut(QtCore.Qt.Key_A    , self, self.resetRange)
         QtWidgets.QShortcut(QtCore.Qt.Key_T    , self, self.toggleAutoRange)
+        QtWidgets.QShortcut(QtCore.Qt.Key_O    , self, self.ringMaskDialog)
+        QtWidgets.QShortcut(QtCore.Qt.Key_I    , self, self.switchToRecStatsMode)
+        QtWidgets.QShortcut(QtCore.Qt.Key_K    , self, self.switchToObjectSelectMode)
+        QtWidgets.QShortcut(QtCore.Qt.Key_X    , self, self.deleteSelectedObjects)
+        QtWidgets.QShortcut(QtCore.Qt.Key_Y    , self, self.reclassifySelectedObjects)
+        QtWidgets.QShortcut(QtCore.Qt.Key_BracketRight, self, self.nextPeak)
+        QtWidgets.QShortcut(QtCore.Qt.Key_BracketLeft , self, self.prevPeak)
+        QtWidgets.QShortcut(QtCore.Qt.Key_J    , self, self.togglePeakOrder)
+        QtWidgets.QShortcut(QtCore.Qt.Key_W    , self, self.togglePrediction)
+        QtWidgets.QShortcut(QtCore.Qt.Key_U    , self, self.acceptPrediction)
+        QtWidgets.QShortcut(QtCore.Qt.Key_Q    , self, self.toggleScheduler)
 
 
     def showLayerPanel(self):
@@ -121,9 +249,13 @@ class Window(QtWidgets.QMainWindow):
     def switchOffOverlay(self):
         if self.requires_overlay:
             # Overlay label...
-            label = self.label
-            empty_mask = np.zeros(label.shape[-2:] + (4, ), dtype = 'uint8')
-            self.label_item.setImage(empty_mask, levels = [0, 128])
+            if self.label_tiles is not None:
+                self.label_tiles.clear()
+                self.label_tiled_key = None
+            else:
+                label = self.label
+                empty_mask = np.zeros(label.shape[-2:] + (4, ), dtype = 'uint8')
+                self.label_item.setImage(empty_mask, levels = [0, 128])
             self.requires_overlay = False
         else:
             self.dispImg(requires_refresh_img = False)
@@ -143,13 +275,20 @@ class Window(QtWidgets.QMainWindow):
             x = int(x_pos)
             y = int(y_pos)
 
+            # ImageItem is column-major by default, the 1st axis is x...
             img = self.img[0]
 
             size_x, size_y = img.shape
             x = min(max(x, 0), size_x - 1)
             y = min(max(y, 0), size_y - 1)
 
-            self.layout.viewer_img.getView().setTitle(f"Sequence number: {self.idx_img}/{self.num_img - 1}  |  ({x_pos:6.2f}, {y_pos:6.2f}, {img[x, y]:12.6f})")
+            # Local statistics around the cursor in O(1)...
+            dm = self.data_manager
+            integral_tuple = dm.get_integral_image(self.idx_img, img)
+            intensity, bg, snr = get_local_stats(integral_tuple, x, y, dm.stats_half_size, dm.stats_half_size_bg)
+
+            self.layout.viewer_img.getView().setTitle(f"Sequence number: {self.idx_img}/{self.num_img - 1}  |  ({x_pos:6.2f}, {y_pos:6.2f}, {img[x, y]:12.6f})"
+                                                      f"  |  I: {intensity:.1f}, bg: {bg:.2f}, SNR: {snr:.1f}")
 
 
     def switchOffMouseMode(self):
@@ -164,6 +303,14 @@ class Window(QtWidgets.QMainWindow):
         self.proxy_click = SignalProxy(self.layout.viewer_img.getView().scene().sigMouseClicked, slot = self.mouseClickedToLabelRange)
 
 
+    def switchToRecStatsMode(self):
+        self.proxy_click = SignalProxy(self.layout.viewer_img.getView().scene().sigMouseClicked, slot = self.mouseClickedToStatsRange)
+
+
+    def switchToObjectSelectMode(self):
+        self.proxy_click = SignalProxy(self.layout.viewer_img.getView().scene().sigMouseClicked, slot = self.mouseClickedToSelectObject)
+
+
     def switchToROILabelMode(self):
         ## self.roi_code = 1
         self.uses_roi_eraser = False    # [COMPRIMISED SOLUION]
@@ -181,11 +328,13 @@ class Window(QtWidgets.QMainWindow):
         x = int(mouse_pos.x())
         y = int(mouse_pos.y())
 
-        label = self.label    # (1, H, W)
-        layer_active = self.data_manager.layer_manager['layer_active']
-        size_x, size_y = label.shape[-2:]
-        if x < size_x and y < size_y:
-            label[0, x, y] = 0 if label[0, x, y] == layer_active else layer_active
+        # Clicks outside of the image don't edit...
+        size_x, size_y = self.label.shape[-2:]
+        if 0 <= x < size_x and 0 <= y < size_y:
+            label = self.get_label_to_edit()    # (1, H, W)
+            layer_active = self.data_manager.layer_manager['layer_active']
+            toggle_layer(label[0, x:x+1, y:y+1], layer_active, label_mode = self.data_manager.label_mode)
+            self.mark_edited()
 
         self.dispImg(requires_refresh_img = False, requires_refresh_layers = True)
 
@@ -201,7 +350,7 @@ class Window(QtWidgets.QMainWindow):
         if len(self.two_click_pos_list) == 2:
             (x_0, y_0), (x_1, y_1) = self.two_click_pos_list
 
-            label = self.label    # (1, H, W)
+            label = self.get_label_to_edit()    # (1, H, W)
             layer_active = self.data_manager.layer_manager['layer_active']
             size_x, size_y = label.shape[-2:]
 
@@ -213,14 +362,64 @@ class Window(QtWidgets.QMainWindow):
             x_b, x_e = sorted([x_0, x_1])
             y_b, y_e = sorted([y_0, y_1])
 
-            label_selected    = label[0, x_b:x_e+1, y_b:y_e+1]
-            label_selected[:] = layer_active if np.all(label_selected == 0) == True else 0
-            label[0, x_b:x_e+1, y_b:y_e+1] = label_selected
+            # Fill an empty range, otherwise clear it...
+            # Only the active layer is touched in bit-packed labels
+            label_mode     = self.data_manager.label_mode
+            label_selected = label[0, x_b:x_e+1, y_b:y_e+1]
+            if label_mode == 'bitplane':
+                is_empty = not np.any(has_layer(label_selected, layer_active, label_mode))
+                if is_empty: set_layer  (label_selected, layer_active, label_mode = label_mode)
+                else       : clear_layer(label_selected, layer_active, label_mode = label_mode)
+            else:
+                label_selected[:] = layer_active if np.all(label_selected == 0) == True else 0
+            self.mark_edited()
 
             self.dispImg(requires_refresh_img = False, requires_refresh_layers = True)
             self.two_click_pos_list = []
 
 
+    def mouseClickedToStatsRange(self, event):
+        ''' Report statistics inside a rectangle given by two clicks.
+        '''
+        mouse_pos = self.layout.viewer_img.getView().vb.mapSceneToView(event[0].scenePos())
+
+        self.two_click_pos_list.append((int(mouse_pos.x()), int(mouse_pos.y())))
+
+        if len(self.two_click_pos_list) == 2:
+            (x_0, y_0), (x_1, y_1) = self.two_click_pos_list
+
+            x_b, x_e = sorted([x_0, x_1])
+            y_b, y_e = sorted([y_0, y_1])
+
+            integral_tuple = self.data_manager.get_integral_image(self.idx_img, self.img[0])
+            total, mean, std, n = get_box_stats(integral_tuple, x_b, x_e + 1, y_b, y_e + 1)
+
+            msg = f"[{x_b}:{x_e+1}, {y_b}:{y_e+1}]  sum: {total:.1f}, mean: {mean:.3f}, std: {std:.3f}, pixels: {n}"
+            print(msg)
+            self.statusBar().showMessage(msg)
+            self.two_click_pos_list = []
+
+
+    def mouseClickedToSelectObject(self, event):
+        ''' Add the clicked object to the selection, or remove it if it's
+            already selected.
+        '''
+        mouse_pos = self.layout.viewer_img.getView().vb.mapSceneToView(event[0].scenePos())
+
+        object_index = self.get_object_index()
+        object_id    = object_index.hit_test(int(mouse_pos.x()), int(mouse_pos.y()))
+        if object_id is None: return None
+
+        if object_id in self.selected_id_list:
+            self.selected_id_list.remove(object_id)
+        else:
+            self.selected_id_list.append(object_id)
+        self.drawSelection()
+
+        obj = object_index.object_dict[object_id]
+        self.statusBar().showMessage(f"Object {object_id}: layer {obj['encode']}, {obj['num_pixel']} pixels at ({obj['centroid'][0]:.1f}, {obj['centroid'][1]:.1f}), {len(self.selected_id_list)} selected")
+
+
     def mouseClickedToLabelROI(self, event):
         mouse_pos = self.layout.viewer_img.getView().vb.mapSceneToView(event[0].scenePos())
 
@@ -257,7 +456,7 @@ class Window(QtWidgets.QMainWindow):
         self.layout.viewer_img.getView().addItem(self.roi_item)
 
         # Fetch image, label and mask...
-        label = self.label
+        label = self.get_label_to_edit()
         layer_active = self.data_manager.layer_manager['layer_active']
 
         # Fetch the right ROI...
@@ -266,7 +465,7 @@ class Window(QtWidgets.QMainWindow):
         # Find the values and coordinates of the ROI...
         # mask is an array of 0 or 1
         canvas = np.ones(label.shape[-2:], dtype = 'int8')
-        roi_patch, coords = self.roi_item.getArrayRegion(canvas, self.layout.viewer_img.getImageItem(), returnMappedCoords = True)
+        roi_patch, coords = self.roi_item.getArrayRegion(canvas, self.label_item, returnMappedCoords = True)
         roi_patch = roi_patch.astype(bool)
 
         ## from PyQt5.QtCore import pyqtRemoveInputHook, pyqtRestoreInputHook
@@ -285,15 +484,16 @@ class Window(QtWidgets.QMainWindow):
         idx_y = np.minimum(np.maximum(idx_y, 0), size_y - 1)
         idx_x = np.minimum(np.maximum(idx_x, 0), size_x - 1)
 
-        # !!! FUTURE IDEA !!! 
-        # Use the 0th-dim for saving multiple labels
-        ## roi[0][idx_y, idx_x] = np.logical_or (roi[0][idx_y, idx_x], layer_active * roi_patch) if not self.uses_roi_eraser else \
-        ##                        np.logical_and(roi[0][idx_y, idx_x], 1 - roi_patch)
-        ## label[0][idx_y, idx_x] = layer_active
-
+        # Bit-packed labels keep other layers under the ROI, and the eraser
+        # only clears the active layer...
+        label_mode  = self.data_manager.label_mode
         label_patch = label[0][idx_y, idx_x]
-        label_patch[roi_patch] = layer_active if not self.uses_roi_eraser else 0
+        if not self.uses_roi_eraser:
+            set_layer(label_patch, layer_active, where = roi_patch, label_mode = label_mode)
+        else:
+            clear_layer(label_patch, layer_active if label_mode == 'bitplane' else None, where = roi_patch, label_mode = label_mode)
         label[0][idx_y, idx_x] = label_patch
+        self.mark_edited()
 
         self.dispImg(requires_refresh_img = False, requires_refresh_layers = True)
 
@@ -301,6 +501,40 @@ class Window(QtWidgets.QMainWindow):
         self.pen_click_pos_list = []
 
 
+    def ringMaskDialog(self):
+        ''' Fill (or erase in the eraser mode) the active layer in rings
+            around the beam center, e.g. ice or powder rings.
+        '''
+        radius_map = get_radius_map(self.img.shape[-2:], self.data_manager.beam_center)
+
+        # Suggest rings from the radial profile of unmasked pixels...
+        img       = self.img[0]
+        profile   = get_radial_profile(img, radius_map, mask = img != 0)
+        ring_list = suggest_rings(profile)
+        text      = ", ".join(f"{r_min:g}-{r_max:g}" for r_min, r_max in ring_list)
+
+        text, is_ok = QtWidgets.QInputDialog.getText(self, "Mask rings", "Rings in pixels (r_min-r_max, ...)", text = text)
+        if not is_ok or not text.strip(): return None
+
+        is_ring = np.zeros(radius_map.shape, dtype = bool)
+        for ring in text.split(","):
+            r_min, r_max = [ float(r) for r in ring.split("-") ]
+            is_ring |= (radius_map >= r_min) & (radius_map < r_max)
+
+        label = self.get_label_to_edit()
+        layer_active = self.data_manager.layer_manager['layer_active']
+        label_mode   = self.data_manager.label_mode
+        if not self.uses_roi_eraser:
+            set_layer(label[0], layer_active, where = is_ring, label_mode = label_mode)
+        else:
+            clear_layer(label[0], layer_active if label_mode == 'bitplane' else None, where = is_ring, label_mode = label_mode)
+        self.mark_edited()
+
+        self.dispImg(requires_refresh_img = False, requires_refresh_layers = True)
+
+        return None
+
+
     def config(self):
         self.setCentralWidget(self.layout.area)
         self.resize(700, 700)
@@ -327,14 +561,545 @@ class Window(QtWidgets.QMainWindow):
         return None
 
 
+    def get_edit_key(self, uses_static = None):
+        ''' Return the key of the label to edit, the static key of the
+            current frame if the active layer is static, unless `uses_static`
+            says otherwise.
+        '''
+        dm = self.data_manager
+        if uses_static is None: uses_static = dm.is_static_layer(dm.layer_manager['layer_active'])
+
+        return dm.get_static_key(self.idx_img) if uses_static else self.idx_img
+
+
+    def get_label_to_edit(self, uses_static = None):
+        ''' Return the label to edit, detached from any pending save.  It's
+            the static label shared by frames if the active layer is static,
+            unless `uses_static` says otherwise.
+
+            Call `mark_edited` once it's actually edited.
+        '''
+        dm = self.data_manager
+        k  = self.get_edit_key(uses_static)
+        if isinstance(k, tuple):
+            label = dm.detach_static_label(k, self.label)
+        else:
+            self.label = dm.detach_label(self.idx_img, self.label)
+            label = self.label
+
+        return label
+
+
+    def mark_edited(self, uses_static = None):
+        ''' Count an edit of the label given by `get_label_to_edit` and queue
+            it for the autosave.
+        '''
+        k = self.get_edit_key(uses_static)
+
+        # Labeled frames leave the schedule...
+        if not isinstance(k, tuple) and self.scheduler is not None: self.scheduler.mark_done(self.idx_img)
+
+        self.num_edit_unsaved += 1
+        if self.autosaver is not None: self.autosaver.mark_dirty(k)
+
+        return None
+
+
+    ###############
+    ### OBJECTS ###
+    ###############
+    def get_object_index(self):
+        ''' Return labeled objects of the current frame, in sync with edits.
+        '''
+        if self.object_index is None or self.object_index_idx != self.idx_img:
+            dm = self.data_manager
+            layer_list = [ encode for encode in dm.layer_manager['layer_order'] if not dm.is_static_layer(encode) ]
+            self.object_index     = ObjectIndex(self.label[0], layer_list, dm.label_mode)
+            self.object_index_idx = self.idx_img
+        else:
+            self.object_index.update(self.label[0])
+
+        return self.object_index
+
+
+    def drawSelection(self):
+        view = self.layout.viewer_img.getView()
+        for item in self.selection_item_list: view.removeItem(item)
+        self.selection_item_list = []
+
+        for object_id in self.selected_id_list:
+            x_b, x_e, y_b, y_e = self.object_index.object_dict[object_id]["bbox"]
+            item = QtWidgets.QGraphicsRectItem(x_b, y_b, x_e - x_b, y_e - y_b)
+            item.setPen(pg.mkPen('y', width = 2, cosmetic = True))
+            view.addItem(item)
+            self.selection_item_list.append(item)
+
+        return None
+
+
+    def clearSelection(self):
+        self.selected_id_list = []
+        self.drawSelection()
+
+        return None
+
+
+    def editSelectedObjects(self, encode_new = None):
+        ''' Delete selected objects, or move them to layer `encode_new`.
+        '''
+        if not self.selected_id_list: return None
+
+        object_index = self.get_object_index()
+        label        = self.get_label_to_edit(uses_static = False)
+        label_mode   = self.data_manager.label_mode
+        for object_id in self.selected_id_list:
+            obj = object_index.object_dict.get(object_id)
+            if obj is None: continue
+
+            (x_b, x_e, y_b, y_e), mask = object_index.get_mask(object_id)
+            label_patch = label[0, x_b:x_e, y_b:y_e]
+            clear_layer(label_patch, obj["encode"], where = mask, label_mode = label_mode)
+            if encode_new is not None: set_layer(label_patch, encode_new, where = mask, label_mode = label_mode)
+        self.mark_edited(uses_static = False)
+
+        print(f"{len(self.selected_id_list)} objects are {'deleted' if encode_new is None else f'moved to layer {encode_new}'}.")
+        self.clearSelection()
+        self.dispImg(requires_refresh_img = False, requires_refresh_layers = True)
+
+        return None
+
+
+    def deleteSelectedObjects(self):
+        self.editSelectedObjects()
+
+        return None
+
+
+    def reclassifySelectedObjects(self):
+        dm = self.data_manager
+        layer_active = dm.layer_manager['layer_active']
+        if layer_active == 0 or dm.is_static_layer(layer_active):
+            print(f"Objects can't be moved to layer {layer_active}.")
+            return None
+
+        self.editSelectedObjects(encode_new = layer_active)
+
+        return None
+
+
+    ############
+    ### PEAK ###
+    ############
+    def get_candidate(self):
+        ''' Return peak candidates of the current frame, loaded on first use.
+            Candidates come from the CXI peak table, or from peak objects in
+            the label if the table is empty.
+        '''
+        if self.candidate is not None and self.candidate["idx_img"] == self.idx_img: return self.candidate
+
+        position, intensity = self.data_manager.get_peak_candidates(self.idx_img)
+        if len(position) == 0:
+            object_index = self.get_object_index()
+            obj_list     = [ obj for obj in object_index.object_dict.values() if obj["encode"] == 1 ]
+            position     = np.array([ obj["centroid"] for obj in obj_list ], dtype = np.float64).reshape(-1, 2)
+            intensity    = np.zeros(len(position), dtype = np.float64)
+
+        # Read intensities off the image if the table has none...
+        if len(position) > 0 and not np.any(intensity):
+            img = self.img[0]
+            idx_x = np.clip(np.round(position[:, 0]).astype(int), 0, img.shape[0] - 1)
+            idx_y = np.clip(np.round(position[:, 1]).astype(int), 0, img.shape[1] - 1)
+            intensity = img[idx_x, idx_y].astype(np.float64)
+
+        self.candidate = { "idx_img"  : self.idx_img,
+                           "position" : position,
+                           "order"    : np.argsort(-intensity, kind = 'stable'),
+                           "tree"     : cKDTree(position) if len(position) > 0 else None,
+                           "history"  : [],
+                           "visited"  : set(), }
+
+        return self.candidate
+
+
+    def togglePeakOrder(self):
+        self.uses_nearest = not self.uses_nearest
+        self.statusBar().showMessage(f"Peak navigation by {'nearest neighbor' if self.uses_nearest else 'intensity'}", 5000)
+
+        return None
+
+
+    def nextPeak(self):
+        candidate = self.get_candidate()
+        num_peak  = len(candidate["position"])
+        if num_peak == 0: return None
+
+        if self.uses_nearest:
+            # Nearest unvisited candidate from the center of the view...
+            (x_b, x_e), (y_b, y_e) = self.layout.viewer_img.getView().vb.viewRange()
+            center = ((x_b + x_e) / 2 - 0.5, (y_b + y_e) / 2 - 0.5)
+            if len(candidate["visited"]) == num_peak: candidate["visited"] = set()
+            k = min(len(candidate["visited"]) + 1, num_peak)
+            _, i_list = candidate["tree"].query(center, k = k)
+            i = next(i for i in np.atleast_1d(i_list).tolist() if i not in candidate["visited"])
+            rank = int(np.flatnonzero(candidate["order"] == i)[0])
+        else:
+            # Next brightest one, with rollover...
+            rank = candidate["history"][-1][1] + 1 if candidate["history"] else 0
+            rank = rank if rank < num_peak else 0
+            i    = int(candidate["order"][rank])
+
+        candidate["history"].append((i, rank))
+        candidate["visited"].add(i)
+        self.centerOnPeak(i)
+
+        return None
+
+
+    def prevPeak(self):
+        candidate = self.get_candidate()
+        if len(candidate["history"]) < 2: return None
+
+        candidate["history"].pop()
+        i, _ = candidate["history"][-1]
+        self.centerOnPeak(i)
+
+        return None
+
+
+    def centerOnPeak(self, i):
+        ''' Recenter the view on candidate `i`, keeping the zoom and the
+            image on display.
+        '''
+        candidate = self.candidate
+        x, y = candidate["position"][i] + 0.5
+
+        vb = self.layout.viewer_img.getView().vb
+        (x_b, x_e), (y_b, y_e) = vb.viewRange()
+        half_x, half_y = (x_e - x_b) / 2, (y_e - y_b) / 2
+        vb.setRange(xRange = (x - half_x, x + half_x), yRange = (y - half_y, y + half_y), padding = 0)
+
+        self.candidate_item.setData([x], [y])
+        self.statusBar().showMessage(f"Peak {i} of {len(candidate['position'])} at ({x - 0.5:.1f}, {y - 0.5:.1f})")
+
+        return None
+
+
+    ##################
+    ### PREDICTION ###
+    ##################
+    def setupPrediction(self):
+        dm = self.data_manager
+        self.prediction_pool = PredictionPool(dm.predictor,
+                                              num_workers = dm.predict_workers,
+                                              num_cache   = dm.predict_cache,
+                                              threshold   = dm.predict_threshold)
+
+        # Show predictions as soon as they arrive...
+        self.timer_predict = QtCore.QTimer(self)
+        self.timer_predict.timeout.connect(self.refresh_prediction)
+        self.timer_predict.start(100)
+
+        return None
+
+
+    def schedulePrediction(self):
+        ''' Predict the current frame and those ahead of navigation.
+        '''
+        idx_list = [ (self.idx_img + i) % self.num_img for i in range(self.data_manager.predict_ahead + 1) ]
+        self.prediction_pool.cancel(idx_list)
+
+        for idx in idx_list:
+            if self.prediction_pool.has(idx): continue
+
+            # Only the current frame is in memory, workers read the others...
+            _, event_idx, fh = self.data_manager.idx_list[idx]
+            img = self.img[0] if idx == self.idx_img else None
+            self.prediction_pool.submit(idx, fh, event_idx, img)
+
+        return None
+
+
+    def refresh_prediction(self):
+        if self.prediction_pool is None: return None
+
+        pred = self.prediction_pool.get(self.idx_img) if self.shows_prediction else None
+        if pred is None:
+            if self.prediction_idx is not None: self.prediction_item.clear()
+            self.prediction_idx = None
+            return None
+
+        if self.prediction_idx == self.idx_img: return None
+
+        r, g, b = hex_to_rgb(self.data_manager.predict_color)
+        overlay = np.zeros(pred.shape + (4, ), dtype = 'uint8')
+        overlay[pred != 0] = (r, g, b, 80)
+        self.prediction_item.setImage(overlay, levels = [0, 128])
+        self.prediction_idx = self.idx_img
+
+        return None
+
+
+    def togglePrediction(self):
+        self.shows_prediction = not self.shows_prediction
+        self.prediction_idx   = -1
+        self.refresh_prediction()
+
+        return None
+
+
+    def acceptPrediction(self):
+        ''' Add predicted layers of the current frame to its label.
+        '''
+        if self.prediction_pool is None: return None
+
+        pred = self.prediction_pool.get(self.idx_img)
+        if pred is None:
+            print(f"Prediction of frame {self.idx_img} isn't ready yet.")
+            return None
+
+        dm         = self.data_manager
+        label      = self.get_label_to_edit(uses_static = False)
+        label_mode = dm.label_mode
+        for encode in np.unique(pred).tolist():
+            if encode == 0 or encode not in dm.layer_manager['layer_metadata'] or dm.is_static_layer(encode): continue
+            set_layer(label[0], encode, where = pred == encode, label_mode = label_mode)
+        self.mark_edited(uses_static = False)
+
+        self.dispImg(requires_refresh_img = False, requires_refresh_layers = True)
+
+        return None
+
+
+    def toggleScheduler(self):
+        if self.scheduler is not None:
+            self.scheduler        = None
+            self.schedule_history = []
+            self.statusBar().showMessage("Frames in the original order", 5000)
+
+            return None
+
+        dm = self.data_manager
+        self.scheduler = build_scheduler(dm, dm.dir_model_output, dm.schedule_score)
+
+        # Frames labeled so far are done...
+        for idx in dm.label_dict: self.scheduler.mark_done(idx)
+        self.scheduler.mark_done(self.idx_img)
+        self.statusBar().showMessage(f"{len(self.scheduler)} frames scheduled by {dm.schedule_score}", 5000)
+
+        return None
+
+
+    #################
+    ### FILMSTRIP ###
+    #################
+    def setupFilmstrip(self):
+        dm = self.data_manager
+        self.thumbnail_pool = ThumbnailPool(dm.thumbnail_bin, dm.label_mode, dm.num_bitplane,
+                                            num_workers = dm.thumbnail_workers,
+                                            num_cache   = dm.thumbnail_cache,
+                                            dir_cache   = dm.dir_thumbnail,
+                                            cache_bytes = int(dm.thumbnail_cache_mb * 1024**2))
+
+        self.filmstrip = self.layout.config_filmstrip(dm.thumbnail_size)
+        self.extendFilmstrip()
+        self.filmstrip.currentRowChanged.connect(self.goFilmstripFrame)
+        self.filmstrip.horizontalScrollBar().valueChanged.connect(self.requestThumbnails)
+
+        # Show thumbnails as soon as they arrive...
+        self.timer_filmstrip = QtCore.QTimer(self)
+        self.timer_filmstrip.timeout.connect(self.refreshFilmstrip)
+        self.timer_filmstrip.start(100)
+
+        return None
+
+
+    def extendFilmstrip(self):
+        for idx in range(self.filmstrip.count(), self.num_img):
+            item = QtWidgets.QListWidgetItem(str(idx))
+            item.setSizeHint(self.filmstrip.gridSize())
+            self.filmstrip.addItem(item)
+
+        return None
+
+
+    def goFilmstripFrame(self, row):
+        if row < 0 or row == self.idx_img: return None
+
+        self.idx_img = row
+        self.dispImg()
+
+        return None
+
+
+    def syncFilmstrip(self):
+        self.extendFilmstrip()
+
+        # Follow navigation without jumping back through goFilmstripFrame...
+        self.filmstrip.blockSignals(True)
+        self.filmstrip.setCurrentRow(self.idx_img)
+        self.filmstrip.blockSignals(False)
+        self.filmstrip.scrollToItem(self.filmstrip.item(self.idx_img), QtWidgets.QAbstractItemView.PositionAtCenter)
+
+        # Edited labels show up in the thumbnail...
+        if self.idx_img in self.data_manager.label_dict: self.setThumbnailIcon(self.idx_img)
+
+        self.requestThumbnails()
+
+        return None
+
+
+    def get_filmstrip_range(self):
+        ''' Return the range of frames to keep thumbnails of, the visible
+            ones and as many on each side.
+        '''
+        width_item  = max(self.filmstrip.gridSize().width(), 1)
+        num_visible = self.filmstrip.viewport().width() // width_item + 1
+        idx_first   = self.filmstrip.horizontalScrollBar().value() // width_item
+
+        return max(idx_first - num_visible, 0), min(idx_first + 2 * num_visible, self.num_img)
+
+
+    def requestThumbnails(self):
+        if self.filmstrip.count() == 0: return None
+
+        idx_b, idx_e = self.get_filmstrip_range()
+        idx_keep_set = set(range(idx_b, idx_e))
+        self.thumbnail_pool.cancel(idx_keep_set)
+
+        # Drop icons far away to bound the memory...
+        for idx in self.thumbnail_icon_idx_set - idx_keep_set: self.filmstrip.item(idx).setIcon(QtGui.QIcon())
+        self.thumbnail_icon_idx_set &= idx_keep_set
+
+        for idx in range(idx_b, idx_e):
+            if idx in self.thumbnail_icon_idx_set: continue
+
+            path_cxi, event_idx, fh = self.data_manager.idx_list[idx]
+            self.thumbnail_pool.submit(idx, path_cxi, event_idx, fh)
+            self.setThumbnailIcon(idx)
+
+        return None
+
+
+    def refreshFilmstrip(self):
+        idx_b, idx_e = self.get_filmstrip_range()
+        for idx in self.thumbnail_pool.collect():
+            if idx_b <= idx < idx_e: self.setThumbnailIcon(idx)
+
+        return None
+
+
+    def setThumbnailIcon(self, idx):
+        thumbnail = self.thumbnail_pool.get(idx)
+        if thumbnail is None: return None
+
+        dm = self.data_manager
+        img_thumb, label_thumb = thumbnail
+
+        # Edited labels override the segmask on disk...
+        label = dm.label_dict.get(idx)
+        if label is not None: label_thumb = block_reduce_label(label[0], dm.thumbnail_bin, dm.label_mode)
+        rgb = colorize_thumbnail(img_thumb, label_thumb, dm.layer_manager, dm.label_mode)
+
+        # Arrays are (x, y) in the viewer...
+        rgb    = np.ascontiguousarray(rgb.transpose(1, 0, 2))
+        h, w   = rgb.shape[:2]
+        qimage = QtGui.QImage(rgb.data, w, h, 3 * w, QtGui.QImage.Format_RGB888).copy()
+        pixmap = QtGui.QPixmap.fromImage(qimage).scaled(self.filmstrip.iconSize(), QtCore.Qt.KeepAspectRatio)
+        self.filmstrip.item(idx).setIcon(QtGui.QIcon(pixmap))
+        self.thumbnail_icon_idx_set.add(idx)
+
+        return None
+
+
+    #############
+    ### TILES ###
+    #############
+    def setupTiles(self):
+        dm   = self.data_manager
+        view = self.layout.viewer_img.getView().vb
+
+        # Image tiles sit on the downsampled frame and below all overlays...
+        self.layout.viewer_img.getImageItem().setZValue(-2)
+        self.image_tiles = TileLayer(view, dm.tile_size, z_value = -1.0, num_cache = dm.tile_cache, max_visible = dm.tile_max_visible, overview_size = dm.tile_overview_size)
+        self.label_tiles = TileLayer(view, dm.tile_size, z_value = -0.5, num_cache = dm.tile_cache, max_visible = dm.tile_max_visible, overview_size = dm.tile_overview_size)
+
+        # Follow the levels and colormap of the histogram...
+        hist = self.layout.viewer_img.getHistogramWidget().item
+        self.image_tiles.set_lookup_table(hist.getLookupTable)
+        hist.sigLevelsChanged.connect(lambda: self.image_tiles.set_levels(hist.getLevels()))
+        hist.sigLookupTableChanged.connect(lambda: self.image_tiles.set_lookup_table(hist.getLookupTable))
+
+        view.sigRangeChanged.connect(self.updateTiles)
+
+        return None
+
+
+    def updateTiles(self):
+        self.image_tiles.update()
+        self.label_tiles.update()
+
+        return None
+
+
+    def setTiledImage(self, img, levels):
+        ''' Show a downsampled frame in the viewer, which also drives the
+            histogram and auto range, and full resolution tiles on top.
+        '''
+        step = get_overview_step(img.shape, self.data_manager.tile_overview_size)
+        self.layout.viewer_img.setImage(downsample(img, step, step), levels = levels, autoRange = self.uses_auto_range,
+                                        transform = QtGui.QTransform.fromScale(step, step))
+        self.image_tiles.set_source(img.shape, lambda x_b, x_e, y_b, y_e: img[x_b:x_e, y_b:y_e], levels = levels)
+
+        return None
+
+
+    def setTiledLayers(self, label):
+        ''' Render label tiles in view, and only tiles with edits if the
+            frame and layer colors haven't changed.
+        '''
+        dm = self.data_manager
+        label_tiled_key = (self.idx_img, label.shape, dm.label_mode,
+                           tuple((encode, dm.layer_manager['layer_metadata'][encode]['color']) for encode in dm.layer_manager['layer_order']))
+
+        # Tiles are rendered from a copy, which is also the reference for
+        # finding edits next time...
+        label_tiled_old = self.label_tiled
+        self.label_tiled = label.copy()
+
+        if label_tiled_key == self.label_tiled_key:
+            self.label_tiles.invalidate(get_changed_tiles(label_tiled_old, label, dm.tile_size))
+        else:
+            self.label_tiles.set_source(label.shape,
+                                        lambda x_b, x_e, y_b, y_e: self.render_layers(self.label_tiled[x_b:x_e, y_b:y_e]),
+                                        overview_func = lambda step: self.render_layers(block_reduce_label(self.label_tiled, step, dm.label_mode)),
+                                        levels        = [0, 128])
+            self.label_tiled_key = label_tiled_key
+
+        return None
+
+
     ###############
     ### DIPSLAY ###
     ###############
     def refresh_layers(self):
-        # Turn label into a layer of shape (1, H, W, 4)...
+        label = self.data_manager.composite_label(self.idx_img, self.label)
+        if self.label_tiles is not None:
+            self.setTiledLayers(label[0])
+
+            return None
+
+        self.label_item.setImage(self.render_layers(label[0]), levels = [0, 128])
+
+
+    def render_layers(self, label):
+        # Turn label into a layer of shape (H, W, 4)...
         # The type is uint8 for pyqt visualization purpose
-        label  = self.label
-        layers = np.zeros(label.shape + (4, ), dtype = 'uint8')
+        label_mode = self.data_manager.label_mode
+        layers     = np.zeros(label.shape + (4, ), dtype = 'uint8')
+
+        # Sum up colors of all layers on each pixel...
+        rgb_sum   = np.zeros(label.shape + (3, ), dtype = 'uint16')
+        num_layer = np.zeros(label.shape, dtype = 'uint8')
 
         # Color them based on layer encoding in the layer metadata...
         for encode in self.data_manager.layer_manager['layer_order']:
@@ -343,21 +1108,28 @@ class Window(QtWidgets.QMainWindow):
 
             if color_hex == '#FFFFFF': continue
 
-            r, g, b = hex_to_rgb(color_hex)
+            is_on = has_layer(label, encode, label_mode)
 
-            layers[:, :, :, 0][label == encode] = r
-            layers[:, :, :, 1][label == encode] = g
-            layers[:, :, :, 2][label == encode] = b
-            layers[:, :, :, 3][label == encode] = 100
+            rgb_sum[is_on]   += np.array(hex_to_rgb(color_hex), dtype = 'uint16')
+            num_layer[is_on] += 1
 
-        self.label_item.setImage(layers[0], levels = [0, 128])
+        # Blend overlapping layers by averaging their colors...
+        is_labeled = num_layer > 0
+        layers[is_labeled, :3] = rgb_sum[is_labeled] // num_layer[is_labeled][:, None]
+        layers[is_labeled,  3] = 100
+
+        return layers
 
 
     def dispImg(self, requires_refresh_img = True, requires_refresh_layers = True):
         # Let idx_img bound within reasonable range....
         self.idx_img = min(max(0, self.idx_img), self.num_img - 1)
 
-        img, label = self.data_manager.get_img(self.idx_img)
+        # Selected objects and the peak marker belong to the frame on display...
+        if self.selected_id_list and self.idx_img != self.object_index_idx: self.clearSelection()
+        if self.candidate is not None and self.idx_img != self.candidate["idx_img"]: self.candidate_item.clear()
+
+        img, label = self.data_manager.get_img(self.idx_img, includes_static = False)
         self.img = img
         self.label = label
 
@@ -368,10 +1140,19 @@ class Window(QtWidgets.QMainWindow):
 
         if requires_refresh_img:
             # Display images...
-            self.layout.viewer_img.setImage(img[0], levels = levels, autoRange = self.uses_auto_range)
+            if self.image_tiles is not None:
+                self.setTiledImage(img[0], levels)
+            else:
+                self.layout.viewer_img.setImage(img[0], levels = levels, autoRange = self.uses_auto_range)
 
         if requires_refresh_layers: self.refresh_layers()
 
+        if self.prediction_pool is not None:
+            self.schedulePrediction()
+            self.refresh_prediction()
+
+        if self.filmstrip is not None: self.syncFilmstrip()
+
         # Display title...
         self.layout.viewer_img.getView().setTitle(f"Sequence number: {self.idx_img}/{self.num_img - 1}")
 
@@ -382,6 +1163,15 @@ class Window(QtWidgets.QMainWindow):
     ### NAVIGATION ###
     ##################
     def nextImg(self):
+        # Go to the most informative frame in the scheduler mode...
+        idx_next = self.scheduler.pop() if self.scheduler is not None else None
+        if idx_next is not None:
+            self.schedule_history.append(self.idx_img)
+            self.idx_img = idx_next
+            self.dispImg()
+
+            return None
+
         # Support rollover...
         idx_next = self.idx_img + 1
         self.idx_img = idx_next if idx_next < self.num_img else 0
@@ -392,6 +1182,13 @@ class Window(QtWidgets.QMainWindow):
 
 
     def prevImg(self):
+        # Retrace frames served by the scheduler...
+        if self.scheduler is not None and self.schedule_history:
+            self.idx_img = self.schedule_history.pop()
+            self.dispImg()
+
+            return None
+
         idx_img_current = self.idx_img
 
         # Support rollover...
@@ -405,22 +1202,157 @@ class Window(QtWidgets.QMainWindow):
         return None
 
 
+    def followLive(self):
+        idx_last = self.num_img - 1
+
+        num_new = self.data_manager.refresh_idx_list()
+        if num_new == 0: return None
+
+        self.num_img = len(self.data_manager.idx_list)
+        if self.filmstrip is not None: self.extendFilmstrip()
+
+        # Jump to the newest frame only if the annotator was at the last one...
+        if self.data_manager.auto_advance and self.idx_img == idx_last:
+            self.idx_img = self.num_img - 1
+            self.dispImg()
+        else:
+            self.layout.viewer_img.getView().setTitle(f"Sequence number: {self.idx_img}/{self.num_img - 1}")
+
+        return None
+
+
     ################
     ### MENU BAR ###
     ################
+    def setupAutosave(self):
+        dm = self.data_manager
+        path_recovery = os.path.join(dm.dir_autosave, f"{os.path.basename(dm.path_yaml)}.{self.username}.recovery")
+
+        # Edits of a multi-annotator session go to the annotator's own log...
+        if dm.dir_session is not None:
+            assert self.username is not None, "A username is required in a multi-annotator session!!!"
+            os.makedirs(dm.dir_session, exist_ok = True)
+            path_recovery = get_path_edit_log(dm.dir_session, self.username)
+
+        # Offer to restore edits from a session that didn't end cleanly, and
+        # always resume a multi-annotator session...
+        is_restored = False
+        if list_recovery(path_recovery):
+            label_state, time_state = read_recovery(path_recovery, returns_time = True)
+            reply = QtWidgets.QMessageBox.Yes if dm.dir_session is not None else \
+                    QtWidgets.QMessageBox.question(self, "Recover labels",
+                                                   f"Restore {len(label_state)} edited labels from {path_recovery}?")
+            if reply == QtWidgets.QMessageBox.Yes:
+                dm.restore_labels(label_state)
+                is_restored = True
+                print(f"{len(dm.label_dict)} edited frames and {len(dm.static_label_dict)} static labels are restored from {path_recovery}.")
+            else:
+                remove_recovery(path_recovery)
+
+        self.autosaver = Autosaver(dm, path_recovery,
+                                   budget_bytes = int(dm.autosave_budget_mb * 1024**2),
+                                   max_bytes    = int(dm.autosave_max_mb    * 1024**2))
+        if is_restored:
+            self.autosaver.adopt(list(dm.label_dict.keys()) + list(dm.static_label_dict.keys()), time_state)
+            self.num_edit_unsaved = len(dm.label_dict) + len(dm.static_label_dict)
+
+        # Without a timer, a session log is written on close...
+        if dm.autosave_interval > 0:
+            self.timer_autosave = QtCore.QTimer(self)
+            self.timer_autosave.timeout.connect(self.startCheckpoint)
+            self.timer_autosave.start(int(dm.autosave_interval * 1000))
+
+        return None
+
+
+    def startCheckpoint(self):
+        ''' Write an autosave checkpoint on a worker thread, skipped until
+            the previous one is finished.
+        '''
+        if self.autosaver.job is not None: return None
+        if not self.autosaver.begin_checkpoint(): return None
+
+        self.autosave_worker = SaveWorker(lambda path, progress_callback: self.autosaver.write_checkpoint(),
+                                          self.autosaver.job["path_log"])
+        self.autosave_worker.sigDone.connect(self.finishCheckpoint)
+        self.autosave_worker.start()
+
+        return None
+
+
+    def finishCheckpoint(self, path, msg_error):
+        if msg_error: print(f"Failed to autosave {path}: {msg_error}")
+
+        # A late signal of a checkpoint ended by `waitCheckpoint`...
+        if self.autosave_worker is not None and self.autosave_worker.isRunning(): return None
+
+        self.autosaver.end_checkpoint()
+
+        return None
+
+
+    def waitCheckpoint(self):
+        ''' Finish a checkpoint running on the worker thread.
+        '''
+        if self.autosave_worker is not None: self.autosave_worker.wait()
+        self.autosaver.end_checkpoint()
+
+        return None
+
+
+    def isSaving(self):
+        is_saving = self.save_worker is not None and self.save_worker.isRunning()
+        if is_saving: print("A save is still in progress, please try again later.")
+
+        return is_saving
+
+
+    def startSave(self, func, path):
+        self.save_worker = SaveWorker(func, path)
+        self.save_worker.sigProgress.connect(self.reportSaveProgress)
+        self.save_worker.sigDone.connect(self.finishSave)
+        self.save_worker.start()
+
+        self.statusBar().showMessage(f"Saving {path}...")
+
+        return None
+
+
+    def reportSaveProgress(self, num_done, num_total):
+        self.statusBar().showMessage(f"Saving {self.save_worker.path}: {num_done}/{num_total}")
+
+
+    def finishSave(self, path, msg_error):
+        # Labels can be edited in place again...
+        self.data_manager.release_snapshot()
+
+        if msg_error:
+            print(f"Failed to save {path}: {msg_error}")
+            self.statusBar().showMessage(f"Failed to save {path}")
+        else:
+            print(f"{path} saved")
+            self.statusBar().showMessage(f"{path} saved", 5000)
+
+            # Edits made during the save remain unsaved...
+            self.num_edit_unsaved -= self.num_edit_saving
+
+        self.num_edit_saving = 0
+
+        return None
+
+
     def saveStateDialog(self):
         path_pickle, is_ok = QtWidgets.QFileDialog.getSaveFileName(self, 'Save File', f'{self.timestamp}.pickle')
 
-        if is_ok:
-            obj_to_save = ( self.data_manager.layer_manager,
+        if is_ok and not self.isSaving():
+            obj_to_save = ( copy.deepcopy(self.data_manager.layer_manager),
                             self.data_manager.state_random,
                             self.idx_img,
-                            self.timestamp )
+                            self.timestamp,
+                            self.data_manager.snapshot_labels() )
 
-            with open(path_pickle, 'wb') as fh:
-                pickle.dump(obj_to_save, fh, protocol = pickle.HIGHEST_PROTOCOL)
-
-            print(f"{path_pickle} saved")
+            self.num_edit_saving = self.num_edit_unsaved
+            self.startSave(lambda path, progress_callback: save_state(path, obj_to_save, progress_callback), path_pickle)
 
         return None
 
@@ -428,7 +1360,8 @@ class Window(QtWidgets.QMainWindow):
     def loadStateDialog(self):
         path_pickle = QtWidgets.QFileDialog.getOpenFileName(self, 'Open File')[0]
 
-        if os.path.exists(path_pickle):
+        # Labels of a running save must stay unchanged...
+        if os.path.exists(path_pickle) and not self.isSaving():
             with open(path_pickle, 'rb') as fh:
                 obj_saved = pickle.load(fh)
                 self.data_manager.layer_manager = obj_saved[0]
@@ -436,8 +1369,44 @@ class Window(QtWidgets.QMainWindow):
                 self.idx_img                    = obj_saved[2]
                 self.timestamp                  = obj_saved[3]
 
-            self.dispImg()
+                # Edited labels are saved since the background save...
+                if len(obj_saved) > 4: self.data_manager.restore_labels(obj_saved[4])
+
+            # Labels are now those of the saved state, and the autosave
+            # starts over from them...
+            self.num_edit_unsaved = 0
+            if self.autosaver is not None:
+                dm = self.data_manager
+                self.waitCheckpoint()
+                self.autosaver.restart(list(dm.label_dict.keys()) + list(dm.static_label_dict.keys()))
+
             self.num_img = len(self.data_manager.idx_list)
+            self.dispImg()
+
+        return None
+
+
+    def importMaskDialog(self):
+        ''' Import a bad pixel mask proposed by `pixelstats` into the active
+            layer, or the first static layer if the active one isn't static.
+        '''
+        path_mask = QtWidgets.QFileDialog.getOpenFileName(self, 'Open File', filter = 'Masks (*.npz)')[0]
+        if not os.path.exists(path_mask): return None
+
+        dm = self.data_manager
+        layer_active = dm.layer_manager['layer_active']
+        encode_list  = [ encode for encode in [layer_active] + dm.layer_manager['layer_order'] if encode != 0 and dm.is_static_layer(encode) ]
+        if not encode_list:
+            print("No static layer to import the mask into, mark one with 'is_static' : True in the layer metadata.")
+            return None
+
+        key_set = dm.import_static_mask(load_mask(path_mask), encode_list[0])
+        self.num_edit_unsaved += len(key_set)
+        if self.autosaver is not None:
+            for k in key_set: self.autosaver.mark_dirty(k)
+
+        print(f"{path_mask} is imported into layer {encode_list[0]} of {len(key_set)} static labels.")
+        self.dispImg(requires_refresh_img = False, requires_refresh_layers = True)
 
         return None
 
@@ -474,6 +1443,7 @@ class Window(QtWidgets.QMainWindow):
 
         fileMenu.addAction(self.loadAction)
         fileMenu.addAction(self.saveAction)
+        fileMenu.addAction(self.importMaskAction)
         ## fileMenu.addAction(self.loadDataAction)
         ## fileMenu.addAction(self.saveDataAction)
 
@@ -493,6 +1463,9 @@ class Window(QtWidgets.QMainWindow):
         self.saveAction = QtWidgets.QAction(self)
         self.saveAction.setText("&Save State")
 
+        self.importMaskAction = QtWidgets.QAction(self)
+        self.importMaskAction.setText("&Import Mask")
+
         self.loadDataAction = QtWidgets.QAction(self)
         self.loadDataAction.setText("&Load Data")
 
@@ -508,6 +1481,7 @@ class Window(QtWidgets.QMainWindow):
     def connectAction(self):
         self.loadAction.triggered.connect(self.loadStateDialog)
         self.saveAction.triggered.connect(self.saveStateDialog)
+        self.importMaskAction.triggered.connect(self.importMaskDialog)
         ## self.loadDataAction.triggered.connect(self.loadDataDialog)
         ## self.saveDataAction.triggered.connect(self.saveDataDialog)
 
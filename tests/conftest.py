@@ -0,0 +1,67 @@
+import sys
+import types
+import subprocess
+
+import h5py
+import numpy as np
+import pytest
+
+# psana only exists at LCLS, code paths that use it get a fake psana
+# object in their tests...
+try:
+    import psana
+except ImportError:
+    sys.modules["psana"] = types.ModuleType("psana")
+
+from manual_peak_labeler.data import CXI_KEY
+
+
+@pytest.fixture
+def make_cxi(tmp_path):
+    ''' Return a function that writes a small CXI file with peaks of known
+        positions, one per event.
+    '''
+    def make(name = "run.cxi", num_event = 6, shape = (12, 10), mask_per_event = False):
+        path_cxi = str(tmp_path / name)
+        H, W = shape
+        rng  = np.random.default_rng(0)
+
+        data    = rng.random((num_event, H, W)).astype('float32')
+        segmask = np.zeros((num_event, H, W), dtype = 'uint8')
+        for event_idx in range(num_event):
+            y, x = 2 + event_idx % (H - 4), 3
+            segmask[event_idx, y:y + 2, x:x + 2] = 1
+            data   [event_idx, y:y + 2, x:x + 2] += 10
+        mask = np.ones((num_event, H, W) if mask_per_event else (H, W), dtype = 'uint8')
+
+        with h5py.File(path_cxi, 'w') as fh:
+            fh.create_dataset(CXI_KEY["data"]     , data = data)
+            fh.create_dataset(CXI_KEY["mask"]     , data = mask)
+            fh.create_dataset(CXI_KEY["segmask"]  , data = segmask)
+            fh.create_dataset(CXI_KEY["num_peaks"], data = np.arange(num_event) % 3)
+
+        return path_cxi
+
+    return make
+
+
+@pytest.fixture
+def hold_open():
+    ''' Return a function that keeps a file open in 'a' mode in another
+        process, like a running labeler, until the test ends.
+    '''
+    proc_list = []
+
+    def hold(path_cxi):
+        code = "import sys, h5py; fh = h5py.File(sys.argv[1], 'a'); print('ready', flush = True); sys.stdin.read()"
+        proc = subprocess.Popen([sys.executable, "-c", code, path_cxi], stdin = subprocess.PIPE, stdout = subprocess.PIPE, text = True)
+        assert proc.stdout.readline().strip() == "ready"
+        proc_list.append(proc)
+
+        return proc
+
+    yield hold
+
+    for proc in proc_list:
+        proc.stdin.close()
+        proc.wait()
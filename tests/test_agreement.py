@@ -0,0 +1,55 @@
+import pickle
+
+import numpy as np
+import yaml
+
+from manual_peak_labeler.agreement import get_confusion, get_kappa, get_iou, match_peaks, LabelSource, compute_agreement
+
+
+def test_identical_labels_agree_fully():
+    label     = np.array([[0, 1, 1], [2, 0, 0]])
+    confusion = get_confusion(label, label, num_class = 3)
+
+    assert confusion.tolist() == [[3, 0, 0], [0, 2, 0], [0, 0, 1]]
+    assert get_kappa(confusion) == 1.0
+    assert get_iou(confusion).tolist() == [1.0, 1.0, 1.0]
+
+
+def test_kappa_of_chance_agreement_is_zero():
+    label_a = np.array([0, 0, 1, 1])
+    label_b = np.array([0, 1, 0, 1])
+
+    assert np.isclose(get_kappa(get_confusion(label_a, label_b, num_class = 2)), 0.0)
+
+
+def test_peaks_match_as_mutual_nearest_centroids():
+    label_a = np.zeros((10, 10), dtype = 'uint8')
+    label_b = np.zeros((10, 10), dtype = 'uint8')
+    label_a[1, 1] = label_a[8, 8] = label_a[1, 8] = 1
+    label_b[2, 1] = label_b[8, 7] = 1
+
+    assert match_peaks(label_a, label_b, max_distance = 1.5) == (3, 2, 2)
+
+
+def test_agreement_is_the_same_for_any_chunk_size(make_cxi, tmp_path):
+    path_cxi  = make_cxi(num_event = 7)
+    path_yaml = str(tmp_path / "data.yaml")
+    with open(path_yaml, 'w') as fh: yaml.safe_dump({ "cxi" : [path_cxi] }, fh)
+
+    # Another annotator erased the peak of two frames...
+    label_state = { (path_cxi, event_idx) : np.zeros((1, 12, 10), dtype = 'uint8') for event_idx in (2, 5) }
+    path_state = str(tmp_path / "state.pickle")
+    with open(path_state, 'wb') as fh: pickle.dump((None, None, 0, "", label_state), fh)
+
+    source_list = [ LabelSource(path_yaml), LabelSource(path_state) ]
+    try:
+        result_list = [ compute_agreement(source_list, num_class = 2, chunk_size = chunk_size, num_workers = 1) for chunk_size in (1, 64) ]
+    finally:
+        for source in source_list: source.close()
+
+    (row_list, report), (row_list_chunked, report_chunked) = result_list
+    assert row_list == row_list_chunked and report == report_chunked
+    assert [ row["event_idx"] for row in row_list ] == [2, 5]
+    assert report["num_frame"] == 2
+    assert report["pair"]["0-1"]["peak"] == { "num_a" : 2, "num_b" : 0, "num_matched" : 0, "f1" : 0.0 }
+    assert report["pair"]["0-1"]["confusion"] == [[232, 0], [8, 0]]
@@ -0,0 +1,161 @@
+import os
+
+import numpy as np
+
+from manual_peak_labeler.autosave import Autosaver, list_recovery, read_recovery, iter_record
+
+
+class LabelDataManager:
+    ''' Edited labels of frames keyed by idx, like `PeakNetData`.
+    '''
+
+    def __init__(self):
+        self.label_dict               = {}
+        self.checkpoint_label_idx_set = set()
+
+    def get_edited_label(self, k):
+        return ("run.cxi", k), self.label_dict.get(k)
+
+    def share_checkpoint(self, k_list):
+        self.checkpoint_label_idx_set = set(k_list)
+
+    def release_checkpoint(self):
+        self.checkpoint_label_idx_set = set()
+
+
+def edit(dm, autosaver, idx, value, shape = (1, 32, 32)):
+    # Random labels don't compress, so records are about the size of labels...
+    label = np.random.default_rng(value).integers(0, 256, shape, dtype = 'uint8')
+    label[0, 0, 0] = value
+    dm.label_dict[idx] = label
+    autosaver.mark_dirty(idx)
+
+    return label
+
+
+def test_latest_labels_are_recovered(tmp_path):
+    dm        = LabelDataManager()
+    autosaver = Autosaver(dm, str(tmp_path / "recovery"))
+    edit(dm, autosaver, 0, 1)
+    edit(dm, autosaver, 1, 2)
+    assert autosaver.checkpoint() == 2
+
+    edit(dm, autosaver, 0, 3)
+    assert autosaver.checkpoint() == 1
+
+    label_state = read_recovery(autosaver.path_recovery)
+    assert { k : int(v[0, 0, 0]) for k, v in label_state.items() } == { ("run.cxi", 0) : 3, ("run.cxi", 1) : 2 }
+    assert dm.checkpoint_label_idx_set == set()
+
+
+def test_truncated_log_only_loses_the_last_record(tmp_path):
+    dm        = LabelDataManager()
+    autosaver = Autosaver(dm, str(tmp_path / "recovery"))
+    edit(dm, autosaver, 0, 1)
+    autosaver.checkpoint()
+    edit(dm, autosaver, 1, 2)
+    autosaver.checkpoint()
+
+    path_log = autosaver.get_path_log(autosaver.generation)
+    with open(path_log, 'r+b') as fh: fh.truncate(os.path.getsize(path_log) - 5)
+
+    assert list(read_recovery(autosaver.path_recovery)) == [("run.cxi", 0)]
+
+
+def test_frames_beyond_the_budget_wait_for_the_next_checkpoint(tmp_path):
+    dm        = LabelDataManager()
+    autosaver = Autosaver(dm, str(tmp_path / "recovery"), budget_bytes = 1)
+    for idx in range(3): edit(dm, autosaver, idx, idx + 1)
+
+    assert autosaver.checkpoint() == 1
+    assert list(autosaver.dirty_dict) == [1, 2]
+    assert autosaver.checkpoint() == 1
+    assert autosaver.checkpoint() == 1
+    assert autosaver.checkpoint() == 0
+
+
+def test_edits_during_a_checkpoint_are_written_next(tmp_path):
+    dm        = LabelDataManager()
+    autosaver = Autosaver(dm, str(tmp_path / "recovery"))
+    edit(dm, autosaver, 0, 1)
+
+    assert autosaver.begin_checkpoint()
+    assert dm.checkpoint_label_idx_set == {0}
+    edit(dm, autosaver, 0, 2)
+    autosaver.write_checkpoint()
+    assert autosaver.end_checkpoint() == 1
+
+    assert list(autosaver.dirty_dict) == [0]
+    autosaver.flush()
+    assert int(read_recovery(autosaver.path_recovery)[("run.cxi", 0)][0, 0, 0]) == 2
+
+
+def test_rotation_carries_frames_over_and_removes_the_old_log(tmp_path):
+    dm        = LabelDataManager()
+    autosaver = Autosaver(dm, str(tmp_path / "recovery"), max_bytes = 4 * 1024)
+    edit(dm, autosaver, 0, 1)
+    edit(dm, autosaver, 1, 2)
+    autosaver.checkpoint()
+    assert autosaver.generation == 0
+
+    # Outdated records make the log mostly garbage...
+    for value in range(3, 8):
+        edit(dm, autosaver, 0, value)
+        autosaver.checkpoint()
+        if autosaver.generation > 0: break
+    assert autosaver.generation == 1
+    assert autosaver.pending_set == {0, 1}
+
+    autosaver.flush()
+    assert [ generation for generation, _ in list_recovery(autosaver.path_recovery) ] == [1]
+
+    label_state = read_recovery(autosaver.path_recovery)
+    assert sorted(label_state) == [("run.cxi", 0), ("run.cxi", 1)]
+    assert int(label_state[("run.cxi", 1)][0, 0, 0]) == 2
+
+
+def test_times_of_edits_survive_adoption(tmp_path):
+    dm        = LabelDataManager()
+    autosaver = Autosaver(dm, str(tmp_path / "recovery"))
+    edit(dm, autosaver, 0, 1)
+    autosaver.time_dict[0] = 123.0
+    autosaver.flush()
+
+    label_state, time_state = read_recovery(autosaver.path_recovery, returns_time = True)
+    autosaver = Autosaver(dm, autosaver.path_recovery)
+    autosaver.adopt([0], time_state)
+    autosaver.flush()
+
+    assert autosaver.generation == 1
+    assert [ generation for generation, _ in list_recovery(autosaver.path_recovery) ] == [1]
+    assert [ record["time"] for _, record in iter_record(autosaver.get_path_log(1)) ] == [123.0]
+
+
+def test_unwritable_log_keeps_frames_dirty(tmp_path):
+    dm        = LabelDataManager()
+    autosaver = Autosaver(dm, str(tmp_path / "missing" / "recovery"))
+    edit(dm, autosaver, 0, 1)
+
+    assert autosaver.checkpoint() == 0
+    assert list(autosaver.dirty_dict) == [0]
+
+    autosaver.flush()
+    assert list(autosaver.dirty_dict) == [0]
+
+
+def test_restart_keeps_only_the_given_frames(tmp_path):
+    dm        = LabelDataManager()
+    autosaver = Autosaver(dm, str(tmp_path / "recovery"))
+    edit(dm, autosaver, 0, 1)
+    edit(dm, autosaver, 1, 2)
+    autosaver.checkpoint()
+    edit(dm, autosaver, 0, 3)
+
+    # Labels are replaced, e.g. by a loaded state...
+    dm.label_dict = { 2 : np.full((1, 32, 32), 4, dtype = 'uint8') }
+    autosaver.restart([2])
+    assert list(autosaver.dirty_dict) == [2]
+
+    autosaver.flush()
+    assert [ generation for generation, _ in list_recovery(autosaver.path_recovery) ] == [1]
+    assert list(read_recovery(autosaver.path_recovery)) == [("run.cxi", 2)]
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pytest
+
+from manual_peak_labeler.diskcache import DiskFrameCache
+
+
+@pytest.fixture
+def path_source(tmp_path):
+    path_source = tmp_path / "run.cxi"
+    path_source.write_bytes(b"frames")
+
+    return str(path_source)
+
+
+def test_cached_arrays_survive_a_restart(tmp_path, path_source):
+    arr   = np.arange(12, dtype = 'float32').reshape(3, 4)
+    cache = DiskFrameCache(str(tmp_path / "cache"), max_bytes = 1024**2)
+    assert cache.get(path_source, "data", 0) is None
+    cache.put(path_source, "data", 0, arr)
+    cache.close()
+
+    cache = DiskFrameCache(str(tmp_path / "cache"), max_bytes = 1024**2)
+    assert np.array_equal(cache.get(path_source, "data", 0), arr)
+    cache.close()
+
+
+def test_corrupted_blobs_are_never_served(tmp_path, path_source):
+    cache = DiskFrameCache(str(tmp_path / "cache"), max_bytes = 1024**2)
+    cache.put(path_source, "data", 0, np.ones(16))
+
+    key = cache.get_key(path_source, "data", 0)
+    with open(cache.get_path_blob(key), 'r+b') as fh: fh.write(b"\0\0\0\0")
+
+    assert cache.get(path_source, "data", 0) is None
+    assert not os.path.exists(cache.get_path_blob(key))
+    cache.close()
+
+
+def test_blobs_of_modified_sources_expire_with_the_stat(tmp_path, path_source):
+    cache = DiskFrameCache(str(tmp_path / "cache"), max_bytes = 1024**2, stat_ttl = 3600)
+    cache.put(path_source, "data", 0, np.ones(16))
+
+    with open(path_source, 'ab') as fh: fh.write(b"more frames")
+
+    # The memoized stat still matches until it's forgotten...
+    assert cache.get(path_source, "data", 0) is not None
+    cache.forget_source(path_source)
+    assert cache.get(path_source, "data", 0) is None
+    cache.close()
+
+
+def test_least_recently_used_blobs_are_evicted(tmp_path, path_source):
+    rng   = np.random.default_rng(0)
+    cache = DiskFrameCache(str(tmp_path / "cache"), max_bytes = 1024**2)
+    for event_idx in range(3): cache.put(path_source, "data", event_idx, rng.random(128))
+
+    # Room for three blobs...
+    nbytes, = cache.db.execute("SELECT MAX(nbytes) FROM entry").fetchone()
+    cache.max_bytes = 3 * nbytes
+
+    # Touch event 0 so that event 1 is the oldest...
+    cache.db.execute("UPDATE entry SET atime = atime - 100 WHERE key != ?", (cache.get_key(path_source, "data", 2), ))
+    cache.get(path_source, "data", 0)
+    cache.put(path_source, "data", 3, rng.random(128))
+
+    assert cache.get(path_source, "data", 1) is None
+    assert cache.get(path_source, "data", 0) is not None
+    assert cache.get(path_source, "data", 3) is not None
+    cache.close()
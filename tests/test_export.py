@@ -0,0 +1,70 @@
+import h5py
+import numpy as np
+
+from manual_peak_labeler import export
+from manual_peak_labeler.export import ShardExporter
+
+
+class ListDataManager:
+    ''' A data list of (image, label) like the one of `img_labeler`.
+    '''
+
+    def __init__(self, num_data):
+        rng = np.random.default_rng(0)
+        self.data_list = [ (rng.random((1, 6, 5)).astype('float32'), np.zeros((1, 6, 5), dtype = 'uint8')) for _ in range(num_data) ]
+
+    def get_img(self, idx):
+        return self.data_list[idx]
+
+
+def count_write_shard(monkeypatch):
+    path_list   = []
+    write_shard  = export.write_shard
+
+    def write_shard_counted(path_shard, *args, **kwargs):
+        path_list.append(path_shard)
+        return write_shard(path_shard, *args, **kwargs)
+
+    monkeypatch.setattr(export, "write_shard", write_shard_counted)
+
+    return path_list
+
+
+def test_export_writes_frames_in_order(tmp_path):
+    dm       = ListDataManager(num_data = 10)
+    exporter = ShardExporter(str(tmp_path), num_frame_per_shard = 4, num_workers = 2)
+    exporter.export(dm)
+
+    assert exporter.index["num_frame"] == 10
+    for shard_id, shard in exporter.index["shard"].items():
+        with h5py.File(tmp_path / shard["path"], 'r') as fh:
+            for i, idx in enumerate(range(int(shard_id) * 4, int(shard_id) * 4 + shard["num_frame"])):
+                assert np.array_equal(fh["image"][i], dm.data_list[idx][0])
+                assert np.array_equal(fh["label"][i], dm.data_list[idx][1])
+
+
+def test_export_resumes_only_shards_with_the_same_labels(tmp_path, monkeypatch):
+    dm = ListDataManager(num_data = 10)
+    ShardExporter(str(tmp_path), num_frame_per_shard = 4).export(dm)
+
+    path_list = count_write_shard(monkeypatch)
+    ShardExporter(str(tmp_path), num_frame_per_shard = 4).export(dm)
+    assert path_list == []
+
+    # A label edited after the export invalidates its shard only...
+    dm.data_list[5][1][0, 2, 2] = 1
+    exporter = ShardExporter(str(tmp_path), num_frame_per_shard = 4)
+    exporter.export(dm)
+    assert [ p.rsplit("/", 1)[-1] for p in path_list ] == ["shard_00001.h5"]
+
+    with h5py.File(tmp_path / "shard_00001.h5", 'r') as fh:
+        assert fh["label"][1][0, 2, 2] == 1
+
+
+def test_export_drops_stale_shards(tmp_path):
+    ShardExporter(str(tmp_path), num_frame_per_shard = 4).export(ListDataManager(num_data = 10))
+    exporter = ShardExporter(str(tmp_path), num_frame_per_shard = 4)
+    exporter.export(ListDataManager(num_data = 5))
+
+    assert sorted(exporter.index["shard"]) == ["0", "1"]
+    assert not (tmp_path / "shard_00002.h5").exists()
@@ -0,0 +1,95 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from img_labeler.data import PeakNetData, MmapDataList, save_data, load_data, is_typed_data, save_state
+
+
+class ConfigData:
+    def __init__(self, path_pnd):
+        self.path_pnd = path_pnd
+
+
+def make_data_list(num_data = 5):
+    rng = np.random.default_rng(0)
+
+    return [ (rng.random((1, 8, 6)).astype('float32'), rng.integers(0, 4, (1, 8, 6), dtype = 'uint8')) for _ in range(num_data) ]
+
+
+def test_typed_data_round_trip(tmp_path):
+    path_data = str(tmp_path / "frames.data")
+    data_list = make_data_list()
+    save_data(path_data, data_list)
+
+    assert is_typed_data(path_data)
+    data_loaded = load_data(path_data)
+    assert len(data_loaded) == len(data_list)
+    for (img, label), (img_loaded, label_loaded) in zip(data_list, data_loaded):
+        assert np.array_equal(img, img_loaded) and np.array_equal(label, label_loaded)
+
+
+def test_empty_data_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        save_data(str(tmp_path / "frames.data"), [])
+
+
+def test_edits_never_touch_the_data_file(tmp_path):
+    path_data = str(tmp_path / "frames.data")
+    save_data(path_data, make_data_list())
+
+    dm = PeakNetData(ConfigData(path_data))
+    _, label = dm.get_img(2)
+    label = dm.detach_label(2, label)
+    label[0, 0, 0] = 9
+
+    assert dm.get_img(2)[1][0, 0, 0] == 9
+    assert load_data(path_data)[2][1][0, 0, 0] != 9
+
+
+def test_snapshot_stays_unchanged_by_later_edits(tmp_path):
+    path_data = str(tmp_path / "frames.data")
+    save_data(path_data, make_data_list())
+    dm = PeakNetData(ConfigData(path_data))
+
+    label = dm.detach_label(1, dm.get_img(1)[1])
+    label[0, 0, 0] = 5
+    snapshot = dm.snapshot_labels()
+
+    label = dm.detach_label(1, dm.get_img(1)[1])
+    label[0, 0, 0] = 6
+    dm.release_snapshot()
+
+    assert snapshot[1][1][0, 0, 0] == 5
+    assert dm.get_img(1)[1][0, 0, 0] == 6
+
+
+def test_state_refers_to_the_data_file_with_edits_only(tmp_path):
+    path_data = str(tmp_path / "frames.data")
+    save_data(path_data, make_data_list(num_data = 50))
+    dm = PeakNetData(ConfigData(path_data))
+
+    label = dm.detach_label(3, dm.get_img(3)[1])
+    label[0, 1, 1] = 7
+
+    path_state = str(tmp_path / "state.pickle")
+    save_state(path_state, (dm.snapshot_labels(), ))
+    dm.release_snapshot()
+
+    with open(path_state, 'rb') as fh: data_list, = pickle.load(fh)
+    assert isinstance(data_list, MmapDataList)
+    assert data_list.is_edited(3) and not data_list.is_edited(4)
+    assert data_list[3][1][0, 1, 1] == 7
+    assert np.array_equal(data_list[4][1], dm.get_img(4)[1])
+    assert (tmp_path / "state.pickle").stat().st_size < 8 * 6 * 50
+
+
+def test_state_of_a_replaced_data_file_is_rejected(tmp_path):
+    path_data = str(tmp_path / "frames.data")
+    save_data(path_data, make_data_list())
+    data_list = load_data(path_data)
+    data_list.header["timestamp"] = "older"
+
+    blob = pickle.dumps(data_list)
+    with pytest.raises(AssertionError):
+        pickle.loads(blob)
@@ -0,0 +1,49 @@
+import numpy as np
+
+from manual_peak_labeler.objects import ObjectIndex
+
+
+def get_object_set(object_index):
+    return { (obj["encode"], obj["bbox"], obj["num_pixel"]) for obj in object_index.object_dict.values() }
+
+
+def test_incremental_updates_match_a_fresh_index():
+    rng   = np.random.default_rng(0)
+    label = (rng.random((24, 20)) < 0.2).astype('uint8') * rng.integers(1, 3, size = (24, 20)).astype('uint8')
+
+    object_index = ObjectIndex(label, [0, 1, 2])
+    for _ in range(20):
+        x, y = rng.integers(0, 22), rng.integers(0, 18)
+        label = label.copy()
+        label[x:x + 2, y:y + 2] = rng.integers(0, 3)
+        object_index.update(label)
+
+        assert get_object_set(object_index) == get_object_set(ObjectIndex(label, [1, 2]))
+
+
+def test_unchanged_label_is_not_relabeled():
+    label = np.zeros((8, 8), dtype = 'uint8')
+    label[2:4, 2:4] = 1
+
+    assert ObjectIndex(label, [1]).update(label.copy()) == 0
+
+
+def test_hit_test_prefers_the_top_layer_and_falls_back_to_nearest_centroid():
+    label = np.zeros((16, 16), dtype = 'uint8')
+    label[2:5, 2:5] = 1
+    label[3, 3]     = 1 | 2
+    label[10, 10]   = 2
+
+    object_index = ObjectIndex(label, [1, 2], label_mode = 'bitplane')
+    id_top       = object_index.hit_test(3, 3)
+    id_bottom    = object_index.hit_test(2, 2)
+
+    assert object_index.object_dict[id_top]["encode"]    == 2
+    assert object_index.object_dict[id_bottom]["encode"] == 1
+    assert object_index.object_dict[id_bottom]["num_pixel"] == 9
+
+    bbox, mask = object_index.get_mask(id_bottom)
+    assert bbox == (2, 5, 2, 5) and mask.all()
+
+    assert object_index.hit_test(11, 12, max_distance = 3.0) == object_index.hit_test(10, 10)
+    assert object_index.hit_test(15, 0,  max_distance = 3.0) is None
@@ -0,0 +1,34 @@
+import h5py
+import numpy as np
+
+from manual_peak_labeler.data  import CXI_KEY
+from manual_peak_labeler.peaks import find_peaks, write_peak_tables, get_path_sidecar
+
+
+def test_find_peaks_weights_centroids_by_intensity():
+    label = np.zeros((8, 8), dtype = 'uint8')
+    label[1:3, 1:3] = 1
+    label[5, 6]     = 1
+    img = np.zeros((8, 8))
+    img[1, 1], img[2, 2], img[5, 6] = 1, 3, 2
+
+    y, x, intensity = find_peaks(img, label)
+
+    assert np.allclose(y, [1.75, 5])
+    assert np.allclose(x, [1.75, 6])
+    assert np.allclose(intensity, [4, 2])
+
+
+def test_sidecar_is_written_while_a_labeler_holds_the_file(make_cxi, hold_open, tmp_path):
+    path_cxi = make_cxi(num_event = 5)
+    hold_open(path_cxi)
+
+    # An edit removes the peak of event 1...
+    label_state = { (path_cxi, 1) : np.zeros((1, 12, 10), dtype = 'uint8') }
+    dir_output  = str(tmp_path)
+    num_event, num_peak = write_peak_tables(path_cxi, label_state, dir_output = dir_output, chunk_size = 2)
+
+    assert (num_event, num_peak) == (5, 4)
+    with h5py.File(get_path_sidecar(path_cxi, dir_output), 'r') as fh:
+        assert fh[CXI_KEY["num_peaks"]][()].tolist() == [1, 0, 1, 1, 1]
+        assert np.allclose(fh[CXI_KEY["peak_y"]][[0, 2], 0], [2.5, 4.5], atol = 0.1)
@@ -0,0 +1,65 @@
+import h5py
+import numpy as np
+
+from manual_peak_labeler.data import CXI_KEY
+from manual_peak_labeler.pixelstats import PixelStats, compute_pixel_stats, save_mask, load_mask
+
+
+def test_merged_batches_match_stats_of_all_frames():
+    rng       = np.random.default_rng(0)
+    img_batch = rng.normal(100, 10, size = (11, 4, 5))
+
+    stats_list = []
+    for i_b, i_e in ((0, 1), (1, 5), (5, 11)):
+        stats = PixelStats((4, 5), threshold = 110)
+        stats.update(img_batch[i_b:i_e])
+        stats_list.append(stats)
+    stats = stats_list[0].merge(stats_list[1]).merge(stats_list[2])
+
+    assert stats.count == 11
+    assert np.allclose(stats.mean, img_batch.mean(axis = 0))
+    assert np.allclose(stats.get_variance(), img_batch.var(axis = 0, ddof = 1))
+    assert np.array_equal(stats.max, img_batch.max(axis = 0))
+    assert np.array_equal(stats.num_above, (img_batch > 110).sum(axis = 0))
+
+
+def test_proposed_mask_flags_dead_and_hot_pixels():
+    rng       = np.random.default_rng(0)
+    img_batch = rng.normal(100, 10, size = (20, 6, 6))
+    img_batch[:, 0, 0] = 0
+    img_batch[:, 5, 5] = 1e4
+
+    stats = PixelStats((6, 6), threshold = 1e3)
+    stats.update(img_batch)
+    mask  = stats.propose_mask()
+
+    assert mask[0, 0] and mask[5, 5]
+    assert mask.sum() == 2
+
+
+def test_parallel_chunks_match_the_run(make_cxi):
+    path_cxi = make_cxi(num_event = 7)
+
+    # Mask the left half of the detector...
+    with h5py.File(path_cxi, 'a') as fh:
+        mask = fh.get(CXI_KEY["mask"])
+        mask[:, :5] = 1
+        mask[:, 5:] = 0
+        data = fh.get(CXI_KEY["data"])[()] * (1 - mask[()])
+
+    stats_dict = compute_pixel_stats({ path_cxi : list(range(7)) }, threshold = 5, chunk_size = 2, batch_size = 1, num_workers = 2)
+    stats      = stats_dict[None]
+
+    assert stats.count == 7
+    assert np.allclose(stats.mean, data.mean(axis = 0))
+    assert np.allclose(stats.get_variance(), data.var(axis = 0, ddof = 1))
+    assert np.array_equal(stats.num_above, (data > 5).sum(axis = 0))
+
+
+def test_masks_round_trip(tmp_path):
+    mask_dict = { None : np.eye(3, dtype = bool), "run.cxi" : np.ones((3, 3), dtype = bool) }
+    save_mask(str(tmp_path / "mask.npz"), mask_dict)
+    mask_dict_loaded = load_mask(str(tmp_path / "mask.npz"))
+
+    assert mask_dict_loaded.keys() == mask_dict.keys()
+    for k, mask in mask_dict.items(): assert np.array_equal(mask_dict_loaded[k], mask)
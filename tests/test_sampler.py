@@ -0,0 +1,53 @@
+import yaml
+import numpy as np
+
+from manual_peak_labeler.sampler import StratifiedReservoirSampler, iter_cxi_metadata, sample_cxi
+
+
+def test_reservoirs_are_bounded_per_stratum():
+    sampler = StratifiedReservoirSampler(num_sample_per_stratum = 3, seed = 0)
+    for i in range(0, 100, 10):
+        record_list = list(range(i, i + 10))
+        sampler.add(record_list, [ record % 4 for record in record_list ])
+
+    selected_dict = sampler.get_selected()
+    assert sorted(selected_dict) == [0, 1, 2, 3]
+    assert sampler.num_seen_dict == { 0 : 25, 1 : 25, 2 : 25, 3 : 25 }
+    for stratum, record_list in selected_dict.items():
+        assert len(record_list) == 3
+        assert all(record % 4 == stratum for record in record_list)
+
+
+def test_selection_only_depends_on_the_seed():
+    def draw(seed):
+        sampler = StratifiedReservoirSampler(num_sample_per_stratum = 5, bin_edges = [2.5, 7.5], seed = seed)
+        sampler.add(list(range(1000)), np.arange(1000) % 10)
+
+        return sampler.get_selected()
+
+    assert draw(1) == draw(1)
+    assert draw(1) != draw(2)
+    assert sorted(draw(1)) == [0, 1, 2]
+
+
+def test_metadata_is_read_while_a_labeler_holds_the_file(make_cxi, hold_open):
+    path_cxi = make_cxi(num_event = 7)
+    hold_open(path_cxi)
+
+    chunk_list = list(iter_cxi_metadata([path_cxi], chunk_size = 3))
+    assert [ event_idx_list.tolist() for _, event_idx_list, _ in chunk_list ] == [[0, 1, 2], [3, 4, 5], [6]]
+    assert np.concatenate([ value_list for _, _, value_list in chunk_list ]).tolist() == [0, 1, 2, 0, 1, 2, 0]
+
+
+def test_sample_cxi_writes_an_index(make_cxi, tmp_path):
+    path_cxi  = make_cxi(num_event = 9)
+    path_yaml = tmp_path / "data.yaml"
+    path_yaml.write_text(yaml.safe_dump({ "cxi" : [path_cxi] }))
+
+    path_index = tmp_path / "index.yaml"
+    sample_cxi(str(path_yaml), str(path_index), num_sample_per_stratum = 2, seed = 0)
+
+    index = yaml.safe_load(path_index.read_text())
+    assert index["cxi"] == [path_cxi]
+    assert len(index["event"][path_cxi]) == 6
+    assert index["sampler"]["num_seen"] == { 0 : 3, 1 : 3, 2 : 3 }
@@ -0,0 +1,46 @@
+import h5py
+import numpy as np
+
+from manual_peak_labeler.data import CXI_KEY
+from manual_peak_labeler.scheduler import FrameScheduler, get_entropy_score, score_model_output, build_scheduler, get_path_model_output
+
+
+class IdxDataManager:
+    def __init__(self, idx_list):
+        self.idx_list = idx_list
+
+
+def test_scheduler_pops_by_latest_score_and_skips_done_frames():
+    scheduler = FrameScheduler()
+    scheduler.update([0, 1, 2, 3], [0.1, 0.9, 0.5, 0.3])
+    scheduler.update([3], [1.0])
+    scheduler.mark_done(1)
+
+    assert len(scheduler) == 3
+    assert [ scheduler.pop() for _ in range(4) ] == [3, 2, 0, None]
+    assert len(scheduler) == 0
+
+
+def test_scores_are_the_same_for_dense_and_sparse_batches():
+    rng     = np.random.default_rng(0)
+    dataset = rng.random((40, 4, 4)).astype(np.float32)
+
+    event_idx_list = [1, 2, 3, 5, 30, 39]
+    score_list     = get_entropy_score(dataset[event_idx_list])
+    for batch_size in (1, 3, 64):
+        assert np.allclose(score_model_output(dataset, event_idx_list, batch_size = batch_size), score_list)
+
+
+def test_sidecar_outputs_schedule_the_most_uncertain_frame_first(tmp_path):
+    path_cxi = str(tmp_path / "run.cxi")
+    prob     = np.full((4, 4, 4), 0.01, dtype = np.float32)
+    prob[2]  = 0.5
+    with h5py.File(get_path_model_output(path_cxi, str(tmp_path)), 'w') as fh:
+        fh.create_dataset(CXI_KEY["model_output"], data = prob)
+
+    # Frames of a file without model outputs are left out...
+    idx_list     = [ (path_cxi, event_idx, None) for event_idx in (3, 2, 0) ] + [ (str(tmp_path / "other.cxi"), 0, None) ]
+    scheduler    = build_scheduler(IdxDataManager(idx_list), dir_model_output = str(tmp_path), batch_size = 2)
+
+    assert len(scheduler) == 3
+    assert scheduler.pop() == 1
@@ -0,0 +1,67 @@
+import zlib
+import pickle
+
+import numpy as np
+
+from manual_peak_labeler.autosave import read_recovery
+from manual_peak_labeler.session  import assign_shards, list_edit_log, get_path_edit_log, resolve_conflict, merge_edit_logs
+
+
+def write_edit_log(dir_session, username, label_dict):
+    ''' Write {(path_cxi, event_idx) : (time, label)} as a one generation
+        edit log.
+    '''
+    with open(f"{get_path_edit_log(dir_session, username)}.0", 'wb') as fh:
+        for key, (time_edit, label) in label_dict.items():
+            record = { "key"   : key,
+                       "shape" : label.shape,
+                       "dtype" : label.dtype.str,
+                       "blob"  : zlib.compress(label.tobytes(), 1),
+                       "time"  : time_edit, }
+            pickle.dump(record, fh, protocol = pickle.HIGHEST_PROTOCOL)
+
+
+def test_range_shards_cover_all_events_once():
+    shard_dict = assign_shards({ "a.cxi" : list(range(5)), "b.cxi" : list(range(4)) }, ["alice", "bob", "carol"])
+
+    record_list = [ (path_cxi, event_idx) for event_dict in shard_dict.values() for path_cxi, event_idx_list in event_dict.items() for event_idx in event_idx_list ]
+    assert sorted(record_list) == [ ("a.cxi", i) for i in range(5) ] + [ ("b.cxi", i) for i in range(4) ]
+    assert shard_dict["alice"] == { "a.cxi" : [0, 1, 2] }
+
+
+def test_stride_shards_with_overlap():
+    shard_dict = assign_shards({ "a.cxi" : list(range(10)) }, ["alice", "bob"], mode = 'stride', frac_overlap = 0.2, seed = 0)
+
+    assert set(shard_dict["alice"]["a.cxi"]) >= { 0, 2, 4, 6, 8 }
+    assert set(shard_dict["bob"]["a.cxi"])   >= { 1, 3, 5, 7, 9 }
+    assert len(shard_dict["alice"]["a.cxi"]) == len(shard_dict["bob"]["a.cxi"]) == 6
+
+
+def test_vote_needs_three_labels_and_ties_go_to_the_latest():
+    label_a = np.array([0, 1, 1, 2])
+    label_b = np.array([0, 1, 0, 3])
+    label_c = np.array([0, 0, 0, 1])
+
+    label, num_disputed = resolve_conflict([label_a, label_b], policy = 'vote')
+    assert label.tolist() == label_b.tolist() and num_disputed == 2
+
+    label, num_disputed = resolve_conflict([label_a, label_b, label_c], policy = 'vote')
+    assert label.tolist() == [0, 1, 0, 1] and num_disputed == 3
+
+
+def test_merge_resolves_frames_edited_by_several_annotators(tmp_path):
+    dir_session = str(tmp_path)
+    ones, twos  = np.ones((1, 2, 2), dtype = 'uint8'), np.full((1, 2, 2), 2, dtype = 'uint8')
+    write_edit_log(dir_session, "alice", { ("a.cxi", 0) : (1.0, ones), ("a.cxi", 1) : (5.0, ones) })
+    write_edit_log(dir_session, "bob"  , { ("a.cxi", 1) : (2.0, twos), ("b.cxi", 0) : (3.0, twos), ("a.cxi", None) : (4.0, ones) })
+
+    log_dict = list_edit_log(dir_session)
+    assert sorted(log_dict) == ["alice", "bob"]
+
+    path_output   = str(tmp_path / "merged.edits")
+    conflict_list = merge_edit_logs(log_dict, path_output, num_workers = 1)
+
+    label_state = read_recovery(path_output)
+    assert sorted(label_state, key = repr) == sorted([("a.cxi", 0), ("a.cxi", 1), ("b.cxi", 0), ("a.cxi", None)], key = repr)
+    assert label_state[("a.cxi", 1)].tolist() == ones.tolist()
+    assert [ (c["event_idx"], c["username"], c["num_disputed"]) for c in conflict_list ] == [(1, "bob alice", 4)]
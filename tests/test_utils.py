@@ -0,0 +1,101 @@
+import threading
+
+import numpy as np
+
+from manual_peak_labeler import utils
+from manual_peak_labeler.utils import PsanaImg, PsanaPrefetcher
+
+
+class FakePsanaImg:
+    ''' Count reads of events like `PsanaImg.get`.
+    '''
+
+    def __init__(self, num_event):
+        self.timestamps = list(range(num_event))
+        self.lock       = threading.Lock()
+        self.count_dict = {}
+
+    def get(self, event_num, mode = "image"):
+        with self.lock:
+            self.count_dict[event_num] = self.count_dict.get(event_num, 0) + 1
+
+        return np.full((2, 3), event_num, dtype = 'float32')
+
+
+class FakeEventTime:
+    def __init__(self, time, fiducial):
+        self.time     = time
+        self.fiducial = fiducial
+
+
+class FakeRun:
+    def __init__(self, num_event):
+        self.num_call  = 0
+        self.num_event = num_event
+
+    def times(self):
+        self.num_call += 1
+
+        return [ FakeTimestamp(i) for i in range(self.num_event) ]
+
+
+class FakeTimestamp:
+    def __init__(self, i):
+        self.i = i
+
+    def seconds(self)    : return 1000 + self.i
+    def nanoseconds(self): return 10 * self.i
+    def fiducial(self)   : return 7 * self.i
+
+
+def test_prefetcher_reads_each_event_once_in_a_sequential_scan():
+    psana_img  = FakePsanaImg(num_event = 40)
+    prefetcher = PsanaPrefetcher(psana_img, depth = 4)
+    try:
+        for event_num in range(40):
+            img = prefetcher.get(event_num)
+            assert img[0, 0] == event_num
+    finally:
+        prefetcher.close()
+
+    assert all(count == 1 for count in psana_img.count_dict.values())
+    assert sorted(psana_img.count_dict) == list(range(40))
+
+
+def test_prefetcher_stays_within_depth():
+    psana_img  = FakePsanaImg(num_event = 40)
+    prefetcher = PsanaPrefetcher(psana_img, depth = 4)
+    try:
+        for event_num in (0, 1, 20, 21, 5):
+            prefetcher.get(event_num)
+            assert len(prefetcher.future_dict) <= 4
+            assert event_num in prefetcher.future_dict
+    finally:
+        prefetcher.close()
+
+
+def test_prefetcher_iter_keeps_order():
+    psana_img  = FakePsanaImg(num_event = 10)
+    prefetcher = PsanaPrefetcher(psana_img, num_workers = 3, depth = 4)
+    try:
+        event_num_list = [ event_num for event_num, _ in prefetcher.iter([3, 1, 4, 1, 5, 9, 2, 6]) ]
+    finally:
+        prefetcher.close()
+
+    assert event_num_list == [3, 1, 4, 1, 5, 9, 2, 6]
+
+
+def test_timestamps_are_reused_from_the_saved_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.psana, "EventTime", FakeEventTime, raising = False)
+
+    path_timestamps = str(tmp_path / "timestamps")
+    psana_img = PsanaImg.__new__(PsanaImg)
+    psana_img.path_timestamps = path_timestamps
+    psana_img.run_current     = FakeRun(num_event = 5)
+
+    psana_img.load_timestamps()
+    timestamps = psana_img.load_timestamps()
+
+    assert psana_img.run_current.num_call == 1
+    assert [ t.time for t in timestamps ]     == [ ((1000 + i) << 32) | (10 * i) for i in range(5) ]
+    assert [ t.fiducial for t in timestamps ] == [ 7 * i for i in range(5) ]